@@ -0,0 +1,209 @@
+"""
+Offline stand-in for the parts of the Stripe API the job uses, for benchmarks.
+
+Serves Charge.list (per customer or account-wide, with created[gte], starting_after and
+expand[]=data.customer), Charge.retrieve and Subscription.list (per customer or status=active).
+Objects are derived from the customer number on the fly, so 1M customers cost no memory.
+Every request can be delayed, and a share of them answered with a 429.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Charges are spread over the year before this timestamp, some of them inside the 90-day maturity window
+BASE_CREATED = 1760000000
+CHARGE_ID = re.compile(r'ch_(\d+)_(\d+)$')
+
+
+def customer_id(number):
+    return f"cus_{number:08d}"
+
+
+def customer_number(customer):
+    return int(customer[4:])
+
+
+class FakeStripeData:
+    """
+    Deterministic synthetic Stripe account: customers cus_00000000 .. cus_<customers-1>.
+    """
+
+    def __init__(self, customers, charges_per_customer, active_ratio=0.3):
+        self.customers = customers
+        self.charges_per_customer = charges_per_customer
+        self.active_ratio = active_ratio
+
+    def charge_count(self, number):
+        # Between 0 and 2x the average, spread by a multiplicative hash of the customer number
+        return (number * 2654435761) % (2 * self.charges_per_customer + 1)
+
+    def is_active(self, number):
+        return (number * 40503) % 1000 < self.active_ratio * 1000
+
+    def customer(self, number):
+        return {'id': customer_id(number), 'object': 'customer', 'email': f"customer{number}@example.com"}
+
+    def charge(self, number, index, expand_customer):
+        disputed = (number + index) % 97 == 0
+        return {
+            'id': f"ch_{number:08d}_{index:03d}",
+            'object': 'charge',
+            'amount': 1000 + (number * 7 + index * 13) % 9000,
+            'currency': 'usd',
+            'status': 'succeeded' if (number + index) % 53 else 'failed',
+            'disputed': disputed,
+            'dispute': f"dp_{number:08d}_{index:03d}" if disputed else None,
+            'refunded': (number + index) % 71 == 0,
+            'created': BASE_CREATED - ((number * 31 + index * 86413) % (365 * 86400)),
+            'description': 'Subscription payment',
+            'payment_method_details': {'type': 'card', 'card': {'brand': 'visa', 'last4': f"{number % 10000:04d}"}},
+            'customer': self.customer(number) if expand_customer else customer_id(number),
+        }
+
+    def subscription(self, number, status):
+        return {'id': f"sub_{number:08d}", 'object': 'subscription', 'customer': customer_id(number), 'status': status}
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    # Set on the subclass built by FakeStripeServer
+    server_state = None
+
+    def do_GET(self):
+        state = self.server_state
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        state.count(url.path)
+
+        if state.latency:
+            time.sleep(state.latency)
+        if state.rate_limit_ratio and state.random() < state.rate_limit_ratio:
+            state.count('429')
+            self._send(429, {'error': {'type': 'invalid_request_error', 'code': 'rate_limit',
+                                       'message': 'Too many requests (injected)'}},
+                       {'Retry-After': str(state.retry_after)})
+            return
+
+        if url.path == '/v1/charges':
+            self._send(200, self._list_charges(query))
+        elif url.path.startswith('/v1/charges/'):
+            match = CHARGE_ID.match(url.path.rsplit('/', 1)[1])
+            if not match:
+                self._send(404, {'error': {'type': 'invalid_request_error', 'message': 'No such charge'}})
+                return
+            number, index = int(match.group(1)), int(match.group(2))
+            self._send(200, state.data.charge(number, index, 'customer' in query.get('expand[0]', '')))
+        elif url.path == '/v1/subscriptions':
+            self._send(200, self._list_subscriptions(query))
+        else:
+            self._send(404, {'error': {'type': 'invalid_request_error', 'message': f"Unknown path {url.path}"}})
+
+    def _list_charges(self, query):
+        data = self.server_state.data
+        limit = int(query.get('limit', 10))
+        created_gte = int(query.get('created[gte]', 0))
+        expand_customer = query.get('expand[0]') == 'data.customer'
+
+        position = (-1, -1)
+        if 'starting_after' in query:
+            match = CHARGE_ID.match(query['starting_after'])
+            position = (int(match.group(1)), int(match.group(2)))
+        if 'customer' in query:
+            numbers = [customer_number(query['customer'])]
+        else:
+            numbers = range(max(position[0], 0), data.customers)
+
+        page = []
+        for number in numbers:
+            for index in range(data.charge_count(number)):
+                if (number, index) <= position:
+                    continue
+                charge = data.charge(number, index, expand_customer)
+                if charge['created'] < created_gte:
+                    continue
+                if len(page) == limit:
+                    return {'object': 'list', 'url': '/v1/charges', 'has_more': True, 'data': page}
+                page.append(charge)
+        return {'object': 'list', 'url': '/v1/charges', 'has_more': False, 'data': page}
+
+    def _list_subscriptions(self, query):
+        data = self.server_state.data
+        limit = int(query.get('limit', 10))
+        if 'customer' in query:
+            number = customer_number(query['customer'])
+            status = 'active' if data.is_active(number) else 'canceled'
+            return {'object': 'list', 'url': '/v1/subscriptions', 'has_more': False,
+                    'data': [data.subscription(number, status)]}
+
+        start = customer_number(query['starting_after'].replace('sub_', 'cus_')) + 1 if 'starting_after' in query else 0
+        page = []
+        for number in range(start, data.customers):
+            if data.is_active(number):
+                if len(page) == limit:
+                    return {'object': 'list', 'url': '/v1/subscriptions', 'has_more': True, 'data': page}
+                page.append(data.subscription(number, 'active'))
+        return {'object': 'list', 'url': '/v1/subscriptions', 'has_more': False, 'data': page}
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeStripeState:
+    def __init__(self, data, latency, rate_limit_ratio, retry_after, seed):
+        self.data = data
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def count(self, key):
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.calls)
+
+
+class FakeStripeServer:
+    """
+    Fake Stripe API on a background thread. Point the SDK at it with stripe.api_base = server.url.
+    """
+
+    def __init__(self, data, latency=0.0, rate_limit_ratio=0.0, retry_after=0.05, seed=0, port=0):
+        self.state = FakeStripeState(data, latency, rate_limit_ratio, retry_after, seed)
+        handler = type('BoundFakeStripeHandler', (FakeStripeHandler,), {'server_state': self.state})
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-stripe', daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
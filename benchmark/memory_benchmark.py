@@ -0,0 +1,121 @@
+"""
+Memory footprint of the charge and user frames, all-object construction against resources.schema.
+
+    python -m benchmark.memory_benchmark --charges 1000000 --output memory_1m.json
+
+Synthetic charge records shaped like update_commision_transactions_db.stripe_client records, plus
+their user_id and referee, are built once. Each frame is then constructed the way the job used to
+(an all-object frame, booleans coerced afterwards) and with the schema dtypes, and the report records
+the frame size (memory_usage(deep=True)) and the peak allocated while building it (tracemalloc).
+
+The records themselves are built before tracing starts, only the frames are measured.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmark.fake_stripe import FakeStripeData, customer_id
+from benchmark.synthetic import USERS_PER_REFEREE, _user_uuid
+from resources.schema import USER_DTYPES, charge_frame, records_frame
+from update_commision_transactions_db.update_commision_transactions import CHARGE_COLUMNS
+
+DESCRIPTIONS = ['Subscription creation', 'Subscription update', 'Subscription payment']
+BRANDS = ['visa', 'mastercard', 'amex']
+
+
+def charge_records(charges, charges_per_customer):
+    """
+    Deterministic charge records, spread over charges / charges_per_customer customers.
+    """
+    data = FakeStripeData(max(1, charges // charges_per_customer), charges_per_customer)
+    customers = data.customers
+    referees = max(1, customers // USERS_PER_REFEREE)
+    records = []
+    for position in range(charges):
+        number, index = position % customers, position // customers
+        charge = data.charge(number, index, expand_customer=False)
+        records.append({
+            'user_id': str(_user_uuid('user', number)),
+            'referee': str(_user_uuid('referee', number % referees)),
+            'customer_id': customer_id(number),
+            'email': f"customer{number}@example.com",
+            'charge_id': charge['id'],
+            'amount': charge['amount'] / 100.0,
+            'currency': charge['currency'].upper(),
+            'status': charge['status'],
+            'disputed': charge['disputed'],
+            'dispute': charge['dispute'],
+            'refunded': charge['refunded'],
+            'created': pd.Timestamp(charge['created'], unit='s'),
+            'description': DESCRIPTIONS[position % len(DESCRIPTIONS)],
+            'payment_method': BRANDS[number % len(BRANDS)],
+            'last4': charge['payment_method_details']['card']['last4'],
+        })
+    return records
+
+
+def user_records(users):
+    referees = max(1, users // USERS_PER_REFEREE)
+    return [
+        {'user_id': str(_user_uuid('user', number)), 'stripe_customer_id': customer_id(number),
+         'referee': str(_user_uuid('referee', number % referees))}
+        for number in range(users)
+    ]
+
+
+def _object_charge_frame(records):
+    df = pd.DataFrame.from_records(records, columns=CHARGE_COLUMNS)
+    df['disputed'] = df['disputed'].astype(bool)
+    df['refunded'] = df['refunded'].astype(bool)
+    return df
+
+
+def measure(name, build, records):
+    """
+    Build a frame under tracemalloc and report its size and the construction peak.
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    df = build(records)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'frame': name,
+        'rows': len(df),
+        'frame_mb': round(df.memory_usage(index=False, deep=True).sum() / 1e6, 1),
+        'build_peak_mb': round(peak / 1e6, 1),
+        'build_seconds': round(seconds, 2),
+        'dtypes': {column: str(dtype) for column, dtype in df.dtypes.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare frame memory with and without the typed schema.")
+    parser.add_argument('--charges', type=int, default=1000000)
+    parser.add_argument('--charges-per-customer', type=int, default=4)
+    parser.add_argument('--output', default='memory_benchmark.json')
+    args = parser.parse_args(argv)
+
+    charges = charge_records(args.charges, args.charges_per_customer)
+    users = user_records(max(1, args.charges // args.charges_per_customer))
+    results = [
+        measure('charges_object', _object_charge_frame, charges),
+        measure('charges_schema', lambda records: charge_frame(records, CHARGE_COLUMNS), charges),
+        measure('users_object', lambda records: pd.DataFrame(records, columns=list(USER_DTYPES)), users),
+        measure('users_schema', lambda records: records_frame(records, list(USER_DTYPES), USER_DTYPES), users),
+    ]
+    for result in results:
+        print(json.dumps({key: value for key, value in result.items() if key != 'dtypes'}))
+
+    report = {'charges': args.charges, 'charges_per_customer': args.charges_per_customer, 'cases': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
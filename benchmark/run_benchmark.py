@@ -0,0 +1,242 @@
+"""
+Reproducible benchmark of the job against offline stand-ins.
+
+    python -m benchmark.run_benchmark --postgres-uri postgresql://bench@localhost/bench --scale 1k
+    python -m benchmark.run_benchmark --postgres-uri ... --scale 100k --latency-ms 30 --rate-limit-ratio 0.02 \
+        --execution-mode async --output bench_100k.json
+
+A synthetic account (users, referrals, Stripe customers and charges) is generated at the chosen scale,
+Stripe is served by benchmark.fake_stripe and Redis by fakeredis unless --redis-url is given.
+Each stage, then the full main(), runs in a fresh process from a cold database, and the report
+records wall time, Stripe API calls, DB round trips and peak RSS per case.
+
+The benchmark database is dropped and re-seeded: never point --postgres-uri at a real database.
+Needs fakeredis on top of requirements.txt (pip install fakeredis); the benchmark is not shipped in the image.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+from benchmark.fake_stripe import FakeStripeData, FakeStripeServer
+from benchmark.synthetic import seed_database, reset_job_state
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+STAGE_CASES = ['update_active_status', 'update_commision_transactions_df', 'update_redis']
+
+
+class BenchmarkLogger:
+    """
+    Logger stand-in: drops info and debug lines, prints warnings and errors to stderr and counts them.
+    """
+
+    debug_enabled = False
+
+    def __init__(self):
+        self.errors = 0
+
+    def debug(self, message, *args, **kwargs):
+        pass
+
+    def info(self, message, *args, **kwargs):
+        pass
+
+    def warning(self, message, *args, **kwargs):
+        print(f"WARNING: {message % args if args else message}", file=sys.stderr)
+
+    def error(self, message, *args, **kwargs):
+        self.errors += 1
+        print(f"ERROR: {message % args if args else message}", file=sys.stderr)
+
+    critical = exception = error
+
+    def record(self, message, severity='INFO', **fields):
+        pass
+
+    def flush(self):
+        pass
+
+    def wait_ready(self):
+        pass
+
+
+def _run_case(case, settings, connection):
+    """
+    Run one case in this (fresh) process and send back its measurements.
+    """
+    os.environ.update(settings['env'])
+
+    import fakeredis
+    import stripe
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    stripe.api_base = settings['stripe_url']
+    round_trips = [0]
+
+    def count_round_trip(*args):
+        round_trips[0] += 1
+
+    event.listen(Engine, 'before_cursor_execute', count_round_trip)
+
+    import main
+    import resources.async_clients as async_clients
+    import update_redis.update_redis as update_redis_module
+    from resources.scheduler import RunContext, run_stages
+
+    if not settings['redis_url']:
+        redis_server = fakeredis.FakeServer()
+        update_redis_module.connect_redis = lambda logger: fakeredis.FakeRedis(server=redis_server,
+                                                                              decode_responses=True)
+        async_clients.get_async_redis = lambda: fakeredis.aioredis.FakeRedis(server=redis_server,
+                                                                             decode_responses=True)
+
+    logger = BenchmarkLogger()
+    started = time.perf_counter()
+    if case == 'main':
+        main.main(logger)
+        ok = logger.errors == 0
+    else:
+        stages = [stage._replace(depends_on=()) for stage in main.STAGES if stage.name == case]
+        if settings['env']['EXECUTION_MODE'] == 'async':
+            import asyncio
+            timings = asyncio.run(main.run_async(logger, stages, RunContext()))
+        else:
+            timings = run_stages(stages, logger, RunContext())
+        ok = timings[case]['ok']
+    wall_seconds = time.perf_counter() - started
+
+    connection.send({
+        'case': case,
+        'ok': ok,
+        'wall_seconds': round(wall_seconds, 3),
+        'db_round_trips': round_trips[0],
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'errors_logged': logger.errors,
+    })
+    connection.close()
+
+
+def run_case(case, settings, stripe_server):
+    """
+    Run a case in a spawned process, so peak RSS and imports are measured per case.
+    """
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    calls_before = stripe_server.state.snapshot()
+    process = context.Process(target=_run_case, args=(case, settings, sender), name=f"bench-{case}")
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'case': case, 'ok': False, 'error': f"process exited with {process.exitcode}"}
+    process.join()
+
+    calls_after = stripe_server.state.snapshot()
+    calls = {key: calls_after.get(key, 0) - calls_before.get(key, 0) for key in calls_after}
+    # Every request counts as an API call, including the ones answered with an injected 429
+    result['api_calls'] = sum(count for key, count in calls.items() if key != '429')
+    result['api_calls_by_path'] = {key: count for key, count in calls.items() if key != '429' and count}
+    result['rate_limited'] = calls.get('429', 0)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the job against offline Stripe, Postgres and Redis.")
+    parser.add_argument('--postgres-uri', required=True, help="Benchmark database, dropped and re-seeded.")
+    parser.add_argument('--redis-url', help="Real Redis to publish to, e.g. redis://localhost:6379/0. "
+                                            "Defaults to fakeredis.")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    parser.add_argument('--users', type=int, help="Referred users, overrides --scale.")
+    parser.add_argument('--charges-per-customer', type=int, default=4, help="Average charges per customer.")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="Added to every fake Stripe response.")
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help="Share of requests answered with a 429.")
+    parser.add_argument('--execution-mode', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--stripe-rps', type=float,
+                        help="Client-side Stripe rate limit. Defaults to the job's STRIPE_REQUESTS_PER_SECOND.")
+    parser.add_argument('--cases', nargs='+', default=STAGE_CASES + ['main'],
+                        help="Stages to run on their own, and/or 'main' for the full job.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args(argv)
+
+    users = args.users or SCALES[args.scale]
+    engine = create_engine(args.postgres_uri)
+
+    started = time.perf_counter()
+    seeded = seed_database(engine, users)
+    seed_seconds = round(time.perf_counter() - started, 3)
+    print(f"Seeded {seeded} in {seed_seconds}s")
+
+    stripe_server = FakeStripeServer(FakeStripeData(users, args.charges_per_customer), latency=args.latency_ms / 1000,
+                                     rate_limit_ratio=args.rate_limit_ratio, seed=args.seed).start()
+
+    env = {
+        'PROJECT_ID': os.getenv('PROJECT_ID', 'benchmark'),
+        'DATABASE_URL': args.postgres_uri,
+        'STRIPE_SECRET_KEY': 'sk_test_benchmark',
+        'EXECUTION_MODE': args.execution_mode,
+        'LOG_LEVEL': 'INFO',
+    }
+    if args.stripe_rps:
+        env['STRIPE_REQUESTS_PER_SECOND'] = str(args.stripe_rps)
+    if args.redis_url:
+        from urllib.parse import urlparse
+        redis_url = urlparse(args.redis_url)
+        env.update(REDIS_HOST=redis_url.hostname, REDIS_PORT=str(redis_url.port or 6379),
+                   REDIS_DB=(redis_url.path.strip('/') or '0'))
+    settings = {'env': env, 'stripe_url': stripe_server.url, 'redis_url': args.redis_url}
+
+    results = []
+    try:
+        for case in args.cases:
+            # Stages build on each other; only the first stage and the full job start from a cold database
+            if case in ('main', args.cases[0]):
+                reset_job_state(engine)
+            result = run_case(case, settings, stripe_server)
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        stripe_server.stop()
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'settings': {
+            'users': users,
+            'charges_per_customer': args.charges_per_customer,
+            'latency_ms': args.latency_ms,
+            'rate_limit_ratio': args.rate_limit_ratio,
+            'execution_mode': args.execution_mode,
+            'stripe_rps': args.stripe_rps,
+            'redis': args.redis_url or 'fakeredis',
+            'seed': args.seed,
+        },
+        'seed_seconds': seed_seconds,
+        'cases': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Seed a benchmark Postgres database with synthetic users and referrals matching benchmark.fake_stripe.
+"""
+import io
+import uuid
+
+from sqlalchemy import text
+
+from benchmark.fake_stripe import customer_id
+from resources.models import Base
+
+# One referee per this many referred users
+USERS_PER_REFEREE = 20
+
+_NAMESPACE = uuid.UUID('6f1c1d1e-8c58-4b0e-9a55-2f0b3c0c7a11')
+
+
+def _user_uuid(kind, number):
+    return uuid.uuid5(_NAMESPACE, f"{kind}-{number}")
+
+
+def _copy(raw_connection, table, columns, rows):
+    """
+    Bulk load rows with COPY FROM STDIN, 100k rows per round trip.
+    """
+    with raw_connection.cursor() as cursor:
+        buffer = io.StringIO()
+        for count, row in enumerate(rows, 1):
+            buffer.write('\t'.join('\\N' if value is None else str(value) for value in row) + '\n')
+            if count % 100000 == 0:
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+                buffer = io.StringIO()
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def seed_database(engine, users, commission=0.25):
+    """
+    Recreate the job's tables and load `users` referred users (customers cus_00000000 ..) plus their referees.
+
+    Every table of resources.models is dropped first: only ever point this at a benchmark database.
+
+    Returns:
+    dict: Row counts loaded per table.
+    """
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    referees = max(1, users // USERS_PER_REFEREE)
+    user_columns = ['user_id', 'email', 'password_hash', 'signup_date', 'isactive', 'verified', 'active_symbols',
+                    'strategy', 'cancel_at_period_end', 'stripe_customer_id', 'referee']
+
+    def referee_rows():
+        for number in range(referees):
+            yield (_user_uuid('referee', number), f"referee{number}@example.com", 'x', '2024-01-01', 'f', 't',
+                   '{}', '{}', 'f', None, None)
+
+    def referred_rows():
+        for number in range(users):
+            yield (_user_uuid('user', number), f"user{number}@example.com", 'x', '2024-01-01', 'f', 't', '{}', '{}',
+                   'f', customer_id(number), _user_uuid('referee', number % referees))
+
+    def referral_rows():
+        for number in range(referees):
+            yield (_user_uuid('referee', number), f"ref{number}", '{}', commission, 0.05)
+
+    raw_connection = engine.raw_connection()
+    try:
+        _copy(raw_connection, 'users', user_columns, referee_rows())
+        _copy(raw_connection, 'users', user_columns, referred_rows())
+        _copy(raw_connection, 'referrals', ['user_id', 'referral_link', 'referrals', 'commission', 'discount'],
+              referral_rows())
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+    return {'users': users + referees, 'referrals': referees}
+
+
+def reset_job_state(engine):
+    """
+    Forget everything a previous run wrote, so the next case starts cold.
+    """
+    with engine.begin() as connection:
+        connection.execute(text("TRUNCATE commission_transactions, charge_sync_state, shard_runs, run_state"))
+        connection.execute(text("UPDATE users SET isactive = false WHERE isactive"))
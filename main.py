@@ -1,35 +1,104 @@
 # stripe_db_tool/main.py
-from resources.db import get_db_session
+import asyncio
+import time
+
+from resources import metrics, startup
+from resources.config import Config
 from resources.logger import get_logger
-from update_active_status.update_active_status import update_active_status
-from update_commision_transactions_db.update_commision_transactions import update_commision_transactions_df
-from update_redis.update_redis import update_redis
+from resources.scheduler import Stage, RunContext, run_stages, run_stages_async, run_reduce_once
+from resources.sharding import SINGLE_SHARD, parse_shard_args
+from resources.stripe_cache import get_stripe_cache
 
+startup.mark('core_imports')
 
-def main(logger):
-    logger.info(f"Entering main function")
-    session = get_db_session()
+# pandas comes in with resources.db through the scheduler; the stage modules (stripe, redis) are only
+# imported when their stage runs.
+# The subscription check and the charge sync are independent and run concurrently;
+# the Redis summaries are built from the charges, so they wait for the sync.
+STAGES = [
+    Stage('update_active_status', 'update_active_status.update_active_status:update_active_status', (),
+          'update_active_status.update_active_status:update_active_status_async'),
+    Stage('update_commision_transactions_df',
+          'update_commision_transactions_db.update_commision_transactions:update_commision_transactions_df', (),
+          'update_commision_transactions_db.update_commision_transactions:update_commision_transactions_df_async'),
+    Stage('update_redis', 'update_redis.update_redis:update_redis', ('update_commision_transactions_df',),
+          'update_redis.update_redis:update_redis_async'),
+]
 
-    try:
-        update_active_status(session, logger)
-    except Exception as e:
-        logger.error(f"Error update_active_status(): {str(e)}")
+# Stages that aggregate over every user. In a sharded run they run once, after all shards have committed.
+REDUCE_STAGES = {'update_redis'}
 
-    try:
-        update_commision_transactions_df(session, logger)
-    except Exception as e:
-        logger.error(f"Error update_commision_transactions_df(): {str(e)}")
+
+async def run_async(logger, stages, context):
+    """
+    Run the stages on one event loop with the async Stripe, Postgres and Redis clients.
+    """
+    from resources.async_clients import dispose_async_clients
 
     try:
-        update_redis(session, logger)
-    except Exception as e:
-        logger.error(f"Error update_redis(): {str(e)}")
+        return await run_stages_async(stages, logger, context)
+    finally:
+        await dispose_async_clients()
+
+
+def report_metrics(logger, shard, run_id, stripe_cache_stats=None):
+    """
+    Emit the run's metrics as one structured log record and, if Config.METRICS_TEXTFILE is set,
+    as a Prometheus text file.
+    """
+    if not metrics.enabled():
+        return
+    logger.record("Run metrics", run_id=run_id, shard=f"{shard.index}/{shard.count}",
+                  execution_mode=Config.EXECUTION_MODE, stripe_cache=stripe_cache_stats, **metrics.summary())
+    if Config.METRICS_TEXTFILE:
+        try:
+            metrics.write_textfile(Config.METRICS_TEXTFILE)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {Config.METRICS_TEXTFILE}: {str(e)}")
+
+
+def main(logger, shard=SINGLE_SHARD, run_id=None):
+    logger.info(f"Entering main function (shard {shard.index}/{shard.count})")
+    started = time.perf_counter()
+    # The Cloud Logging client was created in the background meanwhile, a broken one stops the job here
+    logger.wait_ready()
+    startup.mark('gcp_logger')
+
+    context = RunContext(shard, run_id)
+    if shard.count == 1:
+        stages = STAGES
+    else:
+        stages = [stage for stage in STAGES if stage.name not in REDUCE_STAGES]
+
+    if Config.EXECUTION_MODE == 'async':
+        timings = asyncio.run(run_async(logger, stages, context))
+    else:
+        timings = run_stages(stages, logger, context)
+
+    if shard.count > 1:
+        # The reduce stages read the committed rows of every shard, not this shard's stage results
+        reduce_stages = [stage._replace(depends_on=()) for stage in STAGES if stage.name in REDUCE_STAGES]
+        timings.update(run_reduce_once(reduce_stages, timings, logger, run_id, shard, context))
 
-    logger.info(f"session closing")
-    session.close()
+    logger.info(f"Stage timings: {timings}")
+    cache = get_stripe_cache()
+    cache_stats = cache.stats() if cache else None
+    if cache:
+        logger.info(f"Stripe cache: {cache_stats}")
+        cache.close()
+    metrics.gauge('run_seconds', round(time.perf_counter() - started, 3))
+    report_metrics(logger, shard, run_id, cache_stats)
+    logger.info(f"Startup report: {startup.startup_report()}")
     logger.info(f"Program complete")
 
 
 if __name__ == "__main__":
+    shard, run_id = parse_shard_args()
     logger = get_logger('Subscription_transactions')
-    main(logger)
\ No newline at end of file
+    startup.mark('logger')
+    if Config.RUN_MODE == 'webhook':
+        from webhook_ingestion.server import serve
+        logger.wait_ready()
+        serve(logger)
+    else:
+        main(logger, shard, run_id)
@@ -0,0 +1,47 @@
+-- One-off schema migration for the sync job, applied once per database by a role that owns
+-- commission_transactions, before the first run of this version:
+--
+--     psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f migrations/001_job_tables.sql
+--
+-- The job itself never runs DDL. Adding a column takes an ACCESS EXCLUSIVE lock on
+-- commission_transactions, which the web application reads, so run it at a quiet time.
+-- Every statement is idempotent.
+
+BEGIN;
+
+-- Charge sync high-water marks, per Stripe customer or per account-wide scan
+CREATE TABLE IF NOT EXISTS charge_sync_state (
+    sync_key VARCHAR(255) NOT NULL,
+    last_created TIMESTAMP WITHOUT TIME ZONE,
+    last_charge_id VARCHAR(50),
+    updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (sync_key)
+);
+
+-- Completed shards of a sharded run, so the reduce step runs once
+CREATE TABLE IF NOT EXISTS shard_runs (
+    run_id VARCHAR(255) NOT NULL,
+    shard_index INTEGER NOT NULL,
+    shard_count INTEGER NOT NULL,
+    completed_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    reduced_at TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (run_id, shard_index)
+);
+
+-- Stage checkpoints
+CREATE TABLE IF NOT EXISTS run_state (
+    stage_key VARCHAR(255) NOT NULL,
+    run_id VARCHAR(255),
+    phase VARCHAR(32) NOT NULL,
+    last_key VARCHAR(255),
+    batch INTEGER NOT NULL,
+    retry_keys JSONB NOT NULL,
+    state JSONB,
+    updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (stage_key)
+);
+
+-- Hash of the synced columns of a charge, NULL until the job has written the row
+ALTER TABLE commission_transactions ADD COLUMN IF NOT EXISTS row_fingerprint BIGINT;
+
+COMMIT;
@@ -0,0 +1,82 @@
+# stripe_db_tool/async_clients.py
+import asyncio
+
+import stripe
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from resources import metrics
+from resources.config import Config
+
+# Like the sync engine, the async engine is created on first use
+_async_engine = None
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+
+def get_async_engine():
+    """
+    Return the asyncpg-backed engine. Its pool is capped at Config.ASYNC_DB_CONCURRENCY connections.
+    """
+    global _async_engine
+    if _async_engine is None:
+        url = make_url(Config.SQLALCHEMY_DATABASE_URI).set(drivername='postgresql+asyncpg')
+        _async_engine = create_async_engine(url, pool_size=Config.ASYNC_DB_CONCURRENCY, max_overflow=0)
+        metrics.instrument_engine(_async_engine)
+        AsyncSessionLocal.configure(bind=_async_engine)
+    return _async_engine
+
+
+def new_async_db_session():
+    """
+    Open a dedicated AsyncSession, e.g. for one async stage. The caller closes it.
+
+    The existing sync helpers in resources.db run unchanged on it through session.run_sync().
+    """
+    get_async_engine()
+    return AsyncSessionLocal()
+
+
+def get_async_redis():
+    """
+    Return a redis.asyncio client whose pool blocks once Config.ASYNC_REDIS_CONCURRENCY connections are in use.
+    """
+    import redis.asyncio as aioredis
+
+    pool = aioredis.BlockingConnectionPool(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                                           password=Config.REDIS_PASSWORD, decode_responses=True,
+                                           max_connections=Config.ASYNC_REDIS_CONCURRENCY)
+    return aioredis.Redis.from_pool(pool)
+
+
+def configure_async_stripe():
+    """
+    Route the Stripe SDK through httpx, whose clients keep a pool of keep-alive connections.
+    The *_async methods use its AsyncClient; sync methods keep working on its sync client.
+    """
+    stripe.api_key = Config.STRIPE_SECRET_KEY
+    if not isinstance(stripe.default_http_client, stripe.HTTPXClient):
+        stripe.default_http_client = stripe.HTTPXClient(allow_sync_methods=True)
+
+
+class BackendLimits:
+    """
+    Per-backend bounds on in-flight async operations. Create it inside the event loop that uses it.
+    """
+
+    def __init__(self):
+        self.stripe = asyncio.Semaphore(Config.ASYNC_STRIPE_CONCURRENCY)
+        self.db = asyncio.Semaphore(Config.ASYNC_DB_CONCURRENCY)
+        self.redis = asyncio.Semaphore(Config.ASYNC_REDIS_CONCURRENCY)
+
+
+async def dispose_async_clients():
+    """
+    Close the async engine's pooled connections and the Stripe HTTP client at the end of an async run.
+    """
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+    if isinstance(stripe.default_http_client, stripe.HTTPXClient):
+        await stripe.default_http_client.close_async()
+        stripe.default_http_client = None
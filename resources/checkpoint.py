@@ -0,0 +1,111 @@
+# stripe_db_tool/checkpoint.py
+from datetime import datetime, timedelta
+
+from resources.config import Config
+from resources.db import fetch_run_state, save_run_state, clear_run_state
+
+# Phase that works through the retry list instead of a fresh key range
+RETRY_PHASE = 'retry'
+
+
+def stage_key(name, shard):
+    """
+    Checkpoint key of a stage. Each shard of a sharded run keeps its own checkpoint.
+    """
+    if shard.count == 1:
+        return name
+    return f"{name}:{shard.index}/{shard.count}"
+
+
+class StageCheckpoint:
+    """
+    Progress of a resumable stage, persisted in the run_state table after every committed batch.
+
+    A stage works through ordered phases (e.g. 'reverify', 'customers', then 'retry'), each over keys
+    in ascending order. Once a batch is committed the stage records the phase, the last key the batch
+    covered and the keys that failed. A later run resumes after the last committed key instead of
+    starting over, and failed keys wait on the retry list instead of aborting the stage.
+
+    A checkpoint is only resumed while younger than Config.CHECKPOINT_MAX_AGE_HOURS and written with
+    the same params, e.g. the same sync mode.
+    """
+
+    def __init__(self, key, phases, run_id=None, params=None):
+        self.key = key
+        self.phases = list(phases)
+        self.run_id = run_id
+        self.params = params or {}
+        self.phase = self.phases[0]
+        self.last_key = None
+        self.batch = 0
+        self.retry_keys = set()
+        # Stage-specific extras saved with every batch, e.g. a watermark only written once the stage completes
+        self.state = {}
+        self.resumed = False
+
+    def load(self, session, logger):
+        """
+        Pick up the stored checkpoint of the stage, if it can be resumed.
+        """
+        row = fetch_run_state(session, self.key)
+        if row is None:
+            return self
+
+        state = dict(row['state'] or {})
+        params = state.pop('params', None)
+        age = datetime.utcnow() - row['updated_at']
+        if (age > timedelta(hours=Config.CHECKPOINT_MAX_AGE_HOURS) or params != self.params
+                or row['phase'] not in self.phases):
+            logger.info(f"Discarding checkpoint of {self.key} left by run {row['run_id']} "
+                        f"({age.total_seconds() / 3600:.1f}h old, params {params}).")
+            return self
+
+        self.phase = row['phase']
+        self.last_key = row['last_key']
+        self.batch = row['batch']
+        self.retry_keys = set(row['retry_keys'])
+        self.state = state
+        self.resumed = True
+        logger.info(f"Resuming {self.key} from the checkpoint of run {row['run_id']}: phase {self.phase} after "
+                    f"{self.last_key}, {self.batch} batches committed, {len(self.retry_keys)} keys to retry.")
+        return self
+
+    def finished(self, phase):
+        """
+        Whether a resumed run had already committed every key of the phase.
+        """
+        return self.phases.index(phase) < self.phases.index(self.phase)
+
+    def pending(self, phase, key):
+        """
+        Whether the key of the phase still has to be processed.
+        """
+        if self.finished(phase):
+            return False
+        return phase != self.phase or self.last_key is None or key > self.last_key
+
+    def commit(self, session, phase, last_key, failed=()):
+        """
+        Record a committed batch of the phase.
+
+        Parameters:
+        session (sqlalchemy.orm.session.Session): SQLAlchemy session for database operations.
+        phase (str): Phase the batch belongs to.
+        last_key (str): Highest key the batch covered, or None to keep the previous one.
+        failed (iterable): Keys of the batch that failed, put on the retry list.
+        """
+        if phase != self.phase:
+            self.phase = phase
+            self.last_key = None
+        if phase == RETRY_PHASE and last_key is not None:
+            # Every retry key up to last_key has had its retry, only the ones that failed again stay listed
+            self.retry_keys = {key for key in self.retry_keys if key > last_key}
+        self.retry_keys.update(failed)
+        if last_key is not None:
+            self.last_key = last_key
+        self.batch += 1
+        save_run_state(session, self.key, self.run_id, self.phase, self.last_key, self.batch,
+                       sorted(self.retry_keys), {'params': self.params, **self.state})
+
+    def clear(self, session):
+        clear_run_state(session, self.key)
@@ -1,24 +1,67 @@
 # stripe_db_tool/config.py
 from dotenv import load_dotenv
-from google.cloud import secretmanager
-from google.api_core.exceptions import GoogleAPIError
 import os
+import threading
+import time
 
 load_dotenv()
 
+SECRET_CACHE_TTL = float(os.getenv('SECRET_CACHE_TTL', 3600))  # Seconds a resolved secret stays valid
+
+# Resolved secrets are only ever kept in this process's memory, never written to disk
+_secret_cache = {}
+_secret_lock = threading.Lock()
+
+
 def get_secret(secret_id, project_id):
-    try:
-        client = secretmanager.SecretManagerServiceClient()
-        name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
-        response = client.access_secret_version(request={"name": name})
-        secret = response.payload.data.decode("UTF-8")
-        print(f"Successfully fetched secret {secret_id}")
+    """
+    Resolve a Secret Manager secret, served from the in-memory cache while younger than SECRET_CACHE_TTL.
+    The Secret Manager client is only imported on a miss.
+    """
+    cache_key = f"{project_id}/{secret_id}"
+    with _secret_lock:
+        cached = _secret_cache.get(cache_key)
+        if cached and time.time() - cached[1] <= SECRET_CACHE_TTL:
+            return cached[0]
+
+        from google.cloud import secretmanager
+        from google.api_core.exceptions import GoogleAPIError
+
+        try:
+            client = secretmanager.SecretManagerServiceClient()
+            name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
+            response = client.access_secret_version(request={"name": name})
+            secret = response.payload.data.decode("UTF-8")
+            print(f"Successfully fetched secret {secret_id}")
+        except GoogleAPIError as e:
+            print(f"Error fetching secret {secret_id}: {str(e)}")
+            raise
+
+        fetched_at = time.time()
+        _secret_cache[cache_key] = (secret, fetched_at)
         return secret
-    except GoogleAPIError as e:
-        print(f"Error fetching secret {secret_id}: {str(e)}")
-        raise
 
-class Config:
+
+class _LazyConfig(type):
+    """
+    Resolves secrets and the settings derived from them on first access instead of at import time.
+    """
+
+    @property
+    def DB_PASSWORD(cls):
+        if cls.DB_SECRET_ID and cls.PROJECT_ID:
+            return get_secret(cls.DB_SECRET_ID, cls.PROJECT_ID)
+        return os.getenv('DB_PASSWORD')
+
+    @property
+    def SQLALCHEMY_DATABASE_URI(cls):
+        # A full DATABASE_URL (e.g. a local benchmark database) takes precedence over the DB_* settings
+        if os.getenv('DATABASE_URL'):
+            return os.getenv('DATABASE_URL')
+        return f"postgresql://{cls.DB_USER}:{cls.DB_PASSWORD}@{cls.DB_HOST}:{cls.DB_PORT}/{cls.DB_NAME}"
+
+
+class Config(metaclass=_LazyConfig):
     PROJECT_ID = os.getenv('PROJECT_ID')
     DB_SECRET_ID = os.getenv('DB_SECRET_ID')
     DB_USER = os.getenv('DB_USER')
@@ -30,8 +73,72 @@ class Config:
     REDIS_PORT = os.getenv('REDIS_PORT')
     REDIS_DB = os.getenv('REDIS_DB')
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+    # Keys written per pipelined Redis round trip
+    REDIS_BATCH_SIZE = int(os.getenv('REDIS_BATCH_SIZE', 500))
+    # Hash holding a fingerprint per published referee summary, used to skip unchanged writes
+    REDIS_FINGERPRINT_KEY = os.getenv('REDIS_FINGERPRINT_KEY', 'commission_summaries:fingerprints')
+    REDIS_FORCE_PUBLISH = os.getenv('REDIS_FORCE_PUBLISH', 'false').lower() == 'true'
 
-    DB_PASSWORD = get_secret(DB_SECRET_ID, PROJECT_ID) if DB_SECRET_ID and PROJECT_ID else os.getenv('DB_PASSWORD')
+    # DB_PASSWORD and SQLALCHEMY_DATABASE_URI are resolved lazily by _LazyConfig
     STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')  # Use environment variable directly
-    SQLALCHEMY_DATABASE_URI = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_WRITE_CHUNK_SIZE = int(os.getenv('DB_WRITE_CHUNK_SIZE', 1000))
+    DB_READ_CHUNK_SIZE = int(os.getenv('DB_READ_CHUNK_SIZE', 10000))
+
+    STRIPE_MAX_WORKERS = int(os.getenv('STRIPE_MAX_WORKERS', 8))
+    STRIPE_REQUESTS_PER_SECOND = float(os.getenv('STRIPE_REQUESTS_PER_SECOND', 25))
+    STRIPE_MAX_RETRIES = int(os.getenv('STRIPE_MAX_RETRIES', 5))
+
+    # Local SQLite cache of Stripe charges, e.g. on a mounted volume. Unset disables the cache.
+    # Cached charges keep their expanded customer, so the file holds customer emails: keep it on a private
+    # volume and treat it as personal data. Subscription statuses are mutable and never cached
+    STRIPE_CACHE_PATH = os.getenv('STRIPE_CACHE_PATH')
+    STRIPE_CACHE_MAX_ENTRIES = int(os.getenv('STRIPE_CACHE_MAX_ENTRIES', 500000))
+    # Seconds a cached object stays valid. Matured charges are final and never expire
+    STRIPE_CACHE_TTL_CHARGE = float(os.getenv('STRIPE_CACHE_TTL_CHARGE', 3600))
+    STRIPE_CACHE_TTL_CHARGE_LIST = float(os.getenv('STRIPE_CACHE_TTL_CHARGE_LIST', 7 * 86400))
+
+    # 'per_customer' checks each referred customer, 'global_scan' pages through all active subscriptions once
+    ACTIVE_STATUS_MODE = os.getenv('ACTIVE_STATUS_MODE', 'per_customer')
+
+    # Ignore the persisted charge watermarks and re-download the full charge history
+    FULL_RESYNC = os.getenv('FULL_RESYNC', 'false').lower() == 'true'
+    # Charges refreshed per batch while re-verifying the not-yet-matured window
+    REVERIFY_BATCH_SIZE = int(os.getenv('REVERIFY_BATCH_SIZE', 500))
+    # 'per_customer' lists charges per referred customer, 'global_scan' pages through all charges once.
+    # 'global_scan' cannot be sharded: every shard would page through the whole account, so a sharded
+    # run rejects it (see resources.sharding.parse_shard_args)
+    CHARGE_SYNC_MODE = os.getenv('CHARGE_SYNC_MODE', 'per_customer')
+    # Charges buffered before commission computation and the bulk write
+    CHARGE_SYNC_CHUNK_SIZE = int(os.getenv('CHARGE_SYNC_CHUNK_SIZE', 5000))
+    # Hours a stage checkpoint can be resumed from. Older checkpoints are discarded and the stage starts over
+    CHECKPOINT_MAX_AGE_HOURS = float(os.getenv('CHECKPOINT_MAX_AGE_HOURS', 12))
+    # Commission rate for referees without a referrals row. Defaults to 0.0: their charges are stored
+    # with a zero commission_amount instead of an empty one
+    DEFAULT_COMMISSION_RATE = float(os.getenv('DEFAULT_COMMISSION_RATE', 0.0))
+
+    # 'sync' runs the stages on threads, 'async' runs them on one event loop with async clients
+    EXECUTION_MODE = os.getenv('EXECUTION_MODE', 'sync')
+    # Maximum in-flight requests per backend in async mode
+    ASYNC_STRIPE_CONCURRENCY = int(os.getenv('ASYNC_STRIPE_CONCURRENCY', 32))
+    ASYNC_DB_CONCURRENCY = int(os.getenv('ASYNC_DB_CONCURRENCY', 5))
+    ASYNC_REDIS_CONCURRENCY = int(os.getenv('ASYNC_REDIS_CONCURRENCY', 10))
+
+    # 'batch' runs the stages once, 'webhook' serves the Stripe webhook endpoint and applies events continuously
+    RUN_MODE = os.getenv('RUN_MODE', 'batch')
+    STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+    WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('PORT', 8080))
+    # Durable local queue of received events, kept on a mounted volume
+    WEBHOOK_QUEUE_PATH = os.getenv('WEBHOOK_QUEUE_PATH', 'webhook_events.sqlite')
+    # Events applied per micro-batch, and seconds between micro-batches
+    WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 200))
+    WEBHOOK_BATCH_INTERVAL = float(os.getenv('WEBHOOK_BATCH_INTERVAL', 2.0))
+    WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+    # Days applied event ids are kept for de-duplication, longer than Stripe's 3-day retry window
+    WEBHOOK_RETENTION_DAYS = float(os.getenv('WEBHOOK_RETENTION_DAYS', 7))
+
+    # Per-run instrumentation: stage timings, Stripe, SQL and Redis counters, logged as one record per run
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    # Optional Prometheus text file, e.g. in a node_exporter textfile collector directory
+    METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE')
\ No newline at end of file
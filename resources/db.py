@@ -1,56 +1,123 @@
 # stripe_db_tool/db.py
+import io
+import threading
+import time
 import uuid
+from datetime import datetime
 
-from sqlalchemy import create_engine, select
+from sqlalchemy import (create_engine, select, or_, func, literal_column, values, column, cast,
+                        String, Boolean, Float, DateTime)
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import sessionmaker, scoped_session
+from resources import metrics
 from resources.config import Config
+from resources.fingerprints import FINGERPRINT_COLUMNS, FingerprintIndex, row_fingerprint
+from resources.schema import USER_DTYPES, COMMISSION_RATE_DTYPES, typed_frame
 import pandas as pd
-from resources.models import Users, Referrals, CommissionTransactions
+from resources.models import Users, Referrals, CommissionTransactions, ChargeSyncState, ShardRun, RunState
+
+# The engine is created on first use, so importing this module never resolves the DB secret
+_engine = None
+_engine_lock = threading.Lock()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
+            metrics.instrument_engine(_engine)
+            SessionLocal.configure(bind=_engine)
+    return _engine
 
-engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def get_db_session():
+    get_engine()
     return scoped_session(SessionLocal)
 
 
-def fetch_users(session):
+def new_db_session():
+    """
+    Open a dedicated session, e.g. for a stage running on its own thread. The caller closes it.
+    """
+    get_engine()
+    return SessionLocal()
+
+
+def _copy_frame(connection, stmt, dtypes):
+    """
+    Stream the rows of a select with COPY (...) TO STDOUT as CSV and parse them with pandas' C reader.
+    UUIDs arrive in their text form and no Python object is built per row.
+    """
+    compiled = stmt.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    buffer = io.StringIO()
+    started = time.perf_counter()
+    cursor = connection.connection.cursor()
+    try:
+        # mogrify renders the bound parameters (e.g. a customer_ids filter) in the client encoding
+        query = cursor.mogrify(str(compiled), compiled.params)
+        cursor.copy_expert(b"COPY (" + query + b") TO STDOUT WITH (FORMAT csv, HEADER true, NULL '\\N')", buffer)
+    finally:
+        cursor.close()
+    # COPY bypasses the engine events, record it like any other statement
+    metrics.inc('sql_statements', verb='COPY')
+    metrics.observe('sql_statement_seconds', time.perf_counter() - started, verb='COPY')
+
+    buffer.seek(0)
+    df = pd.read_csv(buffer, header=0, names=list(dtypes), dtype=dtypes, keep_default_na=False, na_values=['\\N'])
+    for name, dtype in dtypes.items():
+        # Missing strings are None, as with the row-based fetch
+        if dtype is object and df[name].isna().any():
+            df[name] = df[name].astype(object).where(df[name].notna(), None)
+    return df
+
+
+def _fetch_frame(session, stmt, dtypes):
+    """
+    Run a select whose columns match dtypes (in order) into a typed DataFrame, UUIDs as strings.
+
+    On psycopg2 the rows come through a COPY TO stream (see _copy_frame). Other drivers, e.g. asyncpg
+    behind AsyncSession.run_sync, build the frame column by column from the result rows.
+    """
+    connection = session.connection()
+    if connection.dialect.driver == 'psycopg2':
+        return _copy_frame(connection, stmt, dtypes)
+
+    rows = session.execute(stmt).all()
+    columns = list(zip(*rows)) if rows else [()] * len(dtypes)
+    data = {}
+    for (name, selected), column_values in zip(zip(dtypes, stmt.selected_columns), columns):
+        if isinstance(selected.type, UUID):
+            column_values = [str(value) if value is not None else None for value in column_values]
+        data[name] = column_values
+    return typed_frame(data, dtypes)
+
+
+def fetch_users(session, customer_ids=None):
     """
     Fetch users from the database with specific columns where referee is not None.
 
     Parameters:
     session (sqlalchemy.orm.session.Session): SQLAlchemy session for database queries.
+    customer_ids (iterable, optional): Only fetch the users with these Stripe customer ids.
 
     Returns:
-    pd.DataFrame: DataFrame containing user_id, stripe_customer_id, and referee for users with a non-null referee.
+    pd.DataFrame: DataFrame containing user_id, stripe_customer_id, and referee for users with a non-null referee,
+                  typed with resources.schema.USER_DTYPES. UUIDs are strings.
 
     Raises:
     Exception: If an error occurs during query execution or DataFrame creation.
     """
     try:
         # Query users with non-null referee, selecting specific columns
-        users_query = session.query(Users.user_id, Users.stripe_customer_id, Users.referee).filter(
-            Users.referee != None)
-
-        # Convert query results to list of dictionaries
-        users_data = [
-            {
-                'user_id': str(user.user_id), # Convert UUID to string
-                'stripe_customer_id': user.stripe_customer_id,
-                'referee': str(user.referee) # Convert UUID to string, handle None explicitly
-            }
-            for user in users_query.all()
-        ]
-
-        # Create DataFrame
-        users_df = pd.DataFrame(users_data)
-
-        # Handle empty result
-        if users_data:
-            return users_df
-        else:
-            # Return empty DataFrame with correct columns
-            return pd.DataFrame(columns=['user_id', 'stripe_customer_id', 'referee'])
+        users_query = select(Users.user_id, Users.stripe_customer_id, Users.referee).where(Users.referee.isnot(None))
+        if customer_ids is not None:
+            users_query = users_query.where(Users.stripe_customer_id.in_(list(customer_ids)))
+
+        # Fetched straight into the typed columns, an empty result keeps the columns
+        return _fetch_frame(session, users_query, USER_DTYPES)
 
     except Exception as e:
         raise ValueError(f"Error fetching users: {str(e)}")
@@ -64,113 +131,142 @@ def fetch_commission_rates(session):
     session (sqlalchemy.orm.session.Session): SQLAlchemy session for database queries.
 
     Returns:
-    pd.DataFrame: DataFrame containing user_id and commission for all records in the referrals table.
+    pd.DataFrame: DataFrame containing user_id and commission for all records in the referrals table,
+                  typed with resources.schema.COMMISSION_RATE_DTYPES.
 
     Raises:
     Exception: If an error occurs during query execution or DataFrame creation.
     """
     try:
         # Query referrals table, selecting user_id and commission columns
-        referrals_query = session.query(Referrals.user_id, Referrals.commission)
-
-        # Convert query results to list of dictionaries
-        referrals_data = [
-            {
-                'user_id': str(referral.user_id),  # Convert UUID to string
-                'commission': referral.commission
-            }
-            for referral in referrals_query.all()
-        ]
-
-        # Create DataFrame
-        referrals_df = pd.DataFrame(referrals_data)
-
-        # Handle empty result
-        if referrals_data:
-            return referrals_df
-        else:
-            # Return empty DataFrame with correct columns
-            return pd.DataFrame(columns=['user_id', 'commission'])
+        referrals_query = select(Referrals.user_id, Referrals.commission)
+
+        # Fetched straight into the typed columns, an empty result keeps the columns
+        return _fetch_frame(session, referrals_query, COMMISSION_RATE_DTYPES)
 
     except Exception as e:
         raise ValueError(f"Error fetching commission rates: {str(e)}")
 
 
-def write_df_to_CommissionTransactions(session, df):
+def _to_db_value(column, value):
+    """
+    Convert a single DataFrame cell into a value the database driver accepts.
+
+    Parameters:
+    column (str): Name of the column the value belongs to.
+    value: Raw cell value taken from the DataFrame.
+
+    Returns:
+    The converted value (UUID for id columns, datetime for timestamps, None for missing values).
+    """
+    if isinstance(value, str) and column in {'user_id', 'referee'}:
+        try:
+            return uuid.UUID(value)
+        except (ValueError, TypeError):
+            return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if pd.isna(value):
+        return None
+    return value
+
+
+def write_df_to_CommissionTransactions(session, df, chunk_size=None, fingerprints=None):
     """
     Write a pandas DataFrame to the commission_transactions table, handling PK conflicts
     by updating only differing columns. Columns not in the DataFrame are not modified.
 
+    Rows are sent in chunks as multi-row INSERT ... ON CONFLICT (charge_id) DO UPDATE statements,
+    so each chunk costs a single round trip. The conflict update only fires when the row changed,
+    which keeps unchanged rows out of the update count and the WAL.
+
+    A frame holding every FINGERPRINT_COLUMNS column stores each row's fingerprint, and the conflict
+    update compares fingerprints instead of every column. With a FingerprintIndex of the stored rows,
+    unchanged rows are not even sent. A frame with fewer columns resets the fingerprint of the rows
+    it changes, as it no longer describes them.
+
     Parameters:
     session (sqlalchemy.orm.session.Session): SQLAlchemy session for database operations.
     df (pd.DataFrame): DataFrame with data to write, containing a subset of table columns.
+    chunk_size (int, optional): Rows per statement. Defaults to Config.DB_WRITE_CHUNK_SIZE.
+    fingerprints (FingerprintIndex, optional): Stored fingerprints, to skip unchanged rows up front.
+                                              Updated with the rows written.
 
     Returns:
-    dict: Summary of operations (e.g., {'inserted': n, 'updated': m, 'errors': k}).
+    dict: Summary of operations (e.g., {'inserted': n, 'updated': m, 'unchanged': u, 'errors': k}).
+          'unchanged' counts the rows skipped up front.
 
     Raises:
     ValueError: If the DataFrame is missing 'charge_id' or contains invalid columns.
     """
 
     # Get table columns from the model
-    table_columns = {c.name for c in CommissionTransactions.__table__.columns}
-    df_columns = set(df.columns)
-    invalid_columns = df_columns - table_columns
+    table = CommissionTransactions.__table__
+    table_columns = {c.name for c in table.columns}
+    df_columns = list(df.columns)
+    invalid_columns = set(df_columns) - table_columns
     if invalid_columns:
         raise ValueError(f"DataFrame contains invalid columns: {invalid_columns}")
+    if 'charge_id' not in df_columns:
+        raise ValueError("DataFrame is missing required column: 'charge_id'")
+
+    chunk_size = chunk_size or Config.DB_WRITE_CHUNK_SIZE
 
     # Track operations
-    result = {'inserted': 0, 'updated': 0, 'errors': 0}
+    result = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
+
+    # A multi-row upsert cannot touch the same key twice, keep the last occurrence like the row loop did
+    df = df.drop_duplicates(subset=['charge_id'], keep='last')
+    fingerprinted = set(FINGERPRINT_COLUMNS) <= set(df_columns)
+    if fingerprinted:
+        df = df.assign(row_fingerprint=[
+            row_fingerprint(values) for values in df[list(FINGERPRINT_COLUMNS)].itertuples(index=False, name=None)
+        ])
+        if fingerprints is not None and len(df):
+            changed = fingerprints.changed(df['charge_id'].tolist(), df['row_fingerprint'])
+            result['unchanged'] = int(len(df) - changed.sum())
+            df = df[changed]
+        df_columns = list(df.columns)
+    update_columns = [col for col in df_columns if col not in ('charge_id', 'row_fingerprint')]
 
     try:
-        for _, row in df.iterrows():
-            # Convert row to dictionary and handle UUID and datetime types
-            row_dict = row.to_dict()
-            for key, value in row_dict.items():
-                if isinstance(value, str) and key in {'user_id', 'referee'}:
-                    try:
-                        row_dict[key] = uuid.UUID(value)
-                    except (ValueError, TypeError):
-                        row_dict[key] = None
-                elif isinstance(value, pd.Timestamp):
-                    row_dict[key] = value.to_pydatetime()
-                elif pd.isna(value):
-                    row_dict[key] = None
-
-            # Check if record exists using ORM mapping
-            existing = session.execute(
-                select(CommissionTransactions).where(CommissionTransactions.charge_id == row_dict['charge_id'])
-            ).scalar_one_or_none()  # This needs adjustment to return the full object
-
-            # Corrected: Use .one_or_none() to get the full model instance
-            existing_query = select(CommissionTransactions).where(CommissionTransactions.charge_id == row_dict['charge_id'])
-            existing = session.execute(existing_query).one_or_none()
-
-            if existing:
-                # Compare existing record with DataFrame row
-                updates = {
-                    col: row_dict[col]
-                    for col in df_columns
-                    if col != 'charge_id' and getattr(existing[0], col) != row_dict.get(col)  # Access the model instance
-                }
-                if updates:
-                    session.execute(
-                        CommissionTransactions.__table__.update()
-                        .where(CommissionTransactions.charge_id == row_dict['charge_id'])
-                        .values(**updates)
-                    )
-                    result['updated'] += 1
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size]
+            records = [
+                {col: _to_db_value(col, value) for col, value in record.items()}
+                for record in chunk.to_dict('records')
+            ]
+
+            stmt = pg_insert(table).values(records)
+            if fingerprinted:
+                # Only rewrite rows whose fingerprint changed, rows without one get it on first write
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c.charge_id],
+                    set_={col: stmt.excluded[col] for col in update_columns + ['row_fingerprint']},
+                    where=table.c.row_fingerprint.is_distinct_from(stmt.excluded.row_fingerprint)
+                )
+            elif update_columns:
+                # Only rewrite rows where at least one DataFrame column actually changed
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c.charge_id],
+                    set_={**{col: stmt.excluded[col] for col in update_columns}, 'row_fingerprint': None},
+                    where=or_(*[table.c[col].is_distinct_from(stmt.excluded[col]) for col in update_columns])
+                )
             else:
-                # Insert new record with only DataFrame columns
-                insert_data = {
-                    col: row_dict.get(col)
-                    for col in df_columns
-                }
-                session.add(CommissionTransactions(**insert_data))
-                result['inserted'] += 1
+                stmt = stmt.on_conflict_do_nothing(index_elements=[table.c.charge_id])
+
+            # xmax is 0 for freshly inserted tuples and non-zero for tuples rewritten by the conflict update
+            stmt = stmt.returning(literal_column('(xmax = 0)').label('inserted'))
+            inserted_flags = session.execute(stmt).scalars().all()
+
+            inserted = sum(1 for flag in inserted_flags if flag)
+            result['inserted'] += inserted
+            result['updated'] += len(inserted_flags) - inserted
 
         # Commit the transaction
         session.commit()
+        if fingerprints is not None and fingerprinted:
+            fingerprints.update(df['charge_id'], df['row_fingerprint'])
 
     except Exception as e:
         session.rollback()
@@ -180,14 +276,19 @@ def write_df_to_CommissionTransactions(session, df):
     return result
 
 
-def update_isactive_in_users(session, df, logger):
+def update_isactive_in_users(session, df, logger, chunk_size=None):
     """
     Update the 'isactive' column in the users table based on the provided DataFrame.
 
+    The frame is sent as a VALUES list joined against users in a single UPDATE per chunk, which
+    only touches rows whose status actually differs. Users that are unchanged or do not exist
+    are both reported as skipped, and so are users with a missing status, whose isactive is left as it is.
+
     Parameters:
     session (sqlalchemy.orm.session.Session): SQLAlchemy session for database operations.
     df (pd.DataFrame): DataFrame with 'user_id' (str) and 'active' (bool) columns.
     logger (GcpLogger): Logger instance for logging operations.
+    chunk_size (int, optional): Rows per UPDATE statement. Defaults to Config.DB_WRITE_CHUNK_SIZE.
 
     Returns:
     dict: Summary of operations (e.g., {'updated': n, 'skipped': m, 'errors': k}).
@@ -199,48 +300,47 @@ def update_isactive_in_users(session, df, logger):
     if not required_columns.issubset(df.columns):
         raise ValueError(f"DataFrame is missing required columns: {required_columns - set(df.columns)}")
 
+    chunk_size = chunk_size or Config.DB_WRITE_CHUNK_SIZE
+
     # Track operations
     result = {'updated': 0, 'skipped': 0, 'errors': 0}
 
     logger.info("Starting update of 'isactive' in users table.")
 
+    # Validate user_ids up front, invalid rows never reach the database
+    valid_rows = []
+    for user_id_str, active_status in zip(df['user_id'], df['active']):
+        if pd.isna(active_status):
+            logger.warning(f"Missing active status for user_id {user_id_str}. Leaving isactive unchanged.")
+            result['skipped'] += 1
+            continue
+        try:
+            valid_rows.append((str(uuid.UUID(user_id_str)), bool(active_status)))
+        except (ValueError, TypeError, AttributeError):
+            logger.warning(f"Invalid user_id format: {user_id_str}. Skipping.")
+            result['errors'] += 1
+
+    users_table = Users.__table__
+
     try:
-        for _, row in df.iterrows():
-            try:
-                user_id_str = row['user_id']
-                active_status = row['active']
-
-                # Validate and convert user_id to UUID
-                try:
-                    user_id_uuid = uuid.UUID(user_id_str)
-                except (ValueError, TypeError):
-                    logger.warning(f"Invalid user_id format: {user_id_str}. Skipping.")
-                    result['errors'] += 1
-                    continue
-
-                # Check if the user exists
-                existing_query = select(Users).where(Users.user_id == user_id_uuid)
-                existing = session.execute(existing_query).scalar_one_or_none()
-
-                if existing:
-                    # Update only if the status differs
-                    if existing.isactive != active_status:
-                        session.execute(
-                            Users.__table__.update()
-                            .where(Users.user_id == user_id_uuid)
-                            .values(isactive=active_status)
-                        )
-                        result['updated'] += 1
-                        logger.debug(f"Updated isactive to {active_status} for user_id: {user_id_str}.")
-                    else:
-                        result['skipped'] += 1
-                        logger.debug(f"No change needed for user_id: {user_id_str}.")
-                else:
-                    logger.warning(f"User not found for user_id: {user_id_str}. Skipping.")
-                    result['skipped'] += 1
-            except Exception as e:
-                logger.error(f"Error processing row for user_id {user_id_str}: {str(e)}")
-                result['errors'] += 1
+        for start in range(0, len(valid_rows), chunk_size):
+            chunk = valid_rows[start:start + chunk_size]
+            new_status = values(
+                column('user_id', String), column('active', Boolean), name='v'
+            ).data(chunk)
+
+            stmt = (
+                users_table.update()
+                .where(users_table.c.user_id == cast(new_status.c.user_id, UUID(as_uuid=True)))
+                .where(users_table.c.isactive.is_distinct_from(new_status.c.active))
+                .values(isactive=new_status.c.active)
+                .returning(users_table.c.user_id)
+            )
+            updated_ids = session.execute(stmt).scalars().all()
+
+            result['updated'] += len(updated_ids)
+            result['skipped'] += len(chunk) - len(updated_ids)
+            logger.debug("Updated isactive for %s of %s users in batch.", len(updated_ids), len(chunk))
 
         # Commit the transaction
         session.commit()
@@ -253,30 +353,395 @@ def update_isactive_in_users(session, df, logger):
     return result
 
 
-def read_CommissionTransactions_to_df(session, logger):
+def fetch_commission_fingerprints(session, chunk_size=None):
     """
-    Read all data from the commission_transactions table into a pandas DataFrame.
+    Load every stored (charge_id, row_fingerprint) pair into a compact FingerprintIndex,
+    streamed Config.DB_READ_CHUNK_SIZE rows at a time.
+
+    Parameters:
+    session (sqlalchemy.orm.session.Session): SQLAlchemy session for database queries.
+
+    Returns:
+    FingerprintIndex: Index of the rows with a known fingerprint.
+
+    Raises:
+    ValueError: If an error occurs during query execution.
+    """
+    query = (
+        select(CommissionTransactions.charge_id, CommissionTransactions.row_fingerprint)
+        .where(CommissionTransactions.row_fingerprint.isnot(None))
+        .execution_options(yield_per=chunk_size or Config.DB_READ_CHUNK_SIZE)
+    )
+    try:
+        return FingerprintIndex.from_rows(session.execute(query))
+    except Exception as e:
+        raise ValueError(f"Error fetching row fingerprints: {str(e)}")
+
+
+def _commission_column_dtype(column):
+    """
+    Pandas dtype used for a commission_transactions column in streamed chunks.
+    """
+    if isinstance(column.type, Float):
+        return 'float64'
+    if isinstance(column.type, Boolean):
+        return 'boolean'
+    if isinstance(column.type, DateTime):
+        return 'datetime64[ns]'
+    return object
+
+
+def iter_CommissionTransactions(session, columns=None, referee=None, commission_paid=None,
+                                matures_after=None, matures_before=None, chunk_size=None):
+    """
+    Stream rows of the commission_transactions table as typed DataFrame chunks.
+
+    Rows are pulled through a server-side cursor, so memory is bounded by chunk_size regardless of
+    the table size. The cursor lives in the session's transaction; do not commit on the same
+    session until the iterator is exhausted.
+
+    Parameters:
+    session (sqlalchemy.orm.session.Session): SQLAlchemy session for database operations.
+    columns (list, optional): Columns to project. Defaults to every column.
+    referee (str or list, optional): Only rows of this referee (or these referees).
+    commission_paid (bool, optional): Only rows with this commission_paid flag.
+    matures_after (datetime, optional): Only rows with matures_on strictly after this time.
+    matures_before (datetime, optional): Only rows with matures_on strictly before this time.
+    chunk_size (int, optional): Rows per chunk. Defaults to Config.DB_READ_CHUNK_SIZE.
+
+    Yields:
+    pd.DataFrame: Chunks with float64, nullable boolean, datetime64 and str (UUID) columns.
+
+    Raises:
+    ValueError: If an unknown column is requested.
+    """
+    table = CommissionTransactions.__table__
+    columns = list(columns) if columns else [c.name for c in table.columns]
+    invalid_columns = set(columns) - {c.name for c in table.columns}
+    if invalid_columns:
+        raise ValueError(f"Invalid columns requested: {invalid_columns}")
+
+    stmt = select(*[table.c[name] for name in columns])
+    if referee is not None:
+        referees = [referee] if isinstance(referee, str) else list(referee)
+        stmt = stmt.where(table.c.referee.in_([_to_db_value('referee', value) for value in referees]))
+    if commission_paid is not None:
+        stmt = stmt.where(table.c.commission_paid.is_(bool(commission_paid)))
+    if matures_after is not None:
+        stmt = stmt.where(table.c.matures_on > matures_after)
+    if matures_before is not None:
+        stmt = stmt.where(table.c.matures_on < matures_before)
+
+    chunk_size = chunk_size or Config.DB_READ_CHUNK_SIZE
+    dtypes = {name: _commission_column_dtype(table.c[name]) for name in columns}
+    uuid_columns = [name for name in columns if isinstance(table.c[name].type, UUID)]
+
+    result = session.execute(stmt.execution_options(stream_results=True, yield_per=chunk_size))
+    for rows in result.partitions():
+        chunk = pd.DataFrame.from_records(rows, columns=columns)
+        for name in uuid_columns:
+            chunk[name] = chunk[name].map(lambda value: str(value) if value is not None else None)
+        yield chunk.astype(dtypes)
+
+
+def read_CommissionTransactions_to_df(session, logger, **filters):
+    """
+    Read data from the commission_transactions table into a pandas DataFrame.
+
+    This is not streaming: the chunks of iter_CommissionTransactions are all collected and concatenated,
+    so the whole result is held in memory, briefly twice while the chunks are concatenated. Narrow it
+    with the column projection and filters, and use iter_CommissionTransactions directly to process a
+    result that does not fit in memory.
 
     Parameters:
     session (sqlalchemy.orm.session.Session): SQLAlchemy session for database operations.
     logger: Logger object for logging information and errors.
+    **filters: Column projection and filters accepted by iter_CommissionTransactions.
 
     Returns:
-    pd.DataFrame: DataFrame containing all data from the table with column names matching the table schema.
+    pd.DataFrame: DataFrame containing the matching data with column names matching the table schema.
 
     Raises:
     ValueError: If there is an error reading from the database.
     """
     try:
-        # Construct the SELECT statement using the ORM model
-        stmt = select(CommissionTransactions)
-
-        # Execute the query and load results into a DataFrame
-        df = pd.read_sql(stmt, session.connection())
+        chunks = list(iter_CommissionTransactions(session, **filters))
+        if chunks:
+            df = pd.concat(chunks, ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=filters.get('columns') or [c.name for c in CommissionTransactions.__table__.columns])
 
         logger.info(f"Successfully read {len(df)} rows from commission_transactions table.")
 
         return df
     except Exception as e:
         logger.error(f"Error reading from database: {str(e)}")
-        raise ValueError(f"Error reading from database: {str(e)}")
\ No newline at end of file
+        raise ValueError(f"Error reading from database: {str(e)}")
+
+
+def fetch_sync_state(session):
+    """
+    Fetch the charge sync high-water marks.
+
+    Parameters:
+    session (sqlalchemy.orm.session.Session): SQLAlchemy session for database queries.
+
+    Returns:
+    dict: Mapping of sync_key (Stripe customer id or global key) to the last synced 'created' datetime.
+
+    Raises:
+    ValueError: If an error occurs during query execution.
+    """
+    try:
+        rows = session.execute(select(ChargeSyncState.sync_key, ChargeSyncState.last_created)).all()
+        return {row.sync_key: row.last_created for row in rows if row.last_created is not None}
+    except Exception as e:
+        raise ValueError(f"Error fetching sync state: {str(e)}")
+
+
+def update_sync_state(session, watermarks):
+    """
+    Advance the charge sync high-water marks. A watermark never moves backwards.
+
+    Parameters:
+    session (sqlalchemy.orm.session.Session): SQLAlchemy session for database operations.
+    watermarks (dict): Mapping of sync_key to a (last_created, last_charge_id) tuple.
+
+    Returns:
+    int: Number of sync keys written.
+
+    Raises:
+    ValueError: If the upsert fails.
+    """
+    if not watermarks:
+        return 0
+
+    table = ChargeSyncState.__table__
+    now = datetime.utcnow()
+    records = [
+        {
+            'sync_key': sync_key,
+            'last_created': _to_db_value('last_created', last_created),
+            'last_charge_id': last_charge_id,
+            'updated_at': now
+        }
+        for sync_key, (last_created, last_charge_id) in watermarks.items()
+    ]
+
+    try:
+        for start in range(0, len(records), Config.DB_WRITE_CHUNK_SIZE):
+            stmt = pg_insert(table).values(records[start:start + Config.DB_WRITE_CHUNK_SIZE])
+            advanced = or_(table.c.last_created.is_(None), stmt.excluded.last_created >= table.c.last_created)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.sync_key],
+                set_={
+                    'last_created': stmt.excluded.last_created,
+                    'last_charge_id': stmt.excluded.last_charge_id,
+                    'updated_at': stmt.excluded.updated_at
+                },
+                where=advanced
+            )
+            session.execute(stmt)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise ValueError(f"Error updating sync state: {str(e)}")
+
+    return len(records)
+
+
+def fetch_charges_to_reverify(session, now=None):
+    """
+    Fetch the charges that can still change in ways that matter to commission.
+
+    A charge stays in the re-verification set while it has not matured yet (matures_on in the
+    future), while it is disputed, or while its status is still pending. Matured, settled
+    charges are frozen and never re-fetched.
+
+    Parameters:
+    session (sqlalchemy.orm.session.Session): SQLAlchemy session for database queries.
+    now (datetime, optional): Reference time in UTC. Defaults to the current time.
+
+    Returns:
+    pd.DataFrame: DataFrame containing charge_id, user_id, referee, customer_id and email.
+
+    Raises:
+    ValueError: If an error occurs during query execution.
+    """
+    now = now or datetime.utcnow()
+    columns = ['charge_id', 'user_id', 'referee', 'customer_id', 'email']
+    try:
+        rows = session.execute(
+            select(CommissionTransactions.charge_id, CommissionTransactions.user_id, CommissionTransactions.referee,
+                   CommissionTransactions.customer_id, CommissionTransactions.email)
+            .where(or_(
+                CommissionTransactions.matures_on > now,
+                CommissionTransactions.matures_on.is_(None),
+                CommissionTransactions.disputed.is_(True),
+                CommissionTransactions.status == 'pending'
+            ))
+        ).all()
+
+        return pd.DataFrame(
+            [
+                (row.charge_id, str(row.user_id) if row.user_id else None,
+                 str(row.referee) if row.referee else None, row.customer_id, row.email)
+                for row in rows
+            ],
+            columns=columns
+        )
+    except Exception as e:
+        raise ValueError(f"Error fetching charges to re-verify: {str(e)}")
+
+
+def fetch_commission_totals(session, referees=None):
+    """
+    Aggregate commission totals per referee inside Postgres.
+
+    Only referee, commission_amount and commission_paid are read, and only one row per referee
+    leaves the database.
+
+    Parameters:
+    session (sqlalchemy.orm.session.Session): SQLAlchemy session for database queries.
+    referees (iterable, optional): Only aggregate these referees (str UUIDs).
+
+    Returns:
+    pd.DataFrame: DataFrame containing referee (str), total_commissions and pending_commissions.
+
+    Raises:
+    ValueError: If an error occurs during query execution.
+    """
+    columns = ['referee', 'total_commissions', 'pending_commissions']
+    commission_amount = func.sum(CommissionTransactions.commission_amount)
+    try:
+        query = (
+            select(
+                CommissionTransactions.referee,
+                func.coalesce(commission_amount, 0.0),
+                func.coalesce(commission_amount.filter(CommissionTransactions.commission_paid.is_(False)), 0.0)
+            )
+            .where(CommissionTransactions.referee.isnot(None))
+            .group_by(CommissionTransactions.referee)
+        )
+        if referees is not None:
+            query = query.where(CommissionTransactions.referee.in_([uuid.UUID(referee) for referee in referees]))
+        rows = session.execute(query).all()
+
+        return pd.DataFrame(
+            [(str(referee), total, pending) for referee, total, pending in rows],
+            columns=columns
+        )
+    except Exception as e:
+        raise ValueError(f"Error aggregating commission totals: {str(e)}")
+
+
+def mark_shard_complete(session, run_id, shard):
+    """
+    Record that a shard of a run has committed all its rows.
+
+    Parameters:
+    session (sqlalchemy.orm.session.Session): SQLAlchemy session for database operations.
+    run_id (str): Identifier shared by every shard of the run.
+    shard (Shard): The shard that completed.
+
+    Raises:
+    ValueError: If the upsert fails.
+    """
+    table = ShardRun.__table__
+    stmt = pg_insert(table).values(run_id=run_id, shard_index=shard.index, shard_count=shard.count,
+                                   completed_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.run_id, table.c.shard_index],
+        set_={'shard_count': stmt.excluded.shard_count, 'completed_at': stmt.excluded.completed_at}
+    )
+    try:
+        session.execute(stmt)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise ValueError(f"Error recording shard completion: {str(e)}")
+
+
+def lock_shard_run(session, run_id):
+    """
+    Take a transaction-scoped Postgres advisory lock on the run, released when the session's
+    transaction commits or rolls back. Shards of the same run serialize on it.
+    """
+    session.execute(select(func.pg_advisory_xact_lock(func.hashtext(run_id))))
+
+
+def fetch_shard_run_status(session, run_id, shard_count):
+    """
+    Count the completed shards of a run and tell whether its reduce step already ran.
+
+    Returns:
+    tuple: (completed, reduced) where completed counts shards recorded with the same shard_count.
+    """
+    completed, reduced = session.execute(
+        select(
+            func.count().filter(ShardRun.shard_count == shard_count),
+            func.count(ShardRun.reduced_at)
+        ).where(ShardRun.run_id == run_id)
+    ).one()
+    return completed, reduced > 0
+
+
+def mark_shard_reduced(session, run_id, shard):
+    """
+    Record that the reduce step of a run ran on this shard, and commit.
+    """
+    table = ShardRun.__table__
+    session.execute(
+        table.update()
+        .where(table.c.run_id == run_id, table.c.shard_index == shard.index)
+        .values(reduced_at=datetime.utcnow())
+    )
+    session.commit()
+
+
+def fetch_run_state(session, stage_key):
+    """
+    Fetch the checkpoint of a stage.
+
+    Returns:
+    dict: The run_state columns, or None if the stage has no checkpoint.
+
+    Raises:
+    ValueError: If an error occurs during query execution.
+    """
+    try:
+        row = session.execute(select(RunState.__table__).where(RunState.stage_key == stage_key)).mappings().first()
+        return dict(row) if row else None
+    except Exception as e:
+        raise ValueError(f"Error fetching run state: {str(e)}")
+
+
+def save_run_state(session, stage_key, run_id, phase, last_key, batch, retry_keys, state=None):
+    """
+    Write the checkpoint of a stage, replacing the previous one, and commit.
+
+    Raises:
+    ValueError: If the upsert fails.
+    """
+    table = RunState.__table__
+    stmt = pg_insert(table).values(stage_key=stage_key, run_id=run_id, phase=phase, last_key=last_key, batch=batch,
+                                   retry_keys=list(retry_keys), state=state, updated_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.stage_key],
+        set_={col: stmt.excluded[col] for col in
+              ('run_id', 'phase', 'last_key', 'batch', 'retry_keys', 'state', 'updated_at')}
+    )
+    try:
+        session.execute(stmt)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise ValueError(f"Error saving run state: {str(e)}")
+
+
+def clear_run_state(session, stage_key):
+    """
+    Delete the checkpoint of a stage once it has completed, and commit.
+    """
+    session.execute(RunState.__table__.delete().where(RunState.stage_key == stage_key))
+    session.commit()
@@ -1,7 +1,12 @@
+import atexit
+import itertools
 import logging
 import os
+import queue
+import sys
+import threading
+import time
 from dotenv import load_dotenv
-from google.cloud import logging as gcp_logging
 from colorama import Fore, Style, init
 from singleton_decorator import singleton
 
@@ -12,29 +17,140 @@ INF_ENV = os.getenv("INF_ENV", "develop")  # Default to develop
 PROJECT_ID = os.getenv("PROJECT_ID")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
+# Background shipping of log entries to Cloud Logging
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", 10000))  # Max entries waiting to be shipped
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 500))  # Max entries per Cloud Logging request
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 2.0))  # Seconds before a partial batch is shipped
+LOG_OVERFLOW_POLICY = os.getenv("LOG_OVERFLOW_POLICY", "drop_newest")  # drop_newest, drop_oldest or block
+LOG_CLOSE_TIMEOUT = float(os.getenv("LOG_CLOSE_TIMEOUT", 10.0))  # Seconds allowed for the final flush at exit
+LOG_DEBUG_SAMPLE_EVERY = int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", 1))  # Keep 1 in N debug lines per call site
+LOG_INIT_TIMEOUT = float(os.getenv("LOG_INIT_TIMEOUT", 30.0))  # Seconds start-up waits for the Cloud Logging client
+
 # Validate environment
 if not INF_ENV:
     raise ValueError("Missing INF_ENV variable in .env file.")
 if not PROJECT_ID:
     raise ValueError("Missing PROJECT_ID variable in .env file.")
 
+_STOP = object()
+
 
 @singleton
 class LoggerSingleton:
+    """
+    Queues structured entries and ships them to Cloud Logging in batches from a background thread,
+    so callers never wait on a Cloud Logging request. The queue is flushed at interpreter exit.
+
+    The google-cloud-logging import and client creation also happen on that thread, started as soon
+    as the logger is created, so they overlap the rest of start-up. wait_ready() then fails the
+    start-up if the client could not be created.
+    """
+
     def __init__(self, process):
+        self._process = process
+        self._logger = None
+        self._init_error = None
+        self._ready = threading.Event()
+        self._queue = queue.Queue(maxsize=LOG_BUFFER_SIZE)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="gcp-log-shipper", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def log_struct(self, info, severity="INFO", **kw):
+        entry = (info, severity, kw)
+        if LOG_OVERFLOW_POLICY == "block":
+            self._queue.put(entry)
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+            if LOG_OVERFLOW_POLICY == "drop_oldest":
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self._queue.put_nowait(entry)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def wait_ready(self, timeout=LOG_INIT_TIMEOUT):
+        """
+        Block until the Cloud Logging client is created.
+
+        Raises:
+        RuntimeError: If the client could not be created, or not within `timeout` seconds.
+        """
+        if not self._ready.wait(timeout):
+            raise RuntimeError(f"GCP logger was not initialized within {timeout}s")
+        if self._init_error is not None:
+            raise RuntimeError(f"Failed to initialize GCP logger: {self._init_error}") from self._init_error
+
+    def flush(self):
+        """Block until every queued entry has been shipped."""
+        self._queue.join()
+
+    def close(self):
+        """Ship whatever is still queued and stop the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put(_STOP, timeout=LOG_CLOSE_TIMEOUT)
+        except queue.Full:
+            pass
+        self._worker.join(timeout=LOG_CLOSE_TIMEOUT)
+        if self._dropped:
+            print(f"GCP logger dropped {self._dropped} entries because the buffer was full")
+
+    def _run(self):
+        self._connect()
+        stopping = False
+        while not stopping:
+            entries = []
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            while len(entries) < LOG_BATCH_SIZE:
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                entries.append(entry)
+            if entries:
+                self._ship(entries)
+
+    def _connect(self):
         try:
+            from google.cloud import logging as gcp_logging
             client = gcp_logging.Client(project=PROJECT_ID)
-            self._logger = client.logger(process)
+            self._logger = client.logger(self._process)
         except Exception as e:
             print(f"Failed to initialize GCP logger: {e}")
-            raise
+            self._init_error = e
+        finally:
+            self._ready.set()
 
-    def log_struct(self, info, severity="INFO", **kw):
+    def _ship(self, entries):
         try:
-            self._logger.log_struct(info, severity=severity, **kw)
+            if self._logger is None:
+                # The client failed to initialize and wait_ready() reported it, the entries only go to the console
+                return
+            batch = self._logger.batch()
+            for info, severity, kw in entries:
+                batch.log_struct(info, severity=severity, **kw)
+            batch.commit()
         except Exception as e:
-            print(f"Error logging to GCP: {e}")
-            raise  # Raise to make failures visible
+            print(f"Error logging {len(entries)} entries to GCP: {e}")
+        finally:
+            for _ in entries:
+                self._queue.task_done()
+
 
 class GcpLogger:
     def __init__(self, process: str, env: str = 'develop'):
@@ -48,42 +164,70 @@ class GcpLogger:
             'DEBUG': Fore.GREEN,
             'ALERT': Fore.RED
         }
+        self._debug_sites = {}
 
     def print_to_console(self, severity, message):
         color = self._color_map.get(severity, Fore.RESET)
         print(f"{color}{severity}: {message}{Style.RESET_ALL}")
 
-    def debug(self, message: str, customer_id='system'):
-        if LOG_LEVEL == 'DEBUG':
-            self.write_log_entry("DEBUG", message, customer_id)
+    @property
+    def debug_enabled(self) -> bool:
+        return LOG_LEVEL == 'DEBUG'
+
+    def _sampled(self, sample_every: int) -> bool:
+        # Count calls per call site (file, line) and keep the 1st, (N+1)th, (2N+1)th, ...
+        if sample_every <= 1:
+            return True
+        frame = sys._getframe(2)
+        counter = self._debug_sites.setdefault((frame.f_code.co_filename, frame.f_lineno), itertools.count())
+        return next(counter) % sample_every == 0
+
+    def debug(self, message: str, *args, customer_id='system', sample_every: int = None):
+        # Formatting with %-style args only happens once the line is known to be emitted
+        if not self.debug_enabled:
+            return
+        if not self._sampled(LOG_DEBUG_SAMPLE_EVERY if sample_every is None else sample_every):
+            return
+        self.write_log_entry("DEBUG", message % args if args else message, customer_id)
+
+    def info(self, message: str, *args, customer_id='system'):
+        self.write_log_entry("INFO", message % args if args else message, customer_id)
+
+    def warning(self, message: str, *args, customer_id='system'):
+        self.write_log_entry("WARNING", message % args if args else message, customer_id)
+
+    def error(self, message: str, *args, customer_id='system'):
+        self.write_log_entry("ERROR", message % args if args else message, customer_id)
 
-    def info(self, message: str, customer_id='system'):
-        self.write_log_entry("INFO", message, customer_id)
+    def critical(self, message: str, *args, customer_id='system'):
+        self.write_log_entry("CRITICAL", message % args if args else message, customer_id)
 
-    def warning(self, message: str, customer_id='system'):
-        self.write_log_entry("WARNING", message, customer_id)
+    def exception(self, message: str, *args, customer_id='system'):
+        self.write_log_entry("ERROR", message % args if args else message, customer_id)
 
-    def error(self, message: str, customer_id='system'):
-        self.write_log_entry("ERROR", message, customer_id)
+    def record(self, message: str, severity: str = 'INFO', **fields):
+        # One entry whose fields stay queryable in Cloud Logging, e.g. the per-run metrics summary
+        self.write_log_entry(severity, message, 'system', **fields)
 
-    def critical(self, message: str, customer_id='system'):
-        self.write_log_entry("CRITICAL", message, customer_id)
+    def wait_ready(self):
+        self._logger.wait_ready()
 
-    def exception(self, message: str, customer_id='system'):
-        self.write_log_entry("ERROR", message, customer_id)
+    def flush(self):
+        self._logger.flush()
 
-    def write_log_entry(self, severity: str, message: str, customer_id: str):
+    def write_log_entry(self, severity: str, message: str, customer_id: str, **fields):
         log_entry = {
             "process": self.process,
             "message": message,
             "environment": self.environment,
-            "customer": customer_id
+            "customer": customer_id,
+            **fields
         }
-        # Always log to GCP
+        # Always log to GCP, shipped in the background
         self._logger.log_struct(log_entry, severity=severity)
         # Print to console only if not in production
         if self.environment not in ['production']:
-            self.print_to_console(severity, message)
+            self.print_to_console(severity, f"{message}: {fields}" if fields else message)
 
 def get_logger(name: str) -> 'GcpLogger':
-    return GcpLogger(process=name, env=INF_ENV)
\ No newline at end of file
+    return GcpLogger(process=name, env=INF_ENV)
@@ -0,0 +1,211 @@
+# stripe_db_tool/metrics.py
+import bisect
+import os
+import threading
+import time
+
+from resources.config import Config
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+PROMETHEUS_PREFIX = 'subscription_transactions_'
+
+# Read once: every recording function returns straight away when metrics are disabled
+_enabled = Config.METRICS_ENABLED
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+
+def enabled():
+    return _enabled
+
+
+def configure(enable):
+    """
+    Turn recording on or off for the rest of the process, e.g. from a benchmark.
+    Engines created while metrics were disabled stay uninstrumented.
+    """
+    global _enabled
+    _enabled = bool(enable)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Add value to a counter, e.g. inc('redis_commands', 3, command='set').
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    """
+    Set a gauge to its latest value, e.g. a stage's wall time.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration in the histogram name, bucketed by BUCKETS.
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # [per-bucket counts, count, sum, max]
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0, 0.0, 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += 1
+        histogram[2] += seconds
+        histogram[3] = max(histogram[3], seconds)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    words = statement.split(None, 1)
+    verb = words[0].upper() if words else 'EMPTY'
+    inc('sql_statements', verb=verb)
+    if started is not None:
+        observe('sql_statement_seconds', time.perf_counter() - started, verb=verb)
+
+
+def instrument_engine(engine):
+    """
+    Count and time every SQL statement sent through engine, by leading keyword (SELECT, UPDATE...).
+    An async engine is instrumented through its sync_engine. No listener is installed when disabled.
+    """
+    if not _enabled:
+        return
+    from sqlalchemy import event
+
+    engine = getattr(engine, 'sync_engine', engine)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _label_text(labels):
+    return ','.join(f"{name}={value}" for name, value in labels) or 'all'
+
+
+def _quantile(buckets, count, q):
+    """
+    Upper bound of the bucket holding the q-quantile, the same estimate Prometheus makes at bucket edges.
+    """
+    rank = q * count
+    seen = 0
+    for bound, bucket_count in zip(BUCKETS, buckets):
+        seen += bucket_count
+        if seen >= rank:
+            return bound
+    return BUCKETS[-1]
+
+
+def summary():
+    """
+    Snapshot of everything recorded so far, shaped for one structured log record.
+
+    Returns:
+    dict: {'counters': {name: {labels: value}}, 'gauges': {...}, 'histograms': {name: {labels:
+          {'count', 'sum_seconds', 'max_seconds', 'p50_seconds', 'p95_seconds'}}}}.
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: (list(value[0]), *value[1:]) for key, value in _histograms.items()}
+
+    report = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for section, values in (('counters', counters), ('gauges', gauges)):
+        for (name, labels), value in sorted(values.items()):
+            report[section].setdefault(name, {})[_label_text(labels)] = value
+    for (name, labels), (buckets, count, total, longest) in sorted(histograms.items()):
+        report['histograms'].setdefault(name, {})[_label_text(labels)] = {
+            'count': count,
+            'sum_seconds': round(total, 4),
+            'max_seconds': round(longest, 4),
+            'p50_seconds': _quantile(buckets, count, 0.5),
+            'p95_seconds': _quantile(buckets, count, 0.95),
+        }
+    return report
+
+
+def _prometheus_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def prometheus_text():
+    """
+    Render the metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, (list(value[0]), *value[1:])) for key, value in _histograms.items())
+
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        metric = f"{PROMETHEUS_PREFIX}{name}_total"
+        declare(metric, 'counter')
+        lines.append(f"{metric}{_prometheus_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        metric = f"{PROMETHEUS_PREFIX}{name}"
+        declare(metric, 'gauge')
+        lines.append(f"{metric}{_prometheus_labels(labels)} {float(value)}")
+    for (name, labels), (buckets, count, total, _) in histograms:
+        metric = f"{PROMETHEUS_PREFIX}{name}"
+        declare(metric, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{metric}_bucket{_prometheus_labels(labels, [('le', le)])} {cumulative}")
+        lines.append(f"{metric}_sum{_prometheus_labels(labels)} {total}")
+        lines.append(f"{metric}_count{_prometheus_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    """
+    Write the metrics for a node_exporter textfile collector. The file is replaced atomically,
+    so the collector never reads a partial file.
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(temporary, path)
@@ -1,5 +1,5 @@
 # stripe_db_tool/models.py
-from sqlalchemy import Column, Integer, Float, String, DateTime, Text, ForeignKey, Boolean, Date
+from sqlalchemy import Column, Integer, BigInteger, Float, String, DateTime, Text, ForeignKey, Boolean, Date
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -53,6 +53,7 @@ class CommissionTransactions(Base):
     commission_amount = Column(Float, nullable=True)
     commission_paid = Column(Boolean, nullable=False, default=False)
     commission_paid_tx_id = Column(Text, nullable=False, default='')
+    row_fingerprint = Column(BigInteger, nullable=True)  # Hash of the synced columns, NULL when unknown
 
 class Referrals(Base):
     __tablename__ = 'referrals'
@@ -60,4 +61,31 @@ class Referrals(Base):
     referral_link = Column(String(50), unique=True, nullable=False)
     referrals = Column(JSONB, nullable=False, default=lambda: {})
     commission = Column(Float, nullable=False, default=0.25)
-    discount = Column(Float, nullable=False, default=0.05)
\ No newline at end of file
+    discount = Column(Float, nullable=False, default=0.05)
+
+# Tables owned by the job, created by migrations/001_job_tables.sql
+class ChargeSyncState(Base):
+    __tablename__ = 'charge_sync_state'
+    sync_key = Column(String(255), primary_key=True)  # Stripe customer id, or a global key for account-wide scans
+    last_created = Column(DateTime, nullable=True)
+    last_charge_id = Column(String(50), nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class ShardRun(Base):
+    __tablename__ = 'shard_runs'
+    run_id = Column(String(255), primary_key=True)  # Shared by every shard of one run, e.g. the Cloud Run execution
+    shard_index = Column(Integer, primary_key=True)
+    shard_count = Column(Integer, nullable=False)
+    completed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    reduced_at = Column(DateTime, nullable=True)  # Set on the shard that ran the reduce step
+
+class RunState(Base):
+    __tablename__ = 'run_state'
+    stage_key = Column(String(255), primary_key=True)  # Stage name, plus the shard in a sharded run
+    run_id = Column(String(255), nullable=True)  # Run that wrote the checkpoint
+    phase = Column(String(32), nullable=False)
+    last_key = Column(String(255), nullable=True)  # Last committed key of the phase, e.g. a customer id or scan cursor
+    batch = Column(Integer, nullable=False, default=0)  # Batches committed so far
+    retry_keys = Column(JSONB, nullable=False, default=lambda: [])  # Keys that failed and are retried later
+    state = Column(JSONB, nullable=True)  # Stage-specific extras, e.g. a pending watermark
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
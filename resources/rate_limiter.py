@@ -0,0 +1,206 @@
+# stripe_db_tool/rate_limiter.py
+import asyncio
+import random
+import threading
+import time
+
+import stripe
+
+from resources import metrics
+from resources.config import Config
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every worker that talks to the Stripe API.
+
+    The bucket refills at `rate` tokens per second up to `capacity`. When Stripe answers with a
+    429 the bucket is paused for the advised delay and its rate is halved, then it creeps back
+    towards the configured rate as calls succeed again. The 429s of a burst of concurrent calls
+    all land in the same pause, so the rate is cut at most once per pause.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=1.0):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # End of the pause that last cut the rate; further 429s before then only extend the pause
+        self._cut_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        """Consume a token if one is available, otherwise return the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available and consume it."""
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait without blocking the event loop until a token is available and consume it."""
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def throttle(self, delay):
+        """Pause all workers for `delay` seconds and halve the request rate, once per pause."""
+        with self._lock:
+            now = time.monotonic()
+            cut = now >= self._cut_until
+            self._paused_until = max(self._paused_until, now + delay)
+            self._updated = self._paused_until
+            self._tokens = 0
+            if cut:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._cut_until = self._paused_until
+
+    def recover(self):
+        """Additively restore the request rate after a successful call."""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+_stripe_limiter = None
+_stripe_limiter_lock = threading.Lock()
+
+
+def get_stripe_limiter():
+    """
+    Return the process-wide Stripe token bucket, so stages running concurrently share one budget.
+
+    Returns:
+        TokenBucket: Limiter sized by Config.STRIPE_REQUESTS_PER_SECOND.
+    """
+    global _stripe_limiter
+    with _stripe_limiter_lock:
+        if _stripe_limiter is None:
+            _stripe_limiter = TokenBucket(Config.STRIPE_REQUESTS_PER_SECOND)
+    return _stripe_limiter
+
+
+def _retry_delay(error, attempt):
+    """
+    Work out how long to back off after a 429, preferring the delay Stripe advertises.
+
+    Args:
+        error (stripe.error.RateLimitError): The rate limit error raised by the SDK.
+        attempt (int): Zero-based retry attempt, used for the exponential fallback.
+
+    Returns:
+        float: Seconds to wait before the next request.
+    """
+    headers = error.headers or {}
+    for header in ('Retry-After', 'X-RateLimit-Reset', 'RateLimit-Reset'):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            delay = float(value)
+        except (TypeError, ValueError):
+            continue
+        # Reset headers may carry an absolute epoch timestamp rather than a delta
+        if delay > time.time() / 2:
+            delay -= time.time()
+        if delay > 0:
+            return delay
+    return min(30.0, 0.5 * (2 ** attempt)) + random.uniform(0, 0.25)
+
+
+def _record_request(func, started, status):
+    """
+    Count one Stripe request attempt and its latency, keyed by SDK method (sync and async share a key).
+
+    Args:
+        func (callable): The SDK method that was called, e.g. stripe.Charge.list_async.
+        started (float): time.perf_counter() taken before the request.
+        status (str): 'ok', '429' or 'error'.
+    """
+    if not metrics.enabled():
+        return
+    endpoint = getattr(func, '__qualname__', str(func)).removesuffix('_async')
+    metrics.inc('stripe_requests', endpoint=endpoint, status=status)
+    metrics.observe('stripe_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+
+
+def call_with_backoff(func, limiter, *args, max_retries=None, **kwargs):
+    """
+    Call a Stripe SDK function through the shared limiter, retrying on 429 responses.
+
+    Args:
+        func (callable): Stripe SDK call, e.g. stripe.Subscription.list.
+        limiter (TokenBucket): Shared limiter that every worker draws from.
+        max_retries (int, optional): Retries before giving up. Defaults to Config.STRIPE_MAX_RETRIES.
+
+    Returns:
+        The SDK call's response.
+
+    Raises:
+        stripe.error.RateLimitError: If Stripe keeps rate limiting after all retries.
+        stripe.error.StripeError: Any other Stripe error is raised immediately.
+    """
+    max_retries = Config.STRIPE_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+        except stripe.error.RateLimitError as e:
+            _record_request(func, started, '429')
+            if attempt >= max_retries:
+                raise
+            limiter.throttle(_retry_delay(e, attempt))
+            attempt += 1
+            continue
+        except stripe.error.StripeError:
+            _record_request(func, started, 'error')
+            raise
+        _record_request(func, started, 'ok')
+        limiter.recover()
+        return response
+
+
+async def call_with_backoff_async(func, limiter, *args, max_retries=None, **kwargs):
+    """
+    Async counterpart of call_with_backoff for the SDK's *_async methods, e.g. stripe.Charge.list_async.
+    """
+    max_retries = Config.STRIPE_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        await limiter.acquire_async()
+        started = time.perf_counter()
+        try:
+            response = await func(*args, **kwargs)
+        except stripe.error.RateLimitError as e:
+            _record_request(func, started, '429')
+            if attempt >= max_retries:
+                raise
+            limiter.throttle(_retry_delay(e, attempt))
+            attempt += 1
+            continue
+        except stripe.error.StripeError:
+            _record_request(func, started, 'error')
+            raise
+        _record_request(func, started, 'ok')
+        limiter.recover()
+        return response
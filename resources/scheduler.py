@@ -0,0 +1,270 @@
+# stripe_db_tool/scheduler.py
+import asyncio
+import importlib
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from resources import metrics, startup
+from resources.db import (new_db_session, fetch_users, fetch_commission_rates, mark_shard_complete, lock_shard_run,
+                          fetch_shard_run_status, mark_shard_reduced)
+from resources.sharding import SINGLE_SHARD, filter_frame
+
+# A job stage: `target` is 'package.module:function', imported only when the stage runs.
+# The function is called as function(session, logger, context=run_context).
+# `async_target` is the coroutine function used instead in async mode, called with an AsyncSession.
+Stage = namedtuple('Stage', ['name', 'target', 'depends_on', 'async_target'], defaults=(None,))
+
+
+class RunContext:
+    """
+    Inputs shared by several stages, computed once per run and safe to request from any stage thread.
+    Every accessor returns a copy, so a stage can mutate its frame freely.
+
+    In a sharded run the users are restricted to the ones the shard owns, so every stage that works
+    from them only fetches and writes its own rows. run_id identifies the run in stage checkpoints.
+    """
+
+    def __init__(self, shard=None, run_id=None):
+        self.shard = shard or SINGLE_SHARD
+        self.run_id = run_id
+        self._values = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._async_locks = {}
+        self._limits = None
+
+    def get(self, key, loader):
+        """
+        Return the memoized value for key, computing it with loader() on first request.
+        Concurrent requests for the same key wait for the first computation.
+        """
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._values:
+                self._values[key] = loader()
+            return self._values[key]
+
+    def users(self, session):
+        return self.get('users', lambda: filter_frame(fetch_users(session), self.shard)).copy()
+
+    def commission_rates(self, session):
+        return self.get('commission_rates', lambda: fetch_commission_rates(session)).copy()
+
+    async def get_async(self, key, loader):
+        """
+        Async counterpart of get() for stages sharing one event loop; loader() returns an awaitable.
+        """
+        key_lock = self._async_locks.setdefault(key, asyncio.Lock())
+        async with key_lock:
+            if key not in self._values:
+                self._values[key] = await loader()
+            return self._values[key]
+
+    async def users_async(self, session):
+        async def load():
+            return filter_frame(await session.run_sync(fetch_users), self.shard)
+        return (await self.get_async('users', load)).copy()
+
+    async def commission_rates_async(self, session):
+        return (await self.get_async('commission_rates', lambda: session.run_sync(fetch_commission_rates))).copy()
+
+    def backend_limits(self):
+        """
+        Concurrency bounds shared by every async stage of the run, created on first use inside the loop.
+        """
+        if self._limits is None:
+            from resources.async_clients import BackendLimits
+            self._limits = BackendLimits()
+        return self._limits
+
+
+def _load_target(stage, use_async=False):
+    module_name, function_name = (stage.async_target if use_async else stage.target).split(':')
+    with startup.phase(f"import_{stage.name}"):
+        return getattr(importlib.import_module(module_name), function_name)
+
+
+def _check_dependencies(stages):
+    """
+    Validate the stage graph and return the stages in a dependency-respecting order.
+
+    Raises:
+    ValueError: If a dependency is unknown or the dependencies contain a cycle.
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        unknown = set(stage.depends_on) - names
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {unknown}")
+
+    ordered, done = [], set()
+    pending = list(stages)
+    while pending:
+        ready = [stage for stage in pending if set(stage.depends_on) <= done]
+        if not ready:
+            raise ValueError(f"Stage dependencies contain a cycle: {sorted(stage.name for stage in pending)}")
+        ordered.extend(ready)
+        done.update(stage.name for stage in ready)
+        pending = [stage for stage in pending if stage.name not in done]
+    return ordered
+
+
+def _run_stage(stage, logger, context):
+    """
+    Run one stage on its own database session. A failure is logged and reported, never raised,
+    so independent stages keep running.
+    """
+    started = time.perf_counter()
+    session = new_db_session()
+    ok = True
+    try:
+        _load_target(stage)(session, logger, context=context)
+    except Exception as e:
+        ok = False
+        logger.error(f"Error {stage.name}(): {str(e)}")
+    finally:
+        session.close()
+    seconds = round(time.perf_counter() - started, 3)
+    logger.info(f"Stage {stage.name} {'completed' if ok else 'failed'} in {seconds}s.")
+    metrics.gauge('stage_seconds', seconds, stage=stage.name)
+    metrics.gauge('stage_ok', ok, stage=stage.name)
+    return {'seconds': seconds, 'ok': ok}
+
+
+def run_stages(stages, logger, context=None, max_workers=None):
+    """
+    Run stages as a dependency graph: every stage starts as soon as the stages it depends on have
+    finished, and independent stages run concurrently on separate sessions.
+
+    A stage whose dependency failed still runs, matching the sequential job where each stage
+    was attempted regardless of the previous one.
+
+    Parameters:
+    stages (list): Stage tuples.
+    logger (GcpLogger): Logger instance for logging operations.
+    context (RunContext, optional): Shared inputs for the run. A new one is created if omitted.
+    max_workers (int, optional): Maximum concurrently running stages. Defaults to len(stages).
+
+    Returns:
+    dict: Per-stage {'seconds': float, 'ok': bool}, keyed by stage name.
+
+    Raises:
+    ValueError: If a dependency is unknown or the dependencies contain a cycle.
+    """
+    context = context or RunContext()
+    _check_dependencies(stages)
+
+    pending = {stage.name: stage for stage in stages}
+    done = set()
+    running = {}
+    timings = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1, thread_name_prefix='stage') as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if set(stage.depends_on) <= done:
+                    running[executor.submit(_run_stage, stage, logger, context)] = name
+                    del pending[name]
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                timings[name] = future.result()
+                done.add(name)
+
+    return timings
+
+
+def run_reduce_once(stages, shard_timings, logger, run_id, shard, context=None):
+    """
+    Record this shard of a sharded run as complete, then run the reduce stages if it is the last
+    shard to complete. A Postgres advisory lock on run_id makes the check and the reduce atomic
+    across shards, so the reduce runs exactly once per run after every shard has committed.
+
+    A shard is only recorded as complete when all of its stages succeeded (shard_timings, as returned
+    by run_stages), so the reduce never aggregates a shard whose rows were not all written. A failed
+    shard or reduce is not recorded, so re-running that task of the run retries it.
+
+    Returns:
+    dict: Per-stage timings of the reduce stages, empty if this shard did not run them.
+    """
+    failed = sorted(name for name, timing in shard_timings.items() if not timing['ok'])
+    if failed:
+        logger.error(f"Shard {shard.index}/{shard.count} of run {run_id} not marked complete, "
+                     f"failed stages: {failed}. The reduce waits for this task to be re-run.")
+        return {}
+
+    session = new_db_session()
+    try:
+        mark_shard_complete(session, run_id, shard)
+        lock_shard_run(session, run_id)
+        completed, reduced = fetch_shard_run_status(session, run_id, shard.count)
+        if reduced or completed < shard.count:
+            logger.info(f"Shard {shard.index}/{shard.count} of run {run_id} done, "
+                        f"{completed} shards complete, reduce {'already ran' if reduced else 'pending'}.")
+            session.commit()
+            return {}
+
+        logger.info(f"All {shard.count} shards of run {run_id} complete, running the reduce step.")
+        timings = run_stages(stages, logger, context)
+        if all(timing['ok'] for timing in timings.values()):
+            mark_shard_reduced(session, run_id, shard)
+        else:
+            session.commit()
+        return timings
+    finally:
+        session.close()
+
+
+async def _run_stage_async(stage, logger, context, dependencies):
+    """
+    Async counterpart of _run_stage: waits for the dependency tasks, then runs the stage's
+    async_target on its own AsyncSession. A failure is logged and reported, never raised.
+    """
+    from resources.async_clients import new_async_db_session
+
+    if dependencies:
+        await asyncio.wait(dependencies)
+    started = time.perf_counter()
+    session = new_async_db_session()
+    ok = True
+    try:
+        await _load_target(stage, use_async=True)(session, logger, context=context)
+    except Exception as e:
+        ok = False
+        logger.error(f"Error {stage.name}(): {str(e)}")
+    finally:
+        await session.close()
+    seconds = round(time.perf_counter() - started, 3)
+    logger.info(f"Stage {stage.name} {'completed' if ok else 'failed'} in {seconds}s.")
+    metrics.gauge('stage_seconds', seconds, stage=stage.name)
+    metrics.gauge('stage_ok', ok, stage=stage.name)
+    return {'seconds': seconds, 'ok': ok}
+
+
+async def run_stages_async(stages, logger, context=None):
+    """
+    Run the stage graph as tasks on the current event loop, with the same ordering and failure
+    semantics as run_stages. Every stage must define an async_target.
+
+    Returns:
+    dict: Per-stage {'seconds': float, 'ok': bool}, keyed by stage name.
+
+    Raises:
+    ValueError: If a stage has no async_target, a dependency is unknown or the dependencies contain a cycle.
+    """
+    context = context or RunContext()
+    missing = [stage.name for stage in stages if not stage.async_target]
+    if missing:
+        raise ValueError(f"Stages without an async target: {missing}")
+
+    tasks = {}
+    for stage in _check_dependencies(stages):
+        dependencies = [tasks[name] for name in stage.depends_on]
+        tasks[stage.name] = asyncio.create_task(_run_stage_async(stage, logger, context, dependencies))
+
+    results = await asyncio.gather(*tasks.values())
+    return dict(zip(tasks, results))
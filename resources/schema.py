@@ -0,0 +1,72 @@
+# stripe_db_tool/schema.py
+import pandas as pd
+
+# Canonical in-memory dtypes of the frames the job builds. Low-cardinality strings, and ids repeated
+# on every charge of a customer, are categoricals: one int8/int16/int32 code per row instead of a
+# pointer to a Python string each. Flags are nullable booleans, 1 byte plus a 1 byte mask.
+# Amounts stay float64 dollars, the unit of commission_transactions.amount and of the commission maths.
+CHARGE_DTYPES = {
+    'user_id': 'category',
+    'referee': 'category',
+    'customer_id': 'category',
+    'email': 'category',
+    'charge_id': object,
+    'amount': 'float64',
+    'currency': 'category',
+    'status': 'category',
+    'disputed': 'boolean',
+    'dispute': object,
+    'refunded': 'boolean',
+    'created': 'datetime64[ns]',
+    'description': 'category',
+    'payment_method': 'category',
+    'last4': 'category',
+}
+
+# One row per user: user_id and stripe_customer_id are unique, the referees repeat
+USER_DTYPES = {
+    'user_id': object,
+    'stripe_customer_id': object,
+    'referee': 'category',
+}
+
+COMMISSION_RATE_DTYPES = {
+    'user_id': object,
+    'commission': 'float64',
+}
+
+
+def typed_frame(columns, dtypes):
+    """
+    Build a DataFrame straight into its schema dtypes, one column at a time, without an all-object frame first.
+
+    Parameters:
+    columns (dict): Column name to a list (or array) of values, in frame order.
+    dtypes (dict): Schema dtype per column name. Columns missing from the schema stay object.
+
+    Returns:
+    pd.DataFrame: The typed frame, with the given columns even when they are empty.
+    """
+    return pd.DataFrame({
+        name: pd.Series(values, dtype=dtypes.get(name, object), name=name)
+        for name, values in columns.items()
+    })
+
+
+def records_frame(records, columns, dtypes):
+    """
+    Build a typed DataFrame from dict records. A key missing from a record becomes a missing value.
+
+    Parameters:
+    records (list): Dict records, e.g. normalized charge records.
+    columns (list): Columns of the frame, in order.
+    dtypes (dict): Schema dtype per column name.
+    """
+    return typed_frame({name: [record.get(name) for record in records] for name in columns}, dtypes)
+
+
+def charge_frame(records, columns):
+    """
+    Typed frame of charge records (CHARGE_DTYPES).
+    """
+    return records_frame(records, columns, CHARGE_DTYPES)
@@ -0,0 +1,69 @@
+# stripe_db_tool/sharding.py
+import argparse
+import hashlib
+import os
+from collections import namedtuple
+
+from resources.config import Config
+
+# The slice of users a job task owns: users whose key hashes to `index` modulo `count`
+Shard = namedtuple('Shard', ['index', 'count'])
+
+SINGLE_SHARD = Shard(0, 1)
+
+
+def parse_shard_args(argv=None):
+    """
+    Read the shard and run id from CLI flags, falling back to the Cloud Run job task variables
+    (CLOUD_RUN_TASK_INDEX, CLOUD_RUN_TASK_COUNT and CLOUD_RUN_EXECUTION).
+
+    Returns:
+    tuple: (Shard, run_id). run_id is None when neither a flag nor CLOUD_RUN_EXECUTION is set.
+
+    Raises:
+    ValueError: If the shard index is outside [0, shard count), a sharded run has no run id,
+                or a sharded run uses the account-wide charge scan (CHARGE_SYNC_MODE=global_scan).
+    """
+    parser = argparse.ArgumentParser(description="Sync Stripe subscriptions and referral commissions.")
+    parser.add_argument('--shard-index', type=int, default=int(os.getenv('CLOUD_RUN_TASK_INDEX', 0)))
+    parser.add_argument('--shard-count', type=int, default=int(os.getenv('CLOUD_RUN_TASK_COUNT', 1)))
+    parser.add_argument('--run-id', default=os.getenv('CLOUD_RUN_EXECUTION'),
+                        help="Identifier shared by every shard of one run, used to run the reduce step once.")
+    args = parser.parse_args(argv)
+
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        raise ValueError(f"Invalid shard {args.shard_index} of {args.shard_count}")
+    if args.shard_count > 1 and not args.run_id:
+        raise ValueError("A sharded run needs --run-id or CLOUD_RUN_EXECUTION")
+    if args.shard_count > 1 and Config.CHARGE_SYNC_MODE == 'global_scan':
+        # Every shard would page through every charge in the account
+        raise ValueError("CHARGE_SYNC_MODE=global_scan cannot be sharded, use per_customer or a single task")
+    return Shard(args.shard_index, args.shard_count), args.run_id
+
+
+def shard_of(key, count):
+    """
+    Stable shard number for a key. Unlike hash(), it is the same in every process and on every run.
+    """
+    digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def owns(shard, key):
+    """
+    Whether the shard owns the key. Rows without a key belong to shard 0.
+    """
+    if shard.count == 1:
+        return True
+    if key is None or key != key:
+        return shard.index == 0
+    return shard_of(key, shard.count) == shard.index
+
+
+def filter_frame(df, shard, column='user_id'):
+    """
+    Keep the rows of a DataFrame whose `column` value is owned by the shard.
+    """
+    if shard.count == 1 or df.empty:
+        return df
+    return df[[owns(shard, key) for key in df[column]]]
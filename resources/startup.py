@@ -0,0 +1,51 @@
+# stripe_db_tool/startup.py
+import time
+from contextlib import contextmanager
+
+# Reference point for the start-up report, taken when the first job module imports this one
+_STARTED_AT = time.perf_counter()
+_last_mark = _STARTED_AT
+_phases = []
+
+
+def mark(label):
+    """
+    Record that a sequential start-up phase (imports, logger, database...) just finished.
+    The phase is timed from the previous mark, or from process start-up for the first one.
+
+    Parameters:
+    label (str): Name of the phase that ended.
+    """
+    global _last_mark
+    now = time.perf_counter()
+    _phases.append((label, now - _last_mark))
+    _last_mark = now
+
+
+@contextmanager
+def phase(label):
+    """
+    Time a deferred initialization step, such as a stage's first import, on its own.
+
+    Parameters:
+    label (str): Name of the phase.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((label, time.perf_counter() - started))
+
+
+def startup_report():
+    """
+    Break start-up and deferred initialization time down by recorded phase.
+
+    For a per-module import breakdown run the job with `python -X importtime main.py`.
+
+    Returns:
+    dict: Milliseconds spent in each phase, in recording order, plus 'total_ms'.
+    """
+    report = {f"{label}_ms": round(seconds * 1000, 1) for label, seconds in _phases}
+    report['total_ms'] = round(sum(seconds for _, seconds in _phases) * 1000, 1)
+    return report
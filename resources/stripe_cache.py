@@ -0,0 +1,133 @@
+# stripe_db_tool/stripe_cache.py
+import json
+import sqlite3
+import threading
+import time
+
+from resources.config import Config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stripe_objects (
+    object_type TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    expires_at REAL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (object_type, object_id)
+)
+"""
+
+
+class StripeCache:
+    """
+    Persistent cache of Stripe API payloads in a local SQLite file, keyed by object type and id.
+
+    An entry is served until its expiry; entries stored as immutable never expire. Once the cache
+    holds more than max_entries rows, the least recently used ones are evicted. Safe to share
+    between threads, and between processes on the same volume.
+    """
+
+    def __init__(self, path, max_entries, ttls):
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS stripe_objects_lru ON stripe_objects (accessed_at)")
+        self._hits = {}
+        self._misses = {}
+        self._puts = 0
+
+    def get(self, object_type, object_id):
+        """
+        Return the cached payload, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, expires_at FROM stripe_objects WHERE object_type = ? AND object_id = ?",
+                (object_type, object_id)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self._misses[object_type] = self._misses.get(object_type, 0) + 1
+                return None
+            self._conn.execute(
+                "UPDATE stripe_objects SET accessed_at = ? WHERE object_type = ? AND object_id = ?",
+                (now, object_type, object_id)
+            )
+            self._hits[object_type] = self._hits.get(object_type, 0) + 1
+        return json.loads(row[0])
+
+    def put(self, object_type, object_id, payload, immutable=False):
+        """
+        Store a JSON-serializable payload. Mutable entries expire after the TTL of their type.
+        """
+        now = time.time()
+        expires_at = None if immutable else now + self.ttls.get(object_type, 0)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stripe_objects VALUES (?, ?, ?, ?, ?, ?)",
+                (object_type, object_id, json.dumps(payload), now, expires_at, now)
+            )
+            self._puts += 1
+            # Check the size every few hundred writes rather than on every write
+            if self._puts % 500 == 0:
+                self._evict()
+
+    def _evict(self):
+        excess = self._conn.execute("SELECT COUNT(*) FROM stripe_objects").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM stripe_objects WHERE rowid IN "
+                "(SELECT rowid FROM stripe_objects ORDER BY accessed_at LIMIT ?)",
+                (excess,)
+            )
+
+    def stats(self):
+        """
+        Hit and miss counters of this process, overall and per object type.
+
+        Returns:
+        dict: e.g. {'hits': 90, 'misses': 10, 'hit_rate': 0.9, 'by_type': {'charge': {...}}}.
+        """
+        with self._lock:
+            by_type = {}
+            for object_type in set(self._hits) | set(self._misses):
+                hits, misses = self._hits.get(object_type, 0), self._misses.get(object_type, 0)
+                by_type[object_type] = {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3)}
+        hits = sum(counts['hits'] for counts in by_type.values())
+        misses = sum(counts['misses'] for counts in by_type.values())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            'by_type': by_type
+        }
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._conn.close()
+
+
+_stripe_cache = None
+_stripe_cache_lock = threading.Lock()
+
+
+def get_stripe_cache():
+    """
+    Return the process-wide Stripe cache, or None when Config.STRIPE_CACHE_PATH is not set.
+    """
+    global _stripe_cache
+    if not Config.STRIPE_CACHE_PATH:
+        return None
+    with _stripe_cache_lock:
+        if _stripe_cache is None:
+            _stripe_cache = StripeCache(Config.STRIPE_CACHE_PATH, Config.STRIPE_CACHE_MAX_ENTRIES, {
+                'charge': Config.STRIPE_CACHE_TTL_CHARGE,
+                'customer_charges': Config.STRIPE_CACHE_TTL_CHARGE_LIST,
+            })
+    return _stripe_cache
@@ -0,0 +1,109 @@
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from resources.schema import charge_frame
+from update_commision_transactions_db.update_commision_transactions import CHARGE_COLUMNS, _compute_commissions
+
+
+def _baseline_commissions(referals_df, commission_df):
+    """
+    The per-referrer mask loop _compute_commissions replaced, kept as the reference.
+    """
+    referals_df['matures_on'] = referals_df['created'] + pd.Timedelta(days=90)
+
+    for _, user_row in commission_df.iterrows():
+        mask = referals_df['referee'] == user_row['user_id']
+        valid_commission_mask = mask & (referals_df['dispute'].isna()) & (referals_df['refunded'] != True)
+        referals_df.loc[valid_commission_mask, 'commission_amount'] = (
+                referals_df.loc[valid_commission_mask, 'amount'] * user_row['commission']
+        )
+        invalid_commission_mask = mask & ((referals_df['dispute'].notna()) | (referals_df['refunded'] == True) |
+                                          (referals_df['status'] != 'succeeded'))
+        referals_df.loc[invalid_commission_mask, 'commission_amount'] = 0.0
+
+    referals_df['disputed'] = referals_df['disputed'].astype(bool)
+    referals_df['refunded'] = referals_df['refunded'].astype(bool)
+    return referals_df[referals_df['charge_id'].notna()]
+
+
+def _random_records(rng, rows, referees):
+    """
+    Charge records over referees with and without a rate, with every status, dispute and refund mix.
+    """
+    records = []
+    for number in range(rows):
+        disputed = rng.random() < 0.1
+        records.append({
+            'user_id': str(uuid.UUID(int=int(rng.integers(1, 2 ** 62)))),
+            'referee': referees[rng.integers(len(referees))] if rng.random() < 0.95 else None,
+            'customer_id': f"cus_{number % 50:08d}",
+            'email': f"customer{number % 50}@example.com",
+            'charge_id': f"ch_{number:08d}" if rng.random() < 0.98 else None,
+            'amount': float(rng.integers(100, 100000)) / 100.0,
+            'currency': 'USD',
+            'status': str(rng.choice(['succeeded', 'succeeded', 'pending', 'failed'])),
+            'disputed': disputed,
+            'dispute': f"dp_{number:08d}" if disputed or rng.random() < 0.02 else None,
+            'refunded': bool(rng.random() < 0.1),
+            'created': pd.Timestamp('2025-01-01') + pd.Timedelta(seconds=int(rng.integers(0, 365 * 86400))),
+            'description': 'Subscription payment',
+            'payment_method': 'visa',
+            'last4': f"{number % 10000:04d}",
+        })
+    return records
+
+
+@pytest.fixture(params=[0, 1, 2, 3])
+def frames(request):
+    rng = np.random.default_rng(request.param)
+    referees = [str(uuid.UUID(int=number + 1)) for number in range(40)]
+    # The last 10 referees have no Referrals row
+    commission_df = pd.DataFrame({
+        'user_id': referees[:30],
+        'commission': rng.choice([0.1, 0.2, 0.25, 1 / 3], size=30),
+    })
+    return _random_records(rng, 2000, referees), commission_df, set(referees[30:])
+
+
+def test_matches_baseline_without_default_rate(frames):
+    records, commission_df, _ = frames
+    expected = _baseline_commissions(pd.DataFrame.from_records(records, columns=CHARGE_COLUMNS), commission_df)
+    actual = _compute_commissions(charge_frame(records, CHARGE_COLUMNS), commission_df, default_rate=None)
+
+    assert isinstance(actual['referee'].dtype, pd.CategoricalDtype)
+    assert actual['charge_id'].tolist() == expected['charge_id'].tolist()
+    np.testing.assert_allclose(actual['commission_amount'].to_numpy(dtype=float),
+                               expected['commission_amount'].to_numpy(dtype=float), equal_nan=True)
+    assert (actual['matures_on'].to_numpy() == expected['matures_on'].to_numpy()).all()
+    assert actual['disputed'].tolist() == expected['disputed'].tolist()
+    assert actual['refunded'].tolist() == expected['refunded'].tolist()
+
+
+def test_default_rate_applies_to_referees_without_rate(frames):
+    records, commission_df, unrated = frames
+    default_rate = 0.05
+    # The baseline with a Referrals row at the default rate for every unrated referee
+    default_rows = pd.DataFrame({'user_id': sorted(unrated), 'commission': default_rate})
+    expected = _baseline_commissions(pd.DataFrame.from_records(records, columns=CHARGE_COLUMNS),
+                                     pd.concat([commission_df, default_rows], ignore_index=True))
+    actual = _compute_commissions(charge_frame(records, CHARGE_COLUMNS), commission_df, default_rate=default_rate)
+
+    unrated_rows = actual['referee'].isin(unrated).to_numpy()
+    assert unrated_rows.any()
+    np.testing.assert_allclose(actual['commission_amount'].to_numpy(dtype=float),
+                               expected['commission_amount'].to_numpy(dtype=float), equal_nan=True)
+
+
+def test_not_payable_and_missing_rate_rows(frames):
+    records, commission_df, unrated = frames
+    actual = _compute_commissions(charge_frame(records, CHARGE_COLUMNS), commission_df, default_rate=0.0)
+
+    not_payable = (actual['dispute'].notna() | actual['refunded'] | (actual['status'] != 'succeeded')).to_numpy()
+    has_referee = actual['referee'].notna().to_numpy()
+    assert (actual['commission_amount'].to_numpy()[not_payable & has_referee] == 0.0).all()
+    assert (actual.loc[actual['referee'].isin(unrated), 'commission_amount'] == 0.0).all()
+    # Charges without a referee cannot be matched to any rate
+    assert actual.loc[~has_referee, 'commission_amount'].isna().all()
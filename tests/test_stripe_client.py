@@ -0,0 +1,65 @@
+import asyncio
+import contextlib
+
+import pytest
+import stripe
+
+from benchmark.fake_stripe import BASE_CREATED, FakeStripeData
+from resources.stripe_cache import StripeCache
+from update_commision_transactions_db import stripe_client
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = StripeCache(str(tmp_path / 'stripe_cache.sqlite'), 1000, {'charge': 3600, 'customer_charges': 3600})
+    monkeypatch.setattr(stripe_client, 'get_stripe_cache', lambda: cache)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def listed_charges(cache):
+    """
+    Charges cached by a customer listing, which stores them with the customer expanded.
+    """
+    data = FakeStripeData(1, 3)
+    charges = [stripe.Charge.construct_from(data.charge(0, index, expand_customer=True), 'sk_test')
+               for index in range(3)]
+    stripe_client._store_listing(cache, charges[0].customer.id, [], charges, 0, BASE_CREATED)
+    return charges
+
+
+def _no_stripe_calls(*args, **kwargs):
+    raise AssertionError("the charge should have been served from the cache")
+
+
+class _Limits:
+    stripe = contextlib.nullcontext()
+
+
+def test_cache_hit_on_listed_charge(monkeypatch, listed_charges):
+    monkeypatch.setattr(stripe_client, 'call_with_backoff', _no_stripe_calls)
+    df = stripe_client.get_charges_by_id(None, [charge.id for charge in listed_charges], max_workers=2)
+
+    assert sorted(df['charge_id']) == sorted(charge.id for charge in listed_charges)
+    assert set(df['customer_id']) == {listed_charges[0].customer.id}
+    assert df['email'].isna().all()
+
+
+def test_cache_hit_on_listed_charge_async(monkeypatch, listed_charges):
+    monkeypatch.setattr(stripe_client, 'call_with_backoff_async', _no_stripe_calls)
+    df = asyncio.run(stripe_client.get_charges_by_id_async(None, [charge.id for charge in listed_charges], _Limits()))
+
+    assert sorted(df['charge_id']) == sorted(charge.id for charge in listed_charges)
+    assert set(df['customer_id']) == {listed_charges[0].customer.id}
+
+
+def test_cache_hit_keeps_email_when_expanded(monkeypatch, cache, listed_charges):
+    # Webhook refreshes expand the customer and always go to Stripe
+    charge = listed_charges[0]
+    monkeypatch.setattr(stripe_client, 'call_with_backoff', lambda *args, **kwargs: charge)
+    df = stripe_client.get_charges_by_id(None, [charge.id], expand_customer=True)
+
+    assert df['customer_id'].tolist() == [charge.customer.id]
+    assert df['email'].tolist() == [charge.customer.email]
+    assert cache.get('charge', charge.id)['customer']['id'] == charge.customer.id
@@ -1,46 +1,220 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import stripe
 
+from resources import metrics
 from resources.db import fetch_users, update_isactive_in_users
 from resources.config import Config
-import time
+from resources.rate_limiter import call_with_backoff, call_with_backoff_async, get_stripe_limiter
 
-def update_active_status(session, logger):
+ACTIVE_SCAN_PARAMS = {'status': 'active', 'limit': 100}
 
-    df_users = fetch_users(session)
-    df_users = df_users.drop(columns=['referee'])
-    df_users = df_users.dropna(subset=['stripe_customer_id'])
-    df_users['active'] = False
 
-    stripe.api_key = Config.STRIPE_SECRET_KEY
+def _subscription_active(customer_id, subscriptions, logger):
+    """
+    Whether one of a customer's subscriptions is active.
+    """
+    statuses = [data.get('status') for data in subscriptions.data]
+    logger.debug("customer_id=%s: Length subscriptions=%s", customer_id, len(statuses))
+    for status in statuses:
+        logger.debug("customer_id=%s: %s", customer_id, status)
+    return 'active' in statuses
+
+
+def _lookup_failed(customer_id, error, logger):
+    """
+    Log a failed subscription lookup and report it as None (unknown), so one bad customer never
+    aborts the stage. The nightly batch counts it as inactive; the webhook path keeps the event
+    queued instead.
+    """
+    if isinstance(error, stripe.error.StripeError):
+        logger.error(f"Stripe API error for customer {customer_id}: {str(error)}")
+    else:
+        logger.error(f"Unexpected error checking subscription for customer {customer_id}: {str(error)}")
+    return None
+
+
+def _has_active_subscription(customer_id, limiter, logger):
+    """
+    Check a single Stripe customer for an active subscription.
+
+    Returns:
+    bool: Whether the customer has an active subscription, or None if the lookup failed.
+    """
+    try:
+        # Check for any active subscriptions. Statuses are mutable and never served from the Stripe cache
+        subscriptions = call_with_backoff(stripe.Subscription.list, limiter, customer=customer_id)
+    except Exception as e:
+        return _lookup_failed(customer_id, e, logger)
+    return _subscription_active(customer_id, subscriptions, logger)
+
+
+async def _has_active_subscription_async(customer_id, limiter, limits, logger):
+    """
+    Async counterpart of _has_active_subscription, holding one of the limits.stripe slots.
+    """
+    try:
+        async with limits.stripe:
+            subscriptions = await call_with_backoff_async(stripe.Subscription.list_async, limiter,
+                                                          customer=customer_id)
+    except Exception as e:
+        return _lookup_failed(customer_id, e, logger)
+    return _subscription_active(customer_id, subscriptions, logger)
+
+
+def check_active_subscriptions(customer_ids, logger, max_workers=None):
+    """
+    Check many Stripe customers concurrently behind a shared token-bucket rate limiter.
+
+    Parameters:
+    customer_ids (list): Stripe customer ids to check.
+    logger (GcpLogger): Logger instance for logging operations.
+    max_workers (int, optional): Worker pool size. Defaults to Config.STRIPE_MAX_WORKERS.
+
+    Returns:
+    list: One bool per customer id, in input order, or None where the lookup failed.
+    """
+    max_workers = max_workers or Config.STRIPE_MAX_WORKERS
+    limiter = get_stripe_limiter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda customer_id: _has_active_subscription(customer_id, limiter, logger),
+                                 customer_ids))
+
+
+def _add_active_page(active_customer_ids, params, page):
+    """
+    Collect the owners of one page of active subscriptions and move the cursor past it.
+
+    Returns:
+    bool: Whether there is another page to fetch.
+    """
+    for subscription in page.data:
+        active_customer_ids.add(subscription.customer)
+    if not page.has_more or not page.data:
+        return False
+    params['starting_after'] = page.data[-1].id
+    return True
+
+
+def fetch_active_customer_ids(logger):
+    """
+    Page once through every active subscription and collect the owning customer ids.
+
+    This costs roughly one API call per 100 active subscriptions, independent of how many
+    referred users there are.
+
+    Parameters:
+    logger (GcpLogger): Logger instance for logging operations.
+
+    Returns:
+    set: Stripe customer ids with at least one active subscription.
+
+    Raises:
+    stripe.error.StripeError: If a page cannot be fetched.
+    """
+    limiter = get_stripe_limiter()
+    active_customer_ids, params, pages = set(), dict(ACTIVE_SCAN_PARAMS), 1
+
+    while _add_active_page(active_customer_ids, params,
+                           call_with_backoff(stripe.Subscription.list, limiter, **params)):
+        pages += 1
+
+    logger.info(f"Found {len(active_customer_ids)} customers with active subscriptions in {pages} pages.")
+    return active_customer_ids
 
-    for index, row in df_users.iterrows():
-        customer_id = row['stripe_customer_id']
-        try:
-            # Check for any active subscriptions
-            time.sleep(0.1)
-            subscriptions = stripe.Subscription.list(
-                customer=customer_id
-            )
-
-            logger.debug(f"customer_id={customer_id}: Length subscriptions={len(subscriptions)}")
-
-            for data in subscriptions.data:
-                if data.get('status') == 'active':
-                    logger.debug(f"customer_id={customer_id}: {data.get('status')}")
-                    df_users.at[index, 'active'] = True
-                else:
-                    logger.debug(f"customer_id={customer_id}: {data.get('status')}")
-
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for customer {customer_id}: {str(e)}")
-            df_users.at[index, 'active'] = False
-        except Exception as e:
-            logger.error(f"Unexpected error checking subscription for customer {customer_id}: {str(e)}")
-            df_users.at[index, 'active'] = False
 
+async def fetch_active_customer_ids_async(logger):
+    """
+    Async counterpart of fetch_active_customer_ids. Pages are sequential, each needs the previous cursor.
+    """
+    limiter = get_stripe_limiter()
+    active_customer_ids, params, pages = set(), dict(ACTIVE_SCAN_PARAMS), 1
+
+    while _add_active_page(active_customer_ids, params,
+                           await call_with_backoff_async(stripe.Subscription.list_async, limiter, **params)):
+        pages += 1
+
+    logger.info(f"Found {len(active_customer_ids)} customers with active subscriptions in {pages} pages.")
+    return active_customer_ids
+
+
+def _customers(df_users):
+    """
+    Users with a Stripe customer, the only ones whose isactive can be checked.
+    """
+    return df_users.drop(columns=['referee']).dropna(subset=['stripe_customer_id'])
+
+
+def _with_scanned_statuses(df_users, active_customer_ids):
+    df_users['active'] = df_users['stripe_customer_id'].isin(active_customer_ids)
+    return df_users
+
+
+def _with_checked_statuses(df_users, results):
+    """
+    Attach the per-customer results. A customer whose subscriptions could not be checked is set
+    inactive, as the batch has always done.
+    """
+    df_users['active'] = [bool(active) for active in results]
+    return df_users
+
+
+def _write_statuses(session, df_users, logger):
     df_users = df_users.drop(columns=['stripe_customer_id'])
+    metrics.inc('rows_processed', len(df_users), stage='update_active_status')
 
     update_isactive_in_users(session, df_users, logger)
 
-    logger.info("Completed updating active subscription statuses.")
\ No newline at end of file
+    logger.info("Completed updating active subscription statuses.")
+
+
+def update_active_status(session, logger, context=None):
+
+    df_users = _customers(context.users(session) if context else fetch_users(session))
+
+    stripe.api_key = Config.STRIPE_SECRET_KEY
+
+    if Config.ACTIVE_STATUS_MODE == 'global_scan':
+        logger.info(f"Checking subscriptions for {len(df_users)} customers with a global active scan.")
+        df_users = _with_scanned_statuses(df_users, fetch_active_customer_ids(logger))
+    else:
+        logger.info(f"Checking subscriptions for {len(df_users)} customers with {Config.STRIPE_MAX_WORKERS} workers.")
+        results = check_active_subscriptions(df_users['stripe_customer_id'].tolist(), logger)
+        df_users = _with_checked_statuses(df_users, results)
+
+    _write_statuses(session, df_users, logger)
+
+
+async def update_active_status_async(session, logger, context=None):
+    """
+    Async counterpart of update_active_status: the per-customer checks all run on the event loop,
+    bounded by the run's Stripe concurrency limit, and the update goes through the AsyncSession.
+    """
+    from resources.async_clients import configure_async_stripe
+    from resources.scheduler import RunContext
+
+    context = context or RunContext()
+    limits = context.backend_limits()
+
+    df_users = _customers(await context.users_async(session))
+
+    configure_async_stripe()
+
+    if Config.ACTIVE_STATUS_MODE == 'global_scan':
+        logger.info(f"Checking subscriptions for {len(df_users)} customers with a global active scan.")
+        df_users = _with_scanned_statuses(df_users, await fetch_active_customer_ids_async(logger))
+    else:
+        logger.info(f"Checking subscriptions for {len(df_users)} customers with "
+                    f"{Config.ASYNC_STRIPE_CONCURRENCY} concurrent requests.")
+        limiter = get_stripe_limiter()
+        results = await asyncio.gather(*(
+            _has_active_subscription_async(customer_id, limiter, limits, logger)
+            for customer_id in df_users['stripe_customer_id']
+        ))
+        df_users = _with_checked_statuses(df_users, results)
+
+    async with limits.db:
+        await session.run_sync(_write_statuses, df_users, logger)
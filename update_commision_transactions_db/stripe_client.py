@@ -1,131 +1,441 @@
+import asyncio
+import calendar
+import time
 import stripe
 import pandas as pd
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import AsyncIterator, Iterable, Iterator, Optional
 
 from resources.config import Config
+from resources.rate_limiter import call_with_backoff, call_with_backoff_async, get_stripe_limiter
+from resources.schema import charge_frame
+from resources.stripe_cache import get_stripe_cache
 
-def get_data_as_df(logger, customer_id: Optional[str] = None) -> pd.DataFrame:
+# A charge matures 90 days after creation (see matures_on); a matured, settled charge never changes again
+MATURITY_SECONDS = 90 * 86400
+# Margin for the Stripe clock running ahead of ours when re-listing a customer without charges
+LISTING_CLOCK_SKEW = 300
+
+
+def _created_filter(created_after: Optional[datetime]) -> dict:
+    """
+    Build the Charge.list 'created' filter for an incremental sync.
+
+    The bound is inclusive so charges created in the same second as the watermark are not lost;
+    re-fetched rows are absorbed by the upsert.
+    """
+    if created_after is None or pd.isna(created_after):
+        return {}
+    return {'created': {'gte': calendar.timegm(pd.Timestamp(created_after).utctimetuple())}}
+
+
+def _charge_to_record(charge, customer_id: Optional[str], email: Optional[str]) -> dict:
+    """
+    Normalize a Stripe Charge object into the flat record stored in commission_transactions.
+    """
+    return {
+        'customer_id': customer_id,
+        'email': email,
+        'charge_id': charge.id,
+        'amount': charge.amount / 100.0,
+        'currency': charge.currency.upper(),
+        'status': charge.status,
+        'disputed': charge.disputed,
+        'dispute': charge.dispute,
+        'refunded': charge.refunded,
+        'created': pd.to_datetime(charge.created, unit='s'),
+        'description': charge.description,
+        'payment_method': charge.payment_method_details.card.brand if charge.payment_method_details else None,
+        'last4': charge.payment_method_details.card.last4 if charge.payment_method_details else None
+    }
+
+
+def _empty_record(customer_id: Optional[str], email: Optional[str]) -> dict:
+    """
+    Placeholder record for a customer without charges, so the customer still shows up in the frame.
+    """
+    return {
+        'customer_id': customer_id,
+        'email': email,
+        'charge_id': None,
+        'amount': None,
+        'currency': None,
+        'status': None,
+        'disputed': None,
+        'dispute': None,
+        'refunded': None,
+        'created': None,
+        'description': None,
+        'payment_method': None,
+        'last4': None
+    }
+
+
+def _charge_is_final(charge, now):
+    """
+    Whether a charge can be cached for good: matured, not disputed and no longer pending.
+    """
+    return charge.created + MATURITY_SECONDS <= now and not charge.disputed and charge.status != 'pending'
+
+
+def _plan_cached_listing(cache, customer_id, created_after_ts):
+    """
+    Work out which part of a customer's charge listing can be served from the cache.
+
+    The cached listing remembers (charge_id, created, final) for every charge of the customer. All
+    charges older than the oldest non-final one are final, so only charges created from that point
+    on are listed from Stripe again.
+
+    Returns:
+    tuple: (cached, kept, list_from, since) where cached are the final charges to serve from the cache,
+           kept the listing entries that stay valid, list_from the 'created' lower bound for Stripe and
+           since the lower bound the updated listing will cover.
+    """
+    entry = cache.get('customer_charges', customer_id)
+    if entry is None or entry['since'] > (created_after_ts or 0):
+        return [], [], created_after_ts, created_after_ts or 0
+
+    mutable = [created for _, created, final in entry['charges'] if not final]
+    if mutable:
+        list_from = min(mutable)
+    elif entry['charges']:
+        list_from = max(created for _, created, _ in entry['charges'])
+    else:
+        list_from = int(entry['listed_at']) - LISTING_CLOCK_SKEW
+    list_from = max(list_from, created_after_ts or 0)
+
+    kept = [item for item in entry['charges'] if item[1] < list_from]
+    cached = []
+    for charge_id, created, _ in kept:
+        if created_after_ts and created < created_after_ts:
+            continue
+        payload = cache.get('charge', charge_id)
+        if payload is None:
+            # Evicted, fall back to a full listing
+            return [], [], created_after_ts, created_after_ts or 0
+        cached.append(stripe.Charge.construct_from(payload, stripe.api_key))
+    cached.sort(key=lambda charge: charge.created, reverse=True)
+    return cached, kept, list_from, entry['since']
+
+
+def _store_listing(cache, customer_id, kept, listed, since, listed_at):
+    """
+    Cache the charges of a completed listing and the customer's updated listing entry.
+    """
+    entries = list(kept)
+    for charge in listed:
+        final = _charge_is_final(charge, listed_at)
+        cache.put('charge', charge.id, charge, immutable=final)
+        entries.append([charge.id, charge.created, final])
+    cache.put('customer_charges', customer_id, {'charges': entries, 'since': since, 'listed_at': listed_at})
+
+
+def _page_params(params):
+    """
+    Charge.list parameters: 100 charges a page, with the customer on every charge expanded so no
+    separate Customer call is needed for the email.
+    """
+    return {'limit': 100, 'expand': ['data.customer'], **params}
+
+
+def _advance(params, page):
+    """
+    Move the listing cursor past a page.
+
+    Returns:
+    bool: Whether there is another page to fetch.
+    """
+    if not page.has_more or not page.data:
+        return False
+    params['starting_after'] = page.data[-1].id
+    return True
+
+
+def _iter_charges(limiter, **params):
+    """
+    Page through Charge.list, each page going through the shared rate limiter.
+    """
+    params = _page_params(params)
+    while True:
+        page = call_with_backoff(stripe.Charge.list, limiter, **params)
+        yield from page.data
+        if not _advance(params, page):
+            return
+
+
+async def _iter_charges_async(limiter, **params):
+    """
+    Async counterpart of _iter_charges, built on Charge.list_async.
+    """
+    params = _page_params(params)
+    while True:
+        page = await call_with_backoff_async(stripe.Charge.list_async, limiter, **params)
+        for charge in page.data:
+            yield charge
+        if not _advance(params, page):
+            return
+
+
+def _customer_fields(charge):
+    """
+    Extract (customer_id, email) from a charge whose customer was expanded.
+    Guest charges have no customer and deleted customers have no email.
+    """
+    customer = charge.customer
+    if customer is None:
+        return None, None
+    if isinstance(customer, str):
+        return customer, None
+    return customer.id, customer.get('email')
+
+
+def _record(charge):
+    return _charge_to_record(charge, *_customer_fields(charge))
+
+
+class _ChargeListing:
+    """
+    One charge listing, with the part of a customer's listing served from the local cache when one
+    is configured. plan() and store() do the blocking cache I/O, the async path runs them on a
+    worker thread.
+    """
+
+    def __init__(self, customer_id, created_after, starting_after):
+        self.customer_id = customer_id
+        self.params = _created_filter(created_after)
+        if customer_id:
+            self.params['customer'] = customer_id
+        if starting_after:
+            self.params['starting_after'] = starting_after
+        # A customer's final charges are served from the local cache, when one is configured
+        self.cache = get_stripe_cache() if customer_id else None
+        self.listed_at = time.time()
+        self.cached, self.kept, self.since, self.listed = [], [], 0, []
+
+    def plan(self):
+        if not self.cache:
+            return
+        self.cached, self.kept, list_from, self.since = _plan_cached_listing(
+            self.cache, self.customer_id, self.params.get('created', {}).get('gte'))
+        if list_from:
+            self.params['created'] = {'gte': list_from}
+
+    def record(self, charge):
+        """
+        Normalize a charge listed from Stripe, remembering it for the cache.
+        """
+        if self.cache:
+            self.listed.append(charge)
+        return _record(charge)
+
+    def cached_records(self):
+        return [_record(charge) for charge in self.cached]
+
+    def store(self):
+        if self.cache:
+            _store_listing(self.cache, self.customer_id, self.kept, self.listed, self.since, self.listed_at)
+
+
+def _listing_failed(logger, customer_id, error):
+    """
+    Log a failed listing.
+
+    Returns:
+    Exception: The error to raise, a ValueError for an unknown customer.
+    """
+    if isinstance(error, stripe.error.InvalidRequestError) and customer_id:
+        logger.error(f"Invalid customer ID {customer_id}: {str(error)}")
+        return ValueError(f"Customer ID {customer_id} not found or invalid")
+    logger.error(f"Stripe API error: {str(error)}")
+    return error
+
+
+def iter_charge_records(logger, customer_id: Optional[str] = None, created_after: Optional[datetime] = None,
+                        limiter=None, starting_after: Optional[str] = None) -> Iterator[dict]:
+    """
+    Stream normalized charge records page by page, without holding the charge history in memory.
+
+    Args:
+        customer_id (str, optional): The Stripe customer ID. If None, scans charges for all customers.
+        created_after (datetime, optional): Only fetch charges created at or after this UTC time.
+        limiter (TokenBucket, optional): Shared rate limiter. A new one is created if omitted.
+        starting_after (str, optional): Charge ID to resume an interrupted account-wide scan after.
+
+    Yields:
+        dict: One normalized record per charge, newest first.
+
+    Raises:
+        stripe.error.StripeError: If the Stripe API call fails.
+        ValueError: If the customer_id is invalid or not found.
+    """
+    # Set Stripe API key (ensure Config.STRIPE_SECRET_KEY is defined)
+    stripe.api_key = Config.STRIPE_SECRET_KEY
+    limiter = limiter or get_stripe_limiter()
+    listing = _ChargeListing(customer_id, created_after, starting_after)
+    listing.plan()
+
+    try:
+        for charge in _iter_charges(limiter, **listing.params):
+            yield listing.record(charge)
+        yield from listing.cached_records()
+        listing.store()
+    except stripe.error.StripeError as e:
+        raise _listing_failed(logger, customer_id, e)
+
+
+async def iter_charge_records_async(logger, customer_id: Optional[str] = None,
+                                    created_after: Optional[datetime] = None, limiter=None,
+                                    starting_after: Optional[str] = None) -> AsyncIterator[dict]:
+    """
+    Async counterpart of iter_charge_records, with the same records and errors.
+    The caller sets up the Stripe client, see resources.async_clients.configure_async_stripe.
+    The blocking SQLite cache is read and written on a worker thread, off the event loop.
+    """
+    limiter = limiter or get_stripe_limiter()
+    listing = _ChargeListing(customer_id, created_after, starting_after)
+    if listing.cache:
+        await asyncio.to_thread(listing.plan)
+
+    try:
+        async for charge in _iter_charges_async(limiter, **listing.params):
+            yield listing.record(charge)
+        for record in listing.cached_records():
+            yield record
+        if listing.cache:
+            await asyncio.to_thread(listing.store)
+    except stripe.error.StripeError as e:
+        raise _listing_failed(logger, customer_id, e)
+
+
+def get_data_as_df(logger, customer_id: Optional[str] = None,
+                   created_after: Optional[datetime] = None) -> pd.DataFrame:
     """
     Retrieve payment-related data for a Stripe customer and return it as a DataFrame.
 
+    Both modes page through Charge.list with the customer expanded on each charge. Without a
+    customer_id this is a single account-wide scan instead of one Charge.list per customer.
+
     Args:
         customer_id (str, optional): The Stripe customer ID (e.g., 'cus_Sg6HZ5yF4go4v1').
-                                   If None, fetches data for all customers.
+                                   If None, fetches charges for all customers in a single scan.
+        created_after (datetime, optional): Only fetch charges created at or after this UTC time.
+                                            If None, the full charge history is fetched.
 
     Returns:
-        pandas.DataFrame: A DataFrame containing customer payment data, including pre-discount amount.
+        pandas.DataFrame: A DataFrame containing customer payment data, including pre-discount amount,
+                          typed with resources.schema.CHARGE_DTYPES.
 
     Raises:
         stripe.error.StripeError: If the Stripe API call fails.
         ValueError: If the customer_id is invalid or not found.
     """
     try:
-        # Set Stripe API key (ensure Config.STRIPE_SECRET_KEY is defined)
-        stripe.api_key = Config.STRIPE_SECRET_KEY
+        payment_data = list(iter_charge_records(logger, customer_id, created_after))
 
-        # Initialize an empty list to store payment data
-        payment_data = []
+        # If no charges, still include customer info
+        if customer_id and not payment_data:
+            payment_data.append(_empty_record(customer_id, None))
 
-        if customer_id:
-            # Fetch specific customer data
-            try:
-                customer = stripe.Customer.retrieve(customer_id)
-            except stripe.error.InvalidRequestError as e:
-                logger.error(f"Invalid customer ID {customer_id}: {str(e)}")
-                raise ValueError(f"Customer ID {customer_id} not found or invalid")
-
-            # Fetch charges (successful payments) for the customer
-            charges = stripe.Charge.list(customer=customer_id)
-
-            # Combine customer and payment data
-            for charge in charges.auto_paging_iter():
-                # Initialize pre-discount amount as the charge amount
-
-                payment_info = {
-                    'customer_id': customer.id,
-                    'email': customer.email,
-                    'charge_id': charge.id,
-                    'amount': charge.amount / 100.0,
-                    'currency': charge.currency.upper(),
-                    'status': charge.status,
-                    'disputed': charge.disputed,
-                    'dispute': charge.dispute,
-                    'refunded': charge.refunded,
-                    'created': pd.to_datetime(charge.created, unit='s'),
-                    'description': charge.description,
-                    'payment_method': charge.payment_method_details.card.brand if charge.payment_method_details else None,
-                    'last4': charge.payment_method_details.card.last4 if charge.payment_method_details else None
-                }
-                payment_data.append(payment_info)
-
-            # If no charges, still include customer info
-            if not payment_data:
-                payment_data.append({
-                    'customer_id': customer.id,
-                    'email': customer.email,
-                    'charge_id': None,
-                    'amount': None,
-                    'currency': None,
-                    'status': None,
-                    'disputed': None,
-                    'dispute': None,
-                    'refunded': None,
-                    'created': None,
-                    'description': None,
-                    'payment_method': None,
-                    'last4': None
-                })
-
-        else:
-            # Fetch all customers if no customer_id is provided
-            customers = stripe.Customer.list()
-            for customer in customers.auto_paging_iter():
-                # Fetch charges for each customer
-                charges = stripe.Charge.list(customer=customer.id)
-                for charge in charges.auto_paging_iter():
-
-                    payment_info = {
-                        'customer_id': customer.id,
-                        'email': customer.email,
-                        'charge_id': charge.id,
-                        'amount': charge.amount / 100.0,
-                        'currency': charge.currency.upper(),
-                        'status': charge.status,
-                        'disputed': charge.disputed,
-                        'dispute': charge.dispute,
-                        'refunded': charge.refunded,
-                        'created': pd.to_datetime(charge.created, unit='s'),
-                        'description': charge.description,
-                        'payment_method': charge.payment_method_details.card.brand if charge.payment_method_details else None,
-                        'last4': charge.payment_method_details.card.last4 if charge.payment_method_details else None
-                    }
-                    payment_data.append(payment_info)
-
-                # If no charges, still include customer info
-                if not charges.data:
-                    payment_data.append({
-                        'customer_id': customer.id,
-                        'email': customer.email,
-                        'charge_id': None,
-                        'amount': None,
-                        'currency': None,
-                        'status': None,
-                        'disputed': None,
-                        'dispute': None,
-                        'refunded': None,
-                        'created': None,
-                        'description': None,
-                        'payment_method': None,
-                        'last4': None
-                    })
-
-        # Convert to DataFrame
-        df = pd.DataFrame(payment_data)
+        # Convert to a DataFrame typed with the charge schema
+        df = charge_frame(payment_data, list(_empty_record(None, None).keys()))
         return df
 
-    except stripe.error.StripeError as e:
-        logger.error(f"Stripe API error: {str(e)}")
+    except (stripe.error.StripeError, ValueError):
         raise
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+
+def _charge_from_cache(payload):
+    return stripe.Charge.construct_from(payload, stripe.api_key)
+
+
+def _cache_charge(cache, charge_id, charge):
+    cache.put('charge', charge_id, charge, immutable=_charge_is_final(charge, time.time()))
+
+
+def _refresh_failed(logger, charge_id, error):
+    logger.error(f"Stripe API error refreshing charge {charge_id}: {str(error)}")
+    return None
+
+
+def _refreshed_record(charge, with_email=False):
+    """
+    Normalize a retrieved charge. Its customer may be expanded, e.g. when it was cached by a
+    listing, so only the id is taken from it, and the email only when asked for.
+    """
+    customer_id, email = _customer_fields(charge)
+    return _charge_to_record(charge, customer_id, email if with_email else None)
+
+
+def _refreshed_frame(retrieved):
+    """
+    Typed frame of the retrieved charges, leaving out the ones that could not be retrieved.
+    """
+    return charge_frame([record for record in retrieved if record is not None], list(_empty_record(None, None).keys()))
+
+
+def get_charges_by_id(logger, charge_ids: Iterable[str], max_workers: Optional[int] = None,
+                      expand_customer: bool = False) -> pd.DataFrame:
+    """
+    Re-fetch the current state of specific charges, concurrently and behind the shared rate limiter.
+
+    Charges that cannot be retrieved are logged and left out, so their stored rows stay untouched.
+
+    Args:
+        charge_ids (Iterable[str]): Stripe charge IDs to refresh.
+        max_workers (int, optional): Worker pool size. Defaults to Config.STRIPE_MAX_WORKERS.
+        expand_customer (bool): Retrieve each charge with its customer expanded to fill in the email.
+                                Always goes to Stripe, and refreshes the cached charge.
+
+    Returns:
+        pandas.DataFrame: One record per retrieved charge. The customer_id column is taken from the
+                          charge, the email column is left empty for the caller to fill in unless
+                          expand_customer is set.
+    """
+    stripe.api_key = Config.STRIPE_SECRET_KEY
+    limiter = get_stripe_limiter()
+    cache = get_stripe_cache()
+
+    def retrieve(charge_id):
+        try:
+            payload = cache.get('charge', charge_id) if cache and not expand_customer else None
+            if payload is not None:
+                charge = _charge_from_cache(payload)
+            else:
+                expand = {'expand': ['customer']} if expand_customer else {}
+                charge = call_with_backoff(stripe.Charge.retrieve, limiter, charge_id, **expand)
+                if cache:
+                    _cache_charge(cache, charge_id, charge)
+            return _refreshed_record(charge, with_email=expand_customer)
+        except stripe.error.StripeError as e:
+            return _refresh_failed(logger, charge_id, e)
+
+    with ThreadPoolExecutor(max_workers=max_workers or Config.STRIPE_MAX_WORKERS) as executor:
+        return _refreshed_frame(list(executor.map(retrieve, charge_ids)))
+
+
+async def get_charges_by_id_async(logger, charge_ids: Iterable[str], limits) -> pd.DataFrame:
+    """
+    Async counterpart of get_charges_by_id, with at most limits.stripe retrievals in flight.
+    """
+    limiter = get_stripe_limiter()
+    cache = get_stripe_cache()
+
+    async def retrieve(charge_id):
+        try:
+            payload = await asyncio.to_thread(cache.get, 'charge', charge_id) if cache else None
+            if payload is not None:
+                charge = _charge_from_cache(payload)
+            else:
+                async with limits.stripe:
+                    charge = await call_with_backoff_async(stripe.Charge.retrieve_async, limiter, charge_id)
+                if cache:
+                    await asyncio.to_thread(_cache_charge, cache, charge_id, charge)
+            return _refreshed_record(charge)
+        except stripe.error.StripeError as e:
+            return _refresh_failed(logger, charge_id, e)
+
+    return _refreshed_frame(await asyncio.gather(*(retrieve(charge_id) for charge_id in charge_ids)))
@@ -1,65 +1,616 @@
+import asyncio
+
 import pandas as pd
 
-from resources.db import write_df_to_CommissionTransactions, fetch_commission_rates, fetch_users
-from update_commision_transactions_db.stripe_client import get_data_as_df
+from resources import metrics
+from resources.checkpoint import RETRY_PHASE, StageCheckpoint, stage_key
+from resources.config import Config
+from resources.db import (write_df_to_CommissionTransactions, fetch_commission_rates, fetch_users,
+                          fetch_sync_state, update_sync_state, fetch_charges_to_reverify,
+                          fetch_commission_fingerprints)
+from resources.rate_limiter import get_stripe_limiter
+from resources.schema import charge_frame
+from resources.sharding import SINGLE_SHARD, filter_frame
+from update_commision_transactions_db.stripe_client import (iter_charge_records, get_charges_by_id,
+                                                            iter_charge_records_async, get_charges_by_id_async)
 
+# Sync state key used by the account-wide charge scan
+GLOBAL_SYNC_KEY = '__global__'
 
-def update_commision_transactions_df(session, logger):
+STAGE_NAME = 'update_commision_transactions_df'
+REVERIFY_PHASE = 'reverify'
+CUSTOMERS_PHASE = 'customers'
+BACKFILL_PHASE = 'backfill'
+SCAN_PHASE = 'scan'
+# Checkpointed phases of the charge sync per Config.CHARGE_SYNC_MODE, in order
+PHASES = {
+    'per_customer': (REVERIFY_PHASE, CUSTOMERS_PHASE, RETRY_PHASE),
+    'global_scan': (REVERIFY_PHASE, BACKFILL_PHASE, RETRY_PHASE, SCAN_PHASE),
+}
 
-    logger.info("Starting update of commission transactions.")
+CHARGE_COLUMNS = [
+    'user_id', 'referee', 'customer_id', 'email', 'charge_id', 'amount', 'currency', 'status',
+    'disputed', 'dispute', 'refunded', 'created', 'description', 'payment_method', 'last4'
+]
 
-    df_users = fetch_users(session)
-    logger.debug(f"Fetched {len(df_users)} users.")
 
-    commission_df = fetch_commission_rates(session)
-    logger.debug(f"Fetched {len(commission_df)} commission rates.")
+def _global_sync_key(shard):
+    """
+    Sync state key of the account-wide scan. Each shard of a sharded run keeps its own watermark,
+    so the shards never write the same row and a change of shard count starts from scratch.
+    """
+    if shard.count == 1:
+        return GLOBAL_SYNC_KEY
+    return f"{GLOBAL_SYNC_KEY}:{shard.index}/{shard.count}"
+
+
+def _newest_charge(records):
+    """
+    Find the newest charge in a list of records.
+
+    Returns:
+    tuple: (created, charge_id) of the newest charge, or None if there are no charges.
+    """
+    charges = [record for record in records if record['charge_id']]
+    if not charges:
+        return None
+    newest = max(charges, key=lambda record: record['created'])
+    return newest['created'], newest['charge_id']
+
+
+def _referred_users(df_users):
+    """
+    Referred users with a Stripe customer, ordered by customer id so a checkpoint can tell which ones are done.
+    """
+    df_users = df_users[df_users['stripe_customer_id'].notna() & (df_users['stripe_customer_id'] != '')]
+    return list(df_users.sort_values(['stripe_customer_id', 'user_id']).itertuples(index=False))
+
+
+def _scan_newest(checkpoint):
+    """
+    Newest charge seen so far by an interrupted global scan, kept in its checkpoint.
+    """
+    newest = checkpoint.state.get('newest')
+    return (pd.Timestamp(newest[0]), newest[1]) if newest else None
+
+
+def _customer_batch(logger, user, records, synced_until=None):
+    """
+    Turn the fetched charges of one referred customer into a batch.
+
+    The customer's watermark is emitted together with its last records, so it can only be
+    persisted once all of that customer's charges are committed. A customer without charges only
+    gets a watermark when synced_until is given, see _ChargeSyncRun.customers.
 
-    columns = [
-        'user_id', 'referee', 'customer_id', 'email', 'charge_id', 'amount', 'currency', 'status',
-        'disputed', 'dispute', 'refunded', 'created', 'description', 'payment_method', 'last4'
-    ]
-    referals_df = pd.DataFrame(columns=columns)
+    Returns:
+    tuple: (records, watermarks, customer_id, failed) for the customer.
+    """
+    customer_id = user.stripe_customer_id
+    records = [{**record, 'user_id': user.user_id, 'referee': user.referee} for record in records]
+    logger.debug("Processed payments for user %s with %s entries.", user.user_id, len(records))
+    newest = _newest_charge(records) or ((synced_until, None) if synced_until else None)
+    return records, ({customer_id: newest} if newest else {}), customer_id, False
 
-    for index, user_row in df_users.iterrows():
+
+def _failed_customer_batch(logger, user, error):
+    """
+    Batch reporting a customer whose charges could not be fetched, so the stage carries on with the next one.
+    """
+    logger.error(f"Error fetching payments for user {user.user_id}: {str(error)}")
+    return [], {}, user.stripe_customer_id, True
+
+
+def _iter_per_customer(logger, users, sync_state, limiter, synced_until=None):
+    """
+    Stream the charges of the given referred users, one Stripe customer at a time.
+
+    Yields:
+    tuple: (records, watermarks, customer_id, failed) for one customer, see _customer_batch.
+    """
+    for user in users:
+        customer_id = user.stripe_customer_id
         try:
-            if user_row['stripe_customer_id']:
-                df_payments = get_data_as_df(logger, user_row['stripe_customer_id'])
-                df_payments['user_id'] = user_row['user_id']
-                df_payments['referee'] = user_row['referee']
-                referals_df = pd.concat([referals_df, df_payments], ignore_index=True)
-                logger.debug(f"Processed payments for user {user_row['user_id']} with {len(df_payments)} entries.")
+            records = list(iter_charge_records(logger, customer_id, sync_state.get(customer_id), limiter))
         except Exception as e:
-            logger.error(f"Error fetching payments for user {user_row.get('user_id', 'unknown')}: {str(e)}")
-            raise ValueError(f"Error fetching users: {str(e)}")
+            yield _failed_customer_batch(logger, user, e)
+            continue
+        yield _customer_batch(logger, user, records, synced_until)
+
+
+class _GlobalScan:
+    """
+    Bookkeeping of an account-wide charge scan, keeping the charges of referred users.
+
+    Every charge becomes a batch keyed by its id, the cursor an interrupted scan resumes after.
+    The newest charge is kept in the checkpoint state, and the global watermark is only emitted
+    by the final batch, once the scan has finished. A scan of the full history also marks every
+    referred customer as synced, so only customers referred later are back-filled (see
+    _ChargeSyncRun.customers).
+    """
+
+    def __init__(self, logger, df_users, checkpoint, sync_key, full_history=False):
+        self.logger = logger
+        self.checkpoint = checkpoint
+        self.sync_key = sync_key
+        self.full_history = full_history
+        self.referred = {
+            user.stripe_customer_id: (user.user_id, user.referee)
+            for user in df_users.itertuples(index=False)
+            if user.stripe_customer_id and pd.notna(user.stripe_customer_id)
+        }
+        self.starting_after = checkpoint.last_key if checkpoint.phase == SCAN_PHASE else None
+        self.newest = _scan_newest(checkpoint)
+        self.scanned = 0
+
+    def batch(self, record):
+        """
+        Returns:
+        tuple: (records, watermarks, charge_id, failed) for one scanned charge.
+        """
+        self.scanned += 1
+        if self.newest is None or record['created'] > self.newest[0]:
+            self.newest = (record['created'], record['charge_id'])
+            self.checkpoint.state['newest'] = [self.newest[0].isoformat(), self.newest[1]]
+        user = self.referred.get(record['customer_id'])
+        records = [{**record, 'user_id': user[0], 'referee': user[1]}] if user else []
+        return records, {}, record['charge_id'], False
+
+    def final_batch(self):
+        """
+        Returns:
+        tuple: A watermark-only batch carrying the newest charge of the scan.
+        """
+        self.logger.info(f"Scanned {self.scanned} charges across all customers"
+                         f"{' after the checkpoint' if self.starting_after else ''}.")
+        if not self.newest:
+            return [], {}, None, False
+        watermarks = {customer_id: (self.newest[0], None) for customer_id in self.referred} if self.full_history else {}
+        return [], {**watermarks, self.sync_key: self.newest}, None, False
+
+
+def _iter_global_scan(logger, df_users, created_after, limiter, checkpoint, sync_key=GLOBAL_SYNC_KEY):
+    """
+    Stream every charge in the account with a single paged scan, see _GlobalScan.
+
+    Yields:
+    tuple: (records, watermarks, charge_id, failed), one charge at a time and a final watermark-only item.
+    """
+    scan = _GlobalScan(logger, df_users, checkpoint, sync_key, full_history=created_after is None)
+    for record in iter_charge_records(logger, created_after=created_after, limiter=limiter,
+                                      starting_after=scan.starting_after):
+        yield scan.batch(record)
+    yield scan.final_batch()
+
 
-    logger.info(f"Collected {len(referals_df)} referral payments entries.")
+def _reverify_batches(reverify_df, logger, checkpoint, shard):
+    """
+    Split the stored charges that have not matured yet, are disputed or are still pending into
+    re-verification batches.
 
+    Matured charges are frozen and never leave the database. Charges are refreshed in charge id
+    order, so a resumed run skips the batches that were already committed.
+
+    Returns:
+    list: DataFrame batches of at most Config.REVERIFY_BATCH_SIZE charges.
+    """
+    reverify_df = filter_frame(reverify_df, shard).sort_values('charge_id')
+    reverify_df = reverify_df[[checkpoint.pending(REVERIFY_PHASE, charge_id) for charge_id in reverify_df['charge_id']]]
+    logger.info(f"Re-verifying {len(reverify_df)} unmatured, disputed or pending charges.")
+    return [reverify_df.iloc[start:start + Config.REVERIFY_BATCH_SIZE]
+            for start in range(0, len(reverify_df), Config.REVERIFY_BATCH_SIZE)]
+
+
+def _reverified_batch(logger, batch, df_charges):
+    """
+    Merge the refreshed charges into their stored rows. Refreshed charges never move a watermark.
+
+    Returns:
+    tuple: (records, watermarks, last charge_id, failed) for the batch.
+    """
+    refreshed = batch.merge(df_charges.drop(columns=['customer_id', 'email']), on='charge_id')
+    logger.debug("Re-verified batch of %s charges.", len(batch))
+    return refreshed.to_dict('records'), {}, batch['charge_id'].iloc[-1], False
+
+
+def _iter_reverified(session, logger, checkpoint, shard=SINGLE_SHARD):
+    """
+    Refresh the still-mutable stored charges, see _reverify_batches.
+
+    Yields:
+    tuple: (records, watermarks, last charge_id, failed) per re-verification batch.
+    """
+    for batch in _reverify_batches(fetch_charges_to_reverify(session), logger, checkpoint, shard):
+        yield _reverified_batch(logger, batch, get_charges_by_id(logger, batch['charge_id'].tolist()))
+
+
+class _Chunker:
+    """
+    Regroup (records, watermarks, key, failed) batches into chunks of roughly chunk_size records,
+    or of chunk_size batches when the batches carry few records (e.g. a scan over unreferred charges).
+
+    Batches are never split, so a watermark always travels with the records it covers. Chunks are
+    (records, watermarks, last_key, failed_keys) tuples.
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self._reset()
+
+    def _reset(self):
+        self.records, self.watermarks, self.last_key, self.failed, self.count = [], {}, None, [], 0
+
+    def _take(self):
+        chunk = (self.records, self.watermarks, self.last_key, self.failed)
+        self._reset()
+        return chunk
+
+    def add(self, batch):
+        """
+        Add a batch. Returns the chunk once it is full, otherwise None.
+        """
+        records, watermarks, key, failed = batch
+        self.records.extend(records)
+        self.watermarks.update(watermarks)
+        self.last_key = key if key is not None else self.last_key
+        if failed:
+            self.failed.append(key)
+        self.count += 1
+        if len(self.records) >= self.chunk_size or self.count >= self.chunk_size:
+            return self._take()
+        return None
+
+    def flush(self):
+        """
+        Returns the last, partial chunk, or None when no batch is left.
+        """
+        return self._take() if self.count else None
+
+
+def _iter_chunks(batches, chunk_size):
+    """
+    Yields:
+    tuple: (records, watermarks, last_key, failed_keys) per chunk, see _Chunker.
+    """
+    chunker = _Chunker(chunk_size)
+    for batch in batches:
+        chunk = chunker.add(batch)
+        if chunk:
+            yield chunk
+    chunk = chunker.flush()
+    if chunk:
+        yield chunk
+
+
+def _compute_commissions(referals_df, commission_df, default_rate=None):
+    """
+    Add matures_on and commission_amount to a chunk of referral charges.
+
+    The referee's rate is joined in with one hash lookup instead of masking the chunk once per
+    referrer. Disputed, refunded and non-succeeded charges earn 0. Referees without a Referrals
+    row get default_rate (Config.DEFAULT_COMMISSION_RATE, 0.0 unless configured), or no
+    commission (NULL) when default_rate is None.
+    """
     referals_df['matures_on'] = referals_df['created'] + pd.Timedelta(days=90)
-    logger.debug("Added 'matures_on' column to referrals DataFrame.")
 
-    for index, user_row in commission_df.iterrows():
-        # Create a mask for rows where referee matches user_row['user_id']
-        mask = referals_df['referee'] == user_row['user_id']
+    # A categorical referee would map to a categorical of rates
+    rates = referals_df['referee'].map(commission_df.set_index('user_id')['commission']).astype(float)
+    if default_rate is not None:
+        # A charge without a referee has no referrer to pay and keeps no commission
+        rates = rates.mask(rates.isna() & referals_df['referee'].notna(), default_rate)
+
+    referals_df['disputed'] = referals_df['disputed'].fillna(False)
+    referals_df['refunded'] = referals_df['refunded'].fillna(False)
+
+    not_payable = (referals_df['dispute'].notna() | referals_df['refunded'] |
+                   (referals_df['status'] != 'succeeded'))
+    commission = (referals_df['amount'] * rates).mask(not_payable, 0.0)
+    referals_df['commission_amount'] = commission.where(rates.notna())
+    return referals_df[referals_df['charge_id'].notna()]
+
+
+def write_charge_records(session, records, commission_df, fingerprints=None):
+    """
+    Compute the commissions of a list of charge records (CHARGE_COLUMNS) and upsert them.
+    With a FingerprintIndex, records identical to the stored rows are skipped before the write.
+
+    Returns:
+    dict: The writer's {'inserted', 'updated', 'unchanged', 'errors'} counters.
+    """
+    referals_df = charge_frame(records, CHARGE_COLUMNS)
+    referals_df = _compute_commissions(referals_df, commission_df, Config.DEFAULT_COMMISSION_RATE)
+    return write_df_to_CommissionTransactions(session, referals_df, fingerprints=fingerprints)
+
+
+def _load_fingerprints(session, logger):
+    fingerprints = fetch_commission_fingerprints(session)
+    logger.info(f"Loaded {len(fingerprints)} stored row fingerprints ({fingerprints.nbytes / 1e6:.1f} MB).")
+    return fingerprints
 
-        # Further filter to exclude rows with disputes or refunds
-        valid_commission_mask = mask & (referals_df['dispute'].isna()) & (referals_df['refunded'] != True)
 
-        referals_df.loc[valid_commission_mask, 'commission_amount'] = (
-                referals_df.loc[valid_commission_mask, 'amount'] * user_row['commission']
-        )
+def _add_write_result(totals, logger, records, result):
+    for key in ('inserted', 'updated', 'unchanged', 'errors'):
+        totals[key] += result[key]
+    totals['collected'] += len(records)
+    metrics.inc('rows_processed', len(records), stage=STAGE_NAME)
+    metrics.inc('rows_unchanged', result['unchanged'], stage=STAGE_NAME)
+    logger.debug("Wrote chunk of %s charges: %s", len(records), result)
 
-        # Set commission_amount to 0.0 for disputed or refunded rows in the matched subset
-        invalid_commission_mask = mask & ((referals_df['dispute'].notna()) | (referals_df['refunded'] == True) |
-                    (referals_df['status'] != 'succeeded'))
-        referals_df.loc[invalid_commission_mask, 'commission_amount'] = 0.0
 
-        logger.debug(f"Calculated commissions for referee {user_row['user_id']}.")
+def _new_checkpoint(shard, run_id, full_resync):
+    mode = Config.CHARGE_SYNC_MODE
+    return StageCheckpoint(stage_key(STAGE_NAME, shard), PHASES[mode], run_id,
+                           params={'mode': mode, 'full_resync': full_resync})
+
+
+def _finish(logger, checkpoint, totals):
+    """
+    Report the run once every phase is committed.
+
+    Raises:
+    ValueError: If some customers still failed after their retry.
+    """
+    write_summary = {key: totals[key] for key in ('inserted', 'updated', 'unchanged', 'errors')}
+    logger.info(f"Collected {totals['collected']} referral payments entries, write summary: {write_summary}.")
+    logger.info(f"Advanced charge sync watermarks for {totals['synced']} keys.")
+    failed = sorted(checkpoint.retry_keys)
+    if failed:
+        metrics.inc('customers_failed', len(failed), stage=STAGE_NAME)
+        raise ValueError(f"Charges of {len(failed)} customers could not be fetched after a retry: {failed[:20]}")
+    logger.info("Completed update of commission transactions.")
+
+
+class _ChargeSyncRun:
+    """
+    State of one charge sync shared by the sync and async drivers: the inputs, the checkpoint,
+    the stored fingerprints and the counters.
+
+    The methods taking a session are plain sync code; the async driver calls them through
+    AsyncSession.run_sync, so the bookkeeping and the write/commit step exist only once.
+    """
+
+    def __init__(self, logger, full_resync, shard, run_id, df_users, commission_df):
+        self.logger = logger
+        self.full_resync = Config.FULL_RESYNC if full_resync is None else full_resync
+        self.shard = shard
+        self.df_users = df_users
+        self.commission_df = commission_df
+        self.checkpoint = _new_checkpoint(shard, run_id, self.full_resync)
+        self.sync_state = {}
+        self.fingerprints = None
+        self.totals = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'errors': 0, 'collected': 0, 'synced': 0}
+
+    def prepare(self, session):
+        """
+        Load the watermarks, the checkpoint to resume from and the stored row fingerprints.
+        """
+        self.sync_state = {} if self.full_resync else fetch_sync_state(session)
+        self.logger.info(f"Charge sync mode: {'full resync' if self.full_resync else 'incremental'} "
+                         f"({len(self.sync_state)} customers with a watermark).")
+        self.checkpoint.load(session, self.logger)
+        self.fingerprints = _load_fingerprints(session, self.logger)
+
+    def phases(self):
+        """
+        Phases to run, in order. The full resync refreshes every charge anyway, otherwise the
+        still-mutable window is re-verified first.
+        """
+        phases = PHASES[Config.CHARGE_SYNC_MODE]
+        return [phase for phase in phases if phase != REVERIFY_PHASE] if self.full_resync else list(phases)
+
+    @property
+    def scan_key(self):
+        return _global_sync_key(self.shard)
+
+    def customers(self, phase):
+        """
+        Referred users the customers, backfill or retry phase still has to fetch.
+
+        The account-wide scan only lists charges created after its watermark, so the earlier charges
+        of a customer referred after a scan would never be stored. The backfill phase lists the full
+        history of every referred customer without a watermark of its own, once there is a scan
+        watermark; the backfill and the full-history scan then mark the customer, see synced_until.
+        """
+        users = _referred_users(self.df_users)
+        if phase == CUSTOMERS_PHASE:
+            return [user for user in users if self.checkpoint.pending(CUSTOMERS_PHASE, user.stripe_customer_id)]
+
+        if phase == BACKFILL_PHASE:
+            if self.scan_key not in self.sync_state:
+                return []
+            backfill = [user for user in users if user.stripe_customer_id not in self.sync_state
+                        and self.checkpoint.pending(BACKFILL_PHASE, user.stripe_customer_id)]
+            if backfill:
+                self.logger.info(f"Back-filling the charge history of {len(backfill)} newly referred customers.")
+            return backfill
+
+        retries = [user for user in users if user.stripe_customer_id in self.checkpoint.retry_keys
+                   and self.checkpoint.pending(RETRY_PHASE, user.stripe_customer_id)]
+        if retries:
+            self.logger.info(f"Retrying {len(retries)} customers whose charges could not be fetched.")
+        return retries
+
+    def synced_until(self, phase):
+        """
+        Watermark of a back-filled customer without charges: the scan watermark the backfill ran under.
+        """
+        if Config.CHARGE_SYNC_MODE != 'global_scan' or phase == SCAN_PHASE:
+            return None
+        return self.sync_state.get(self.scan_key)
+
+    def commit_chunk(self, session, phase, chunk):
+        """
+        Commit one chunk of a phase: its changed charges, then its watermarks, then the checkpoint,
+        so an interrupted run resumes after the last committed chunk.
+        """
+        records, watermarks, last_key, failed = chunk
+        if records:
+            result = write_charge_records(session, records, self.commission_df, self.fingerprints)
+            _add_write_result(self.totals, self.logger, records, result)
+
+        # Only advance the watermarks once the charges they cover are committed
+        self.totals['synced'] += update_sync_state(session, watermarks)
+        self.checkpoint.commit(session, phase, last_key, failed)
+
+    def complete(self, session):
+        """
+        Every phase is committed: the next run starts over, failed customers kept their old watermark.
+
+        Raises:
+        ValueError: If some customers still failed after their retry.
+        """
+        self.checkpoint.clear(session)
+        _finish(self.logger, self.checkpoint, self.totals)
+
+
+def _phase_batches(run, session, phase, limiter):
+    if phase == REVERIFY_PHASE:
+        return _iter_reverified(session, run.logger, run.checkpoint, run.shard)
+    if phase == SCAN_PHASE:
+        return _iter_global_scan(run.logger, run.df_users, run.sync_state.get(run.scan_key), limiter,
+                                 run.checkpoint, run.scan_key)
+    return _iter_per_customer(run.logger, run.customers(phase), run.sync_state, limiter, run.synced_until(phase))
+
+
+def update_commision_transactions_df(session, logger, full_resync=None, context=None):
+    """
+    Sync referred users' Stripe charges into commission_transactions as a streaming pipeline:
+    Stripe pages -> normalized records -> commission computation -> bulk writer.
+
+    Memory is bounded by Config.CHARGE_SYNC_CHUNK_SIZE records (plus one customer's new charges in
+    per-customer mode), and every chunk is committed as soon as it is produced, followed by the
+    stage's checkpoint. An interrupted or failed run resumes from the checkpoint instead of starting
+    over. Customers whose charges cannot be fetched are retried once after all the others instead
+    of aborting the stage.
+
+    Raises:
+    ValueError: If some customers still failed after their retry. Every other charge is committed by then.
+    """
+    logger.info("Starting update of commission transactions.")
+
+    df_users = context.users(session) if context else fetch_users(session)
+    logger.debug(f"Fetched {len(df_users)} users.")
+
+    commission_df = context.commission_rates(session) if context else fetch_commission_rates(session)
+    logger.debug(f"Fetched {len(commission_df)} commission rates.")
+
+    run = _ChargeSyncRun(logger, full_resync, context.shard if context else SINGLE_SHARD,
+                         context.run_id if context else None, df_users, commission_df)
+    run.prepare(session)
+    limiter = get_stripe_limiter()
+
+    for phase in run.phases():
+        for chunk in _iter_chunks(_phase_batches(run, session, phase, limiter), Config.CHARGE_SYNC_CHUNK_SIZE):
+            run.commit_chunk(session, phase, chunk)
+
+    run.complete(session)
+
+
+async def _fetch_customer_async(logger, user, created_after, limiter, limits, synced_until=None):
+    """
+    Fetch one referred customer's new charges, holding one of the limits.stripe slots.
+
+    Returns:
+    tuple: (records, watermarks, customer_id, failed) for the customer, see _customer_batch.
+    """
+    try:
+        async with limits.stripe:
+            records = [record async for record in
+                       iter_charge_records_async(logger, user.stripe_customer_id, created_after, limiter)]
+    except Exception as e:
+        return _failed_customer_batch(logger, user, e)
+    return _customer_batch(logger, user, records, synced_until)
+
+
+async def _aiter_per_customer(logger, users, sync_state, limiter, limits, synced_until=None):
+    """
+    Async counterpart of _iter_per_customer. Customers are fetched concurrently, a window of a few
+    times the Stripe concurrency limit at a time, and yielded in customer order.
+    """
+    window = Config.ASYNC_STRIPE_CONCURRENCY * 4
+    for start in range(0, len(users), window):
+        batches = await asyncio.gather(*(
+            _fetch_customer_async(logger, user, sync_state.get(user.stripe_customer_id), limiter, limits, synced_until)
+            for user in users[start:start + window]
+        ))
+        for batch in batches:
+            yield batch
+
+
+async def _aiter_global_scan(logger, df_users, created_after, limiter, checkpoint, sync_key=GLOBAL_SYNC_KEY):
+    """
+    Async counterpart of _iter_global_scan. The scan itself is sequential, each page needs the previous cursor.
+    """
+    scan = _GlobalScan(logger, df_users, checkpoint, sync_key, full_history=created_after is None)
+    async for record in iter_charge_records_async(logger, created_after=created_after, limiter=limiter,
+                                                  starting_after=scan.starting_after):
+        yield scan.batch(record)
+    yield scan.final_batch()
+
+
+async def _aiter_reverified(session, logger, limits, checkpoint, shard=SINGLE_SHARD):
+    """
+    Async counterpart of _iter_reverified, with each batch retrieved concurrently.
+    """
+    async with limits.db:
+        reverify_df = await session.run_sync(fetch_charges_to_reverify)
+    for batch in _reverify_batches(reverify_df, logger, checkpoint, shard):
+        df_charges = await get_charges_by_id_async(logger, batch['charge_id'].tolist(), limits)
+        yield _reverified_batch(logger, batch, df_charges)
+
+
+async def _aiter_chunks(batches, chunk_size):
+    """
+    Async counterpart of _iter_chunks.
+    """
+    chunker = _Chunker(chunk_size)
+    async for batch in batches:
+        chunk = chunker.add(batch)
+        if chunk:
+            yield chunk
+    chunk = chunker.flush()
+    if chunk:
+        yield chunk
+
+
+def _aphase_batches(run, session, phase, limiter, limits):
+    if phase == REVERIFY_PHASE:
+        return _aiter_reverified(session, run.logger, limits, run.checkpoint, run.shard)
+    if phase == SCAN_PHASE:
+        return _aiter_global_scan(run.logger, run.df_users, run.sync_state.get(run.scan_key), limiter,
+                                  run.checkpoint, run.scan_key)
+    return _aiter_per_customer(run.logger, run.customers(phase), run.sync_state, limiter, limits,
+                               run.synced_until(phase))
+
+
+async def update_commision_transactions_df_async(session, logger, full_resync=None, context=None):
+    """
+    Async counterpart of update_commision_transactions_df: the same checkpointed pipeline, with the
+    Stripe calls made concurrently on the event loop and the writes going through the AsyncSession.
+    """
+    from resources.async_clients import configure_async_stripe
+    from resources.scheduler import RunContext
+
+    logger.info("Starting update of commission transactions.")
+    context = context or RunContext()
+    limits = context.backend_limits()
+
+    df_users = await context.users_async(session)
+    logger.debug(f"Fetched {len(df_users)} users.")
+
+    commission_df = await context.commission_rates_async(session)
+    logger.debug(f"Fetched {len(commission_df)} commission rates.")
 
-    referals_df['disputed'] = referals_df['disputed'].astype(bool)
-    referals_df['refunded'] = referals_df['refunded'].astype(bool)
-    referals_df = referals_df[referals_df['charge_id'].notna()]
+    run = _ChargeSyncRun(logger, full_resync, context.shard, context.run_id, df_users, commission_df)
+    async with limits.db:
+        await session.run_sync(run.prepare)
+    configure_async_stripe()
+    limiter = get_stripe_limiter()
 
-    logger.info("Writing updated DataFrame to CommissionTransactions.")
-    write_df_to_CommissionTransactions(session, referals_df)
+    for phase in run.phases():
+        async for chunk in _aiter_chunks(_aphase_batches(run, session, phase, limiter, limits),
+                                         Config.CHARGE_SYNC_CHUNK_SIZE):
+            async with limits.db:
+                await session.run_sync(run.commit_chunk, phase, chunk)
 
-    logger.info("Completed update of commission transactions.")
\ No newline at end of file
+    async with limits.db:
+        await session.run_sync(run.complete)
@@ -1,19 +1,172 @@
+import hashlib
 import json
 import logging
-import uuid
-import numpy as np
 import redis
-from resources.db import read_CommissionTransactions_to_df
+from resources import metrics
+from resources.db import fetch_commission_totals
 from resources.config import Config
 
 
-def update_redis(session, logger: logging.Logger):
+def _summary_payload(total_commissions, pending_commissions):
     """
-    Update Redis with aggregated commission data after reading and modifying the commission transactions DataFrame.
+    Serialize one referee's commission summary exactly as it is stored in Redis.
+    """
+    data = {
+        'total_commissions_paid_out': total_commissions - pending_commissions,
+        'pending_commissions': pending_commissions,
+        'total_commissions': total_commissions
+    }
+    return json.dumps(data)
+
+
+def _fingerprint(payload):
+    """
+    Short, stable fingerprint of a summary payload.
+    """
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def _plan_publish(stored_fingerprints, totals_df, prune, force):
+    """
+    Compare the summaries in totals_df with the stored fingerprints.
+
+    Returns:
+    tuple: (changed, stale, unchanged) where changed is a list of (referee, payload, fingerprint) to write,
+           stale a list of referees to delete and unchanged the number of summaries left as they are.
+    """
+    changed = []
+    unchanged = 0
+    for referee, total_commissions, pending_commissions in totals_df.itertuples(index=False):
+        payload = _summary_payload(total_commissions, pending_commissions)
+        fingerprint = _fingerprint(payload)
+        if not force and stored_fingerprints.get(referee) == fingerprint:
+            unchanged += 1
+        else:
+            changed.append((referee, payload, fingerprint))
+
+    stale = []
+    if prune:
+        stale = list(set(stored_fingerprints) - set(totals_df['referee']))
+    return changed, stale, unchanged
+
+
+def _publish_batches(r, changed, stale):
+    """
+    Queue the writes and deletions on non-transactional pipelines, one pipeline per Config.REDIS_BATCH_SIZE keys.
+    Commands are counted once the caller has executed the pipeline and resumes the generator.
+
+    Yields:
+    tuple: (pipeline, counter, count) for the caller to execute, sync or async.
+    """
+    fingerprint_key = Config.REDIS_FINGERPRINT_KEY
+    batch_size = Config.REDIS_BATCH_SIZE
+
+    for start in range(0, len(changed), batch_size):
+        batch = changed[start:start + batch_size]
+        pipe = r.pipeline(transaction=False)
+        for referee, payload, fingerprint in batch:
+            pipe.set(referee, payload)
+        pipe.hset(fingerprint_key, mapping={referee: fingerprint for referee, _, fingerprint in batch})
+        yield pipe, 'written', len(batch)
+        metrics.inc('redis_commands', len(batch), command='set')
+        metrics.inc('redis_commands', command='hset')
+
+    for start in range(0, len(stale), batch_size):
+        batch = stale[start:start + batch_size]
+        pipe = r.pipeline(transaction=False)
+        pipe.delete(*batch)
+        pipe.hdel(fingerprint_key, *batch)
+        yield pipe, 'deleted', len(batch)
+        metrics.inc('redis_commands', command='del')
+        metrics.inc('redis_commands', command='hdel')
+
+
+def _start_publish(stored_fingerprints, totals_df, prune, force):
+    """
+    Plan a publish against the fingerprints just read from Redis.
+
+    Returns:
+    tuple: (changed, stale, result) with the run counters, see _plan_publish.
+    """
+    force = Config.REDIS_FORCE_PUBLISH if force is None else force
+    metrics.inc('redis_commands', command='hgetall')
+    changed, stale, unchanged = _plan_publish(stored_fingerprints, totals_df, prune, force)
+    return changed, stale, {'written': 0, 'unchanged': unchanged, 'deleted': 0}
+
+
+def _publish_failed(logger, error):
+    logger.error(f"Error storing referee summaries in Redis: {str(error)}")
+    return ValueError(f"Error storing referee summaries: {str(error)}")
+
+
+def publish_referee_summaries(r, totals_df, logger, prune=True, force=None):
+    """
+    Publish referee summaries to Redis, skipping the ones whose payload has not changed.
+
+    A fingerprint of every published payload is kept in the Config.REDIS_FINGERPRINT_KEY hash,
+    next to the summary keys themselves.
 
     Parameters:
-    session: SQLAlchemy session for database operations.
+    r (redis.Redis): Redis client.
+    totals_df (pd.DataFrame): DataFrame with referee, total_commissions and pending_commissions.
     logger: Logger object for logging information and errors.
+    prune (bool): Delete summaries of referees that are fingerprinted but absent from totals_df.
+                  Only valid when totals_df covers every referee.
+    force (bool, optional): Rewrite every summary regardless of fingerprints.
+                            Defaults to Config.REDIS_FORCE_PUBLISH.
+
+    Returns:
+    dict: Counters for the run (e.g., {'written': n, 'unchanged': m, 'deleted': k}).
+
+    Raises:
+    ValueError: If a pipelined batch cannot be stored.
+    """
+    changed, stale, result = _start_publish(r.hgetall(Config.REDIS_FINGERPRINT_KEY), totals_df, prune, force)
+
+    # Write changed summaries and their fingerprints, one round trip per batch
+    try:
+        for pipe, counter, count in _publish_batches(r, changed, stale):
+            pipe.execute()
+            result[counter] += count
+    except Exception as e:
+        raise _publish_failed(logger, e)
+
+    return result
+
+
+async def publish_referee_summaries_async(r, totals_df, logger, prune=True, force=None):
+    """
+    Async counterpart of publish_referee_summaries for a redis.asyncio client.
+    Pipelines are sent one after the other, so at most one Redis connection is used.
+    """
+    changed, stale, result = _start_publish(await r.hgetall(Config.REDIS_FINGERPRINT_KEY), totals_df, prune, force)
+
+    try:
+        for pipe, counter, count in _publish_batches(r, changed, stale):
+            await pipe.execute()
+            result[counter] += count
+    except Exception as e:
+        raise _publish_failed(logger, e)
+
+    return result
+
+
+def _connected(logger):
+    metrics.inc('redis_commands', command='ping')
+    logger.info("Successfully connected to Redis.")
+
+
+def _connect_failed(logger, error):
+    logger.error(f"Failed to connect to Redis: {str(error)}")
+    return ConnectionError(f"Failed to connect to Redis: {str(error)}")
+
+
+def connect_redis(logger):
+    """
+    Open a Redis client from Config and check the connection.
+
+    Raises:
+    ConnectionError: If Redis cannot be reached.
     """
     # Retrieve Redis configuration
     redis_host = Config.REDIS_HOST
@@ -25,40 +178,70 @@ def update_redis(session, logger: logging.Logger):
     try:
         r = redis.Redis(host=redis_host, port=redis_port, db=redis_db, password=redis_password, decode_responses=True)
         r.ping()  # Test connection
-        logger.info("Successfully connected to Redis.")
     except redis.ConnectionError as e:
-        logger.error(f"Failed to connect to Redis: {str(e)}")
-        raise ConnectionError(f"Failed to connect to Redis: {str(e)}")
+        raise _connect_failed(logger, e)
+    _connected(logger)
+    return r
+
 
-    # Read DataFrame from database
+def _aggregate_totals(session, logger):
+    """
+    Aggregate the totals in the database, one row per referee.
+    """
     try:
-        commission_transactions_df = read_CommissionTransactions_to_df(session, logger)
-        logger.info(f"Successfully read {len(commission_transactions_df)} rows from commission_transactions table.")
+        totals_df = fetch_commission_totals(session)
     except ValueError as e:
-        logger.error(f"Error reading DataFrame from database: {str(e)}")
+        logger.error(f"Error aggregating commission totals from database: {str(e)}")
         raise
+    logger.info(f"Identified {len(totals_df)} unique referees.")
+    metrics.inc('rows_processed', len(totals_df), stage='update_redis')
+    return totals_df
 
-    # Get unique referees (used as user_ids)
-    user_ids = list(commission_transactions_df['referee'].unique())
-    logger.info(f"Identified {len(user_ids)} unique referees.")
 
-    # Process and store data for each unique referee
-    for user_id in user_ids:
-        temp_df = commission_transactions_df[commission_transactions_df['referee'] == user_id]
-        total_commissions = temp_df['commission_amount'].sum()
-        pending_commissions = temp_df[temp_df['commission_paid'] == False]['commission_amount'].sum()
-        total_commissions_paid_out = total_commissions - pending_commissions
+def update_redis(session, logger: logging.Logger, context=None):
+    """
+    Update Redis with per-referee commission totals aggregated in the database.
+
+    Parameters:
+    session: SQLAlchemy session for database operations.
+    logger: Logger object for logging information and errors.
+    context (RunContext, optional): Shared run inputs. Unused, accepted for the stage scheduler.
+
+    Returns:
+    dict: Counters for the run (e.g., {'written': n, 'unchanged': m, 'deleted': k}).
+    """
+    r = connect_redis(logger)
+    totals_df = _aggregate_totals(session, logger)
 
-        data = {
-            'total_commissions_paid_out': total_commissions_paid_out,
-            'pending_commissions': pending_commissions,
-            'total_commissions': total_commissions
-        }
+    result = publish_referee_summaries(r, totals_df, logger)
+    logger.info(f"Published referee summaries to Redis: {result}")
+    return result
 
-        key = str(user_id)
+
+async def update_redis_async(session, logger: logging.Logger, context=None):
+    """
+    Async counterpart of update_redis, using redis.asyncio and the AsyncSession.
+    """
+    from resources.async_clients import get_async_redis
+    from resources.scheduler import RunContext
+
+    context = context or RunContext()
+    limits = context.backend_limits()
+
+    r = get_async_redis()
+    try:
         try:
-            r.set(key, json.dumps(data))
-            logger.info(f"Successfully stored data for key '{key}' in Redis.")
-        except Exception as e:
-            logger.error(f"Error storing data for key '{key}' in Redis: {str(e)}")
-            raise ValueError(f"Error storing data for key '{key}': {str(e)}")
+            await r.ping()
+        except redis.ConnectionError as e:
+            raise _connect_failed(logger, e)
+        _connected(logger)
+
+        async with limits.db:
+            totals_df = await session.run_sync(_aggregate_totals, logger)
+
+        async with limits.redis:
+            result = await publish_referee_summaries_async(r, totals_df, logger)
+        logger.info(f"Published referee summaries to Redis: {result}")
+        return result
+    finally:
+        await r.aclose()
@@ -0,0 +1,101 @@
+import pandas as pd
+
+from resources.db import fetch_users, fetch_commission_rates, fetch_commission_totals, update_isactive_in_users
+from update_active_status.update_active_status import check_active_subscriptions
+from update_commision_transactions_db.stripe_client import get_charges_by_id
+from update_commision_transactions_db.update_commision_transactions import CHARGE_COLUMNS, write_charge_records
+from update_redis.update_redis import publish_referee_summaries
+
+# Event type prefixes this mode consumes, and the kind of object each one points at
+SUBSCRIPTION_EVENT_PREFIX = 'customer.subscription.'
+CHARGE_EVENT_PREFIX = 'charge.'
+
+
+def event_target(event):
+    """
+    Reduce a Stripe event to the object whose current state must be re-fetched.
+
+    Returns:
+    tuple: ('customer', customer_id) for subscription events, ('charge', charge_id) for charge,
+           refund and dispute events, or None for events this mode ignores.
+    """
+    obj = event['data']['object']
+    if event['type'].startswith(SUBSCRIPTION_EVENT_PREFIX):
+        customer = obj.get('customer')
+        return ('customer', customer if isinstance(customer, str) else customer['id']) if customer else None
+    if event['type'].startswith(CHARGE_EVENT_PREFIX):
+        charge_id = obj['id'] if obj.get('object') == 'charge' else obj.get('charge')
+        return ('charge', charge_id) if charge_id else None
+    return None
+
+
+def apply_events(session, r, logger, events):
+    """
+    Apply one micro-batch of webhook events.
+
+    The payloads of the events are never trusted as the latest state. Every affected customer and
+    charge is re-fetched from Stripe, so applying a batch is idempotent and the order in which
+    events arrived does not matter.
+
+    A customer or charge that cannot be re-fetched is left untouched, and its events are not
+    reported as applied so they stay queued for a retry.
+
+    Parameters:
+    session: SQLAlchemy session for database operations.
+    r (redis.Redis): Redis client.
+    logger (GcpLogger): Logger instance for logging operations.
+    events (list): Queued (event_id, object_kind, object_id) rows.
+
+    Returns:
+    tuple: (applied, result) with the ids of the events that were applied and counters for the batch.
+    """
+    customer_ids, charge_ids = split_targets(events)
+    result = {'customers': 0, 'charges': 0, 'referees': 0}
+    referees = set()
+    # (object_kind, object_id) of the objects that could not be re-fetched
+    failed = set()
+
+    if customer_ids:
+        df_users = fetch_users(session, customer_ids)
+        if not df_users.empty:
+            df_users['active'] = pd.Series(
+                check_active_subscriptions(df_users['stripe_customer_id'].tolist(), logger),
+                index=df_users.index, dtype='boolean'
+            )
+            unchecked = df_users['active'].isna()
+            failed.update(('customer', customer_id) for customer_id in df_users.loc[unchecked, 'stripe_customer_id'])
+            df_users = df_users[~unchecked]
+            if not df_users.empty:
+                update_isactive_in_users(session, df_users[['user_id', 'active']], logger)
+        result['customers'] = len(df_users)
+
+    if charge_ids:
+        df_charges = get_charges_by_id(logger, sorted(charge_ids), expand_customer=True)
+        # get_charges_by_id leaves out the charges it could not retrieve
+        failed.update(('charge', charge_id) for charge_id in charge_ids - set(df_charges['charge_id']))
+        df_users = fetch_users(session, set(df_charges['customer_id'].dropna()))
+        # Charges of customers that were not referred do not earn commission and are not stored
+        referals_df = df_charges.merge(df_users.rename(columns={'stripe_customer_id': 'customer_id'}),
+                                       on='customer_id')
+        if not referals_df.empty:
+            write_charge_records(session, referals_df[CHARGE_COLUMNS].to_dict('records'),
+                                 fetch_commission_rates(session))
+            referees.update(referals_df['referee'].dropna())
+        result['charges'] = len(referals_df)
+
+    if referees:
+        totals_df = fetch_commission_totals(session, referees)
+        publish_referee_summaries(r, totals_df, logger, prune=False)
+        result['referees'] = len(totals_df)
+
+    applied = [event_id for event_id, object_kind, object_id in events if (object_kind, object_id) not in failed]
+    return applied, result
+
+
+def split_targets(events):
+    """
+    Group queued (event_id, object_kind, object_id) rows into the distinct customers and charges to refresh.
+    """
+    customer_ids = {object_id for _, object_kind, object_id in events if object_kind == 'customer'}
+    charge_ids = {object_id for _, object_kind, object_id in events if object_kind == 'charge'}
+    return customer_ids, charge_ids
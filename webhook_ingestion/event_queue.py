@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id TEXT PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    object_kind TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    applied_at REAL
+)
+"""
+
+
+class EventQueue:
+    """
+    Durable queue of Stripe webhook events in a local SQLite file.
+
+    Events are keyed by their Stripe event id, so a redelivered event is ignored. Applied events are
+    kept for `retention` seconds to keep de-duplicating late redeliveries. Only the object an event
+    refers to is stored: the applier re-fetches its current state, which makes the order of events
+    irrelevant.
+    """
+
+    def __init__(self, path, retention):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS webhook_events_pending ON webhook_events (status, received_at)")
+
+    def enqueue(self, event_id, event_type, object_kind, object_id):
+        """
+        Persist an event. Returns False if the event id was already received.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO webhook_events (event_id, event_type, object_kind, object_id, received_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (event_id, event_type, object_kind, object_id, time.time())
+            )
+        return cursor.rowcount == 1
+
+    def pending(self, limit):
+        """
+        Return up to `limit` pending events, oldest first, as (event_id, object_kind, object_id) tuples.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT event_id, object_kind, object_id FROM webhook_events WHERE status = 'pending' "
+                "ORDER BY received_at LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def mark_applied(self, event_ids):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE webhook_events SET status = 'applied', applied_at = ? WHERE event_id = ?",
+                [(time.time(), event_id) for event_id in event_ids]
+            )
+
+    def mark_failed(self, event_ids, error, max_attempts):
+        """
+        Record a failed attempt. Events stay pending until they have failed max_attempts times.
+        """
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE webhook_events SET attempts = attempts + 1, last_error = ?, "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END WHERE event_id = ?",
+                [(error, max_attempts, event_id) for event_id in event_ids]
+            )
+
+    def prune(self):
+        """
+        Forget applied events older than the retention window. Returns the number of rows removed.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM webhook_events WHERE status = 'applied' AND applied_at < ?",
+                (time.time() - self.retention,)
+            )
+        return cursor.rowcount
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM webhook_events GROUP BY status").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
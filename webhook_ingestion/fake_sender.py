@@ -0,0 +1,83 @@
+"""
+Send signed fake Stripe events to a local webhook endpoint, for testing the ingestion mode.
+
+    python -m webhook_ingestion.fake_sender --secret whsec_test --type charge.refunded --object-id ch_123
+    python -m webhook_ingestion.fake_sender --secret whsec_test --type customer.subscription.deleted \
+        --customer cus_123 --repeat 3
+
+The signature header matches Stripe's scheme: t=<timestamp>,v1=<HMAC-SHA256 of "<timestamp>.<payload>">.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+
+def build_event(event_type, object_id=None, customer_id=None, event_id=None):
+    """
+    Build a minimal event of the given type. Only the fields the ingestion mode reads are filled in.
+    """
+    if event_type.startswith('customer.subscription.'):
+        obj = {'id': object_id or f"sub_{uuid.uuid4().hex[:14]}", 'object': 'subscription', 'customer': customer_id}
+    elif event_type.startswith('charge.dispute.'):
+        obj = {'id': f"dp_{uuid.uuid4().hex[:14]}", 'object': 'dispute', 'charge': object_id}
+    elif event_type.startswith('charge.refund.'):
+        obj = {'id': f"re_{uuid.uuid4().hex[:14]}", 'object': 'refund', 'charge': object_id}
+    else:
+        obj = {'id': object_id, 'object': 'charge', 'customer': customer_id}
+    return {
+        'id': event_id or f"evt_{uuid.uuid4().hex[:24]}",
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()),
+        'data': {'object': obj}
+    }
+
+
+def sign(payload, secret, timestamp=None):
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode('utf-8'), f"{timestamp}.{payload}".encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def send_event(url, event, secret):
+    """
+    POST an event with a valid signature.
+
+    Returns:
+    tuple: (HTTP status, response body).
+    """
+    payload = json.dumps(event)
+    request = urllib.request.Request(url, data=payload.encode('utf-8'), method='POST', headers={
+        'Content-Type': 'application/json',
+        'Stripe-Signature': sign(payload, secret)
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode('utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send signed fake Stripe webhook events.")
+    parser.add_argument('--url', default='http://localhost:8080/webhook')
+    parser.add_argument('--secret', required=True, help="Webhook signing secret, as in STRIPE_WEBHOOK_SECRET.")
+    parser.add_argument('--type', required=True, help="Event type, e.g. charge.succeeded or charge.dispute.created.")
+    parser.add_argument('--object-id', help="Charge id for charge events, subscription id for subscription events.")
+    parser.add_argument('--customer', help="Stripe customer id.")
+    parser.add_argument('--repeat', type=int, default=1, help="Send the same event this many times.")
+    args = parser.parse_args(argv)
+
+    event = build_event(args.type, args.object_id, args.customer)
+    for _ in range(args.repeat):
+        status, body = send_event(args.url, event, args.secret)
+        print(f"{event['id']} {args.type}: {status} {body}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+
+from resources.config import Config
+from resources.db import new_db_session
+from update_redis.update_redis import connect_redis
+from webhook_ingestion.apply_events import apply_events, event_target
+from webhook_ingestion.event_queue import EventQueue
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Receives Stripe events on POST /webhook, verifies their signature and queues them.
+
+    Stripe gets a 2xx as soon as the event is durably queued; applying it happens in the background.
+    """
+
+    # Set on the subclass built by make_server
+    queue = None
+    logger = None
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/webhook':
+            self._respond(404, "not found")
+            return
+
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            event = stripe.Webhook.construct_event(payload, self.headers.get('Stripe-Signature', ''),
+                                                   Config.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            self.logger.warning(f"Rejected webhook payload: {str(e)}")
+            self._respond(400, "invalid payload or signature")
+            return
+
+        target = event_target(event)
+        if target is None:
+            self._respond(200, "ignored")
+            return
+
+        queued = self.queue.enqueue(event['id'], event['type'], *target)
+        self.logger.debug("Webhook %s %s for %s %s", event['type'], 'queued' if queued else 'duplicate', *target)
+        self._respond(200, "queued" if queued else "duplicate")
+
+    def do_GET(self):
+        # Health check
+        if self.path.rstrip('/') == '/healthz':
+            self._respond(200, "ok")
+        else:
+            self._respond(404, "not found")
+
+    def _respond(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are logged through the job logger instead of stderr
+        pass
+
+
+def make_server(queue, logger, host=None, port=None):
+    handler = type('BoundWebhookHandler', (WebhookHandler,), {'queue': queue, 'logger': logger})
+    return ThreadingHTTPServer((host or Config.WEBHOOK_HOST, Config.WEBHOOK_PORT if port is None else port), handler)
+
+
+def run_applier(queue, r, logger, stop_event):
+    """
+    Apply queued events in micro-batches until stop_event is set, then drain what is left.
+
+    A failed batch, or the events of a batch whose customer or charge could not be re-fetched, is
+    retried on the next tick; events are marked failed after Config.WEBHOOK_MAX_ATTEMPTS attempts and
+    left for the nightly reconciliation.
+    """
+    ticks = 0
+    while True:
+        events = queue.pending(Config.WEBHOOK_BATCH_SIZE)
+        if not events:
+            if stop_event.is_set():
+                return
+            ticks += 1
+            if ticks % 1000 == 0:
+                queue.prune()
+            stop_event.wait(Config.WEBHOOK_BATCH_INTERVAL)
+            continue
+
+        event_ids = [event[0] for event in events]
+        session = new_db_session()
+        try:
+            applied, result = apply_events(session, r, logger, events)
+            queue.mark_applied(applied)
+            applied_ids = set(applied)
+            unapplied = [event_id for event_id in event_ids if event_id not in applied_ids]
+            if unapplied:
+                queue.mark_failed(unapplied, "customer or charge could not be re-fetched from Stripe",
+                                  Config.WEBHOOK_MAX_ATTEMPTS)
+                logger.warning(f"{len(unapplied)} webhook events left for a retry, their object could not be "
+                               f"re-fetched from Stripe.")
+            logger.info(f"Applied {len(applied)} of {len(events)} webhook events: {result}")
+        except Exception as e:
+            session.rollback()
+            unapplied = event_ids
+            queue.mark_failed(event_ids, str(e), Config.WEBHOOK_MAX_ATTEMPTS)
+            logger.error(f"Error applying {len(events)} webhook events: {str(e)}")
+        finally:
+            session.close()
+        if unapplied and stop_event.wait(Config.WEBHOOK_BATCH_INTERVAL):
+            # Shutting down: leave the rest queued for the next start
+            return
+
+
+def serve(logger, host=None, port=None):
+    """
+    Run the webhook ingestion mode: the HTTP endpoint plus the background micro-batch applier.
+    Blocks until interrupted.
+    """
+    if not Config.STRIPE_WEBHOOK_SECRET:
+        raise ValueError("STRIPE_WEBHOOK_SECRET is required in webhook mode")
+
+    stripe.api_key = Config.STRIPE_SECRET_KEY
+    r = connect_redis(logger)
+    queue = EventQueue(Config.WEBHOOK_QUEUE_PATH, Config.WEBHOOK_RETENTION_DAYS * 86400)
+    stop_event = threading.Event()
+    applier = threading.Thread(target=run_applier, args=(queue, r, logger, stop_event), name='webhook-applier')
+    applier.start()
+
+    server = make_server(queue, logger, host, port)
+    # Cloud Run stops instances with SIGTERM; shut down cleanly so the applier drains the queue
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    logger.info(f"Listening for Stripe webhooks on {server.server_address}, queue: {queue.counts()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stop_event.set()
+        applier.join()
+        queue.close()
+        logger.info("Webhook ingestion stopped.")